@@ -0,0 +1,309 @@
+"""Measure the per-batch runtime of the models on synthetic data.
+
+Regenerates tables shaped like writing/hard_stack_paper/runtime.tsv: one row
+per batch size and one column per model, for every sequence length and
+model_dim in the sweep. Models are built with init_model, so any model flag
+(e.g. --stack_type, --reduce, --encode) applies to the benchmark as well.
+
+Usage:
+
+    python -m spinn.benchmarks.runtime --benchmark_models SPINN,RNN \\
+        --benchmark_batch_sizes 32,64,128 --benchmark_json runtime.json
+
+Passing the JSON output of an earlier run as --benchmark_baseline reports the
+ratio to the baseline for every configuration, and exits with an error if any
+configuration is slower than the baseline by more than
+--benchmark_tolerance.
+"""
+
+import json
+import sys
+import time
+
+import gflags
+import numpy as np
+
+from spinn.util import afs_safe_logger
+from spinn.util.blocks import the_gpu
+from spinn.util.data import CompileTransitionPlans
+from spinn.util.loss import auxiliary_loss
+
+# PyTorch
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+import torch.nn.functional as F
+
+from spinn.data import T_SHIFT, T_REDUCE
+from spinn.models.base import get_data_manager, get_flags
+from spinn.models.base import flag_defaults, init_model
+from spinn.models.base import sequential_only, transition_plans
+
+
+FLAGS = gflags.FLAGS
+
+PHASES = ["forward", "forward_backward"]
+PHASE_NAMES = {"forward": "fwd", "forward_backward": "fwd+bwd"}
+
+
+def random_transitions(rng, seq_length):
+    """A uniformly random sequence of SHIFT/REDUCE transitions that forms a
+    valid binary tree over seq_length tokens."""
+    transitions = []
+    stack_size, n_shifts = 0, 0
+    while len(transitions) < 2 * seq_length - 1:
+        can_shift = n_shifts < seq_length
+        can_reduce = stack_size >= 2
+        if can_shift and (not can_reduce or rng.rand() < 0.5):
+            transitions.append(T_SHIFT)
+            stack_size += 1
+            n_shifts += 1
+        else:
+            transitions.append(T_REDUCE)
+            stack_size -= 1
+    return transitions
+
+
+def synthetic_batch(rng, batch_size, seq_length, vocab_size, num_classes,
+                    sentence_pair):
+    """A batch of full-length examples, so that no padding or truncation is
+    involved and every model does the same amount of work per example. As in
+    PreprocessDataset, sequential models get no transitions and count tokens
+    instead."""
+    num_sentences = 2 if sentence_pair else 1
+    X = rng.randint(1, vocab_size, size=(
+        batch_size, seq_length, num_sentences)).astype(np.int32)
+    y = rng.randint(0, num_classes, size=batch_size).astype(np.int64)
+    if sequential_only():
+        transitions = np.zeros((batch_size, 0, num_sentences), dtype=np.int32)
+        num_transitions = np.full((batch_size, num_sentences), seq_length,
+                                  dtype=np.int32)
+    else:
+        transitions = np.array([
+            [random_transitions(rng, seq_length) for _ in range(num_sentences)]
+            for _ in range(batch_size)], dtype=np.int32).transpose((0, 2, 1))
+        num_transitions = np.full((batch_size, num_sentences),
+                                  2 * seq_length - 1, dtype=np.int32)
+
+    plans = None
+    if transition_plans():
+        num_tokens = np.full(batch_size, seq_length, dtype=np.int64)
+        plans = np.stack([CompileTransitionPlans(transitions[:, :, i], num_tokens)
+                          for i in range(num_sentences)], axis=3)
+
+    if not sentence_pair:
+        X, transitions = X[:, :, 0], transitions[:, :, 0]
+        num_transitions = num_transitions[:, 0]
+        if plans is not None:
+            plans = plans[:, :, :, 0]
+    return X, transitions, y, num_transitions, plans
+
+
+def time_phase(run, warmup, repeats):
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return times
+
+
+def benchmark_config(model_type, batch_size, seq_length, model_dim, logger):
+    FLAGS.model_type = model_type
+    FLAGS.model_dim = model_dim
+    FLAGS.word_embedding_dim = model_dim
+    FLAGS.seq_length = seq_length
+    FLAGS.batch_size = batch_size
+
+    data_manager = get_data_manager(FLAGS.data_type)
+    num_classes = len(set(data_manager.LABEL_MAP.values()))
+    vocab_size = FLAGS.benchmark_vocab_size
+
+    torch.manual_seed(FLAGS.benchmark_seed)
+    rng = np.random.RandomState(FLAGS.benchmark_seed)
+
+    # RLSPINN needs a tracker and a transition net to sample parses from. If
+    # they are not configured, use a tracker half the size of the model.
+    tracker_dim, transition_weight = FLAGS.tracking_lstm_hidden_dim, FLAGS.transition_weight
+    if model_type == "RLSPINN":
+        if tracker_dim is None:
+            FLAGS.tracking_lstm_hidden_dim = model_dim // 2
+        if transition_weight is None:
+            FLAGS.transition_weight = 1.0
+    model, optimizer, _ = init_model(
+        FLAGS, logger, None, vocab_size, num_classes, data_manager)
+    FLAGS.tracking_lstm_hidden_dim, FLAGS.transition_weight = tracker_dim, transition_weight
+    X, transitions, y, num_transitions, plans = synthetic_batch(
+        rng, batch_size, seq_length, vocab_size, num_classes,
+        data_manager.SENTENCE_PAIR_DATA)
+
+    def run_model():
+        return model(X, transitions, y,
+                     use_internal_parser=FLAGS.use_internal_parser,
+                     validate_transitions=FLAGS.validate_transitions,
+                     example_lengths=num_transitions,
+                     transition_plans=plans)
+
+    def forward():
+        model.eval()
+        run_model()
+
+    def forward_backward():
+        model.train()
+        optimizer.zero_grad()
+        output = run_model()
+        logits = F.log_softmax(output)
+        total_loss = 0.0
+        total_loss += nn.NLLLoss()(logits, Variable(torch.from_numpy(y)))
+        transition_loss = getattr(model, 'transition_loss', None)
+        if transition_loss is not None and model.optimize_transition_loss:
+            total_loss += transition_loss
+        total_loss = total_loss + auxiliary_loss(model)
+        total_loss.backward()
+
+    result = dict(model=model_type, batch_size=batch_size,
+                  seq_length=seq_length, model_dim=model_dim)
+    for phase, run in zip(PHASES, [forward, forward_backward]):
+        times = time_phase(
+            run, FLAGS.benchmark_warmup, FLAGS.benchmark_repeats)
+        result[phase] = float(np.mean(times))
+        result[phase + "_min"] = float(np.min(times))
+    return result
+
+
+def config_key(result):
+    return (result["model"], result["batch_size"], result["seq_length"],
+            result["model_dim"])
+
+
+def write_tsv(results, models, batch_sizes, seq_lengths, model_dims, path):
+    """One row per batch size (largest first, as in runtime.tsv) and one
+    column per model and phase, for every sequence length and model_dim."""
+    by_key = {config_key(r): r for r in results}
+    columns = ["{} {}".format(model, PHASE_NAMES[phase])
+               for model in models for phase in PHASES]
+    lines = ["\t".join(["Batch size", "Seq length", "Model dim"] + columns)]
+    for model_dim in model_dims:
+        for seq_length in seq_lengths:
+            for batch_size in sorted(batch_sizes, reverse=True):
+                row = [str(batch_size), str(seq_length), str(model_dim)]
+                for model in models:
+                    result = by_key.get((model, batch_size, seq_length, model_dim))
+                    for phase in PHASES:
+                        row.append("" if result is None else "{:.6f}".format(result[phase]))
+                lines.append("\t".join(row))
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def compare_to_baseline(results, baseline_path, tolerance, logger):
+    """Log the ratio of every timing to the baseline, and return the
+    configurations that are slower than the baseline by more than the
+    tolerance. The fastest repeat is compared, since it is the least affected
+    by other load on the machine."""
+    with open(baseline_path) as f:
+        baseline = {config_key(r): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        base = baseline.get(config_key(result))
+        if base is None:
+            continue
+        for phase in PHASES:
+            new_time, base_time = result[phase + "_min"], base[phase + "_min"]
+            ratio = new_time / base_time
+            logger.Log("{} batch {} seq {} dim {} {}: {:.4f}s vs {:.4f}s ({:.2f}x)".format(
+                result["model"], result["batch_size"], result["seq_length"],
+                result["model_dim"], PHASE_NAMES[phase], new_time,
+                base_time, ratio))
+            if ratio > 1 + tolerance:
+                regressions.append((config_key(result), phase, ratio))
+    return regressions
+
+
+def run():
+    logger = afs_safe_logger.ProtoLogger()
+    # Don't print the architecture of every model that is built.
+    model_logger = afs_safe_logger.ProtoLogger(
+        min_print_level=afs_safe_logger.ProtoLogger.WARNING)
+
+    # The benchmark measures CPU throughput.
+    FLAGS.gpu = -1
+    the_gpu.gpu = -1
+
+    models = FLAGS.benchmark_models
+    batch_sizes = [int(x) for x in FLAGS.benchmark_batch_sizes]
+    seq_lengths = [int(x) for x in FLAGS.benchmark_seq_lengths]
+    model_dims = [int(x) for x in FLAGS.benchmark_model_dims]
+
+    results = []
+    for model_dim in model_dims:
+        for seq_length in seq_lengths:
+            for batch_size in batch_sizes:
+                for model_type in models:
+                    result = benchmark_config(
+                        model_type, batch_size, seq_length, model_dim, model_logger)
+                    results.append(result)
+                    logger.Log("{} batch {} seq {} dim {}: fwd {:.4f}s fwd+bwd {:.4f}s".format(
+                        model_type, batch_size, seq_length, model_dim,
+                        result["forward"], result["forward_backward"]))
+
+    if FLAGS.benchmark_tsv:
+        write_tsv(results, models, batch_sizes, seq_lengths, model_dims,
+                  FLAGS.benchmark_tsv)
+    if FLAGS.benchmark_json:
+        with open(FLAGS.benchmark_json, 'w') as f:
+            json.dump(dict(
+                flags=dict((k, str(v)) for k, v in FLAGS.FlagValuesDict().items()),
+                torch_version=torch.__version__,
+                results=results), f, indent=2, sort_keys=True)
+
+    if FLAGS.benchmark_baseline:
+        regressions = compare_to_baseline(
+            results, FLAGS.benchmark_baseline, FLAGS.benchmark_tolerance, logger)
+        for key, phase, ratio in regressions:
+            logger.Log("Regression: {} batch {} seq {} dim {} {} is {:.2f}x the baseline.".format(
+                key[0], key[1], key[2], key[3], PHASE_NAMES[phase], ratio))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+def get_benchmark_flags():
+    gflags.DEFINE_list("benchmark_models", "SPINN,RLSPINN,RNN,CBOW,ChoiPyramid",
+                       "Model types to benchmark.")
+    gflags.DEFINE_list("benchmark_batch_sizes", "32,64,128,256,512",
+                       "Batch sizes to sweep.")
+    gflags.DEFINE_list("benchmark_seq_lengths", "25", "Sequence lengths to sweep.")
+    gflags.DEFINE_list("benchmark_model_dims", "100", "Values of model_dim to sweep. "
+                       "word_embedding_dim is set to the same value.")
+    gflags.DEFINE_integer("benchmark_vocab_size", 1000,
+                          "Vocabulary size of the synthetic data.")
+    gflags.DEFINE_integer("benchmark_seed", 1234,
+                          "Seed for the synthetic data and the model weights.")
+    gflags.DEFINE_integer("benchmark_warmup", 2,
+                          "Untimed runs before timing each phase.")
+    gflags.DEFINE_integer("benchmark_repeats", 5,
+                          "Timed runs of each phase. The mean and min are reported.")
+    gflags.DEFINE_string("benchmark_tsv", "runtime.tsv",
+                         "Write a table shaped like runtime.tsv here.")
+    gflags.DEFINE_string("benchmark_json", None,
+                         "Write all timings as JSON here. Can be used as a baseline.")
+    gflags.DEFINE_string("benchmark_baseline", None,
+                         "JSON output of an earlier run to compare against.")
+    gflags.DEFINE_float("benchmark_tolerance", 0.1,
+                        "Fail if a timing is slower than the baseline by more "
+                        "than this fraction.")
+
+
+if __name__ == '__main__':
+    get_flags()
+    get_benchmark_flags()
+
+    # Parse command line flags.
+    FLAGS(sys.argv)
+
+    flag_defaults(FLAGS)
+
+    run()
@@ -6,7 +6,7 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
-from spinn.util.blocks import Embed, to_gpu, MLP
+from spinn.util.blocks import Embed, TokenTable, to_gpu, MLP
 from spinn.util.misc import Args, Vocab
 
 
@@ -29,6 +29,7 @@ def build_model(data_manager, initial_embeddings, vocab_size,
                      num_mlp_layers=FLAGS.num_mlp_layers,
                      mlp_ln=FLAGS.mlp_ln,
                      context_args=context_args,
+                     eval_projection_table=FLAGS.eval_projection_table,
                      )
 
 
@@ -49,6 +50,7 @@ class BaseModel(nn.Module):
                  mlp_ln=None,
                  use_sentence_pair=False,
                  context_args=None,
+                 eval_projection_table=False,
                  **kwargs
                  ):
         super(BaseModel, self).__init__()
@@ -82,6 +84,23 @@ class BaseModel(nn.Module):
         self.reshape_input = context_args.reshape_input
         self.reshape_context = context_args.reshape_context
 
+        # In eval, sum encoded embeddings from a table computed once per
+        # evaluation, if the encoder sees one token at a time.
+        self.projection_table = TokenTable(self.embed, self.encode) \
+            if eval_projection_table and context_args.token_wise else None
+
+    def train(self, mode=True):
+        # The table is only valid for the weights it was made with.
+        if self.projection_table is not None:
+            self.projection_table.clear()
+        return super(BaseModel, self).train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        if self.projection_table is not None:
+            self.projection_table.clear()
+        return super(BaseModel, self).load_state_dict(
+            state_dict, *args, **kwargs)
+
     def run_embed(self, x):
         batch_size, seq_length = x.size()
 
@@ -98,8 +117,11 @@ class BaseModel(nn.Module):
         sentences.shape[0]
 
         x = self.unwrap(sentences, transitions)
-        emb = self.run_embed(x)
-        hh = torch.squeeze(torch.sum(emb, 1))
+        if self.projection_table is not None and not self.training:
+            hh = self.projection_table.bag_of_words(x)
+        else:
+            emb = self.run_embed(x)
+            hh = torch.squeeze(torch.sum(emb, 1))
         h = self.wrap(hh)
         output = self.mlp(self.build_features(h))
 
@@ -142,11 +164,13 @@ class BaseModel(nn.Module):
     # --- Sentence Specific ---
 
     def unwrap_sentence_pair(self, sentences, transitions):
-        sentences.shape[0]
-
-        x_prem = sentences[:, :, 0]
-        x_hyp = sentences[:, :, 1]
-        x = np.concatenate([x_prem, x_hyp], axis=0)
+        if sentences.ndim == 2:
+            # Already unwrapped, with the premises stacked over the hypotheses.
+            x = sentences
+        else:
+            x_prem = sentences[:, :, 0]
+            x_hyp = sentences[:, :, 1]
+            x = np.concatenate([x_prem, x_hyp], axis=0)
 
         return to_gpu(
             Variable(
@@ -35,6 +35,7 @@ def build_model(data_manager, initial_embeddings, vocab_size,
                      composition_ln=FLAGS.composition_ln,
                      context_args=context_args,
                      trainable_temperature=FLAGS.pyramid_trainable_temperature,
+                     incremental=FLAGS.pyramid_incremental_composition,
                      )
 
 
@@ -56,6 +57,7 @@ class ChoiPyramid(nn.Module):
                  composition_ln=None,
                  context_args=None,
                  trainable_temperature=None,
+                 incremental=False,
                  **kwargs
                  ):
         super(ChoiPyramid, self).__init__()
@@ -83,7 +85,8 @@ class ChoiPyramid(nn.Module):
             model_dim / 2,
             False,
             composition_ln=composition_ln,
-            trainable_temperature=trainable_temperature)
+            trainable_temperature=trainable_temperature,
+            incremental=incremental)
 
         mlp_input_dim = self.get_features_dim()
 
@@ -226,9 +229,13 @@ class ChoiPyramid(nn.Module):
     # --- Sentence Specific ---
 
     def unwrap_sentence_pair(self, sentences, lengths=None):
-        x_prem = sentences[:, :, 0]
-        x_hyp = sentences[:, :, 1]
-        x = np.concatenate([x_prem, x_hyp], axis=0)
+        if sentences.ndim == 2:
+            # Already unwrapped, with the premises stacked over the hypotheses.
+            x = sentences
+        else:
+            x_prem = sentences[:, :, 0]
+            x_hyp = sentences[:, :, 1]
+            x = np.concatenate([x_prem, x_hyp], axis=0)
 
         if lengths is not None:
             len_prem = lengths[:, 0]
@@ -258,11 +265,13 @@ class ChoiPyramid(nn.Module):
 class BinaryTreeLSTM(nn.Module):
 
     def __init__(self, word_dim, hidden_dim, intra_attention,
-                 composition_ln=False, trainable_temperature=False):
+                 composition_ln=False, trainable_temperature=False,
+                 incremental=False):
         super(BinaryTreeLSTM, self).__init__()
         self.word_dim = word_dim
         self.hidden_dim = hidden_dim
         self.intra_attention = intra_attention
+        self.incremental = incremental
         self.treelstm_layer = BinaryTreeLSTMLayer(
             hidden_dim, composition_ln=composition_ln)
 
@@ -336,22 +345,86 @@ class BinaryTreeLSTM(nn.Module):
         selected_h = (select_mask_expand * new_h).sum(1)
         return new_h, new_c, select_mask, selected_h, temperature_to_display
 
+    def update_candidates(self, candidates, state, select_mask, done_mask):
+        """
+        Compose the adjacent pairs of the next layer, reusing the candidates
+        of this layer. A merge at k only changes the pairs at k - 1 and k:
+        the pairs to the left of the merge are the same as before, and the
+        ones to its right move one position to the left. Rows that are done
+        only drop their last pair. So only two pairs per row are composed.
+
+        In training, the forward pass is the same as composing every pair,
+        but the straight-through gradient of the selection reaches the next
+        layer only through the two pairs that are composed.
+
+        Args:
+            candidates: A (h, c) tuple of this layer's compositions, each of
+                size (batch_size, width, hidden_dim).
+            state: A (h, c) tuple of the next layer's nodes, each of size
+                (batch_size, width, hidden_dim).
+            select_mask: The merge of each row, of size (batch_size, width).
+            done_mask: Which rows merged, of size (batch_size,).
+
+        Returns:
+            h, c: The next layer's compositions, each of size
+                (batch_size, width - 1, hidden_dim).
+        """
+
+        h, c = state
+        cand_h, cand_c = candidates
+        batch_size, width, hidden_dim = h.size()
+        num_pairs = width - 1
+
+        merged = select_mask.data.max(1)[1]
+        active = done_mask.data.long()
+        merged = active * merged + (1 - active) * width
+
+        positions = torch.arange(0, num_pairs, out=merged.new()).unsqueeze(
+            0).expand(batch_size, num_pairs)
+        index = positions + (positions >= merged.unsqueeze(1)).long()
+
+        def gather(x, index):
+            index = Variable(index.unsqueeze(2).expand(
+                index.size(0), index.size(1), hidden_dim))
+            return x.gather(1, index)
+
+        # Merging into the first or last node changes a single pair.
+        left = torch.stack([merged - 1, merged], 1).clamp(0, num_pairs - 1)
+        right = left + 1
+        new_h, new_c = self.treelstm_layer(
+            l=(gather(h, left), gather(c, left)),
+            r=(gather(h, right), gather(c, right)))
+
+        replace = cand_h.data.new(batch_size, 2, num_pairs).zero_()
+        replace.scatter_(2, left.unsqueeze(2), 1)
+        replace[:, 1] *= (left[:, 1] != left[:, 0]).unsqueeze(1).float()
+        replace *= active.float().unsqueeze(1).unsqueeze(2)
+        keep = Variable((1 - replace.sum(1)).unsqueeze(2))
+        replace = Variable(replace.transpose(1, 2))
+
+        h = keep * gather(cand_h, index) + torch.bmm(replace, new_h)
+        c = keep * gather(cand_c, index) + torch.bmm(replace, new_c)
+        return h, c
+
     def forward(self, input, length, temperature_multiplier=1.0):
         max_depth = input.size(1)
         length_mask = sequence_mask(sequence_length=length,
                                     max_length=max_depth)
         select_masks = []
-        state = input.chunk(num_chunks=2, dim=2)
+        state = input.chunk(2, dim=2)
         nodes = []
         # For one or two-word trees where we never compute a temperature
         temperature_to_display = -1.0
         if self.intra_attention:
             nodes.append(state[0])
+        candidates = None
         for i in range(max_depth - 1):
             h, c = state
-            l = (h[:, :-1, :], c[:, :-1, :])
-            r = (h[:, 1:, :], c[:, 1:, :])
-            new_state = self.treelstm_layer(l=l, r=r)
+            if candidates is None:
+                l = (h[:, :-1, :], c[:, :-1, :])
+                r = (h[:, 1:, :], c[:, 1:, :])
+                candidates = self.treelstm_layer(l=l, r=r)
+            new_state = candidates
             if i < max_depth - 2:
                 # We don't need to greedily select the composition in the
                 # last iteration, since it has only one option left.
@@ -365,6 +438,11 @@ class BinaryTreeLSTM(nn.Module):
             done_mask = length_mask[:, i + 1]
             state = self.update_state(old_state=state, new_state=new_state,
                                       done_mask=done_mask)
+            if self.incremental and i < max_depth - 2:
+                candidates = self.update_candidates(
+                    candidates, state, select_mask, done_mask)
+            else:
+                candidates = None
             if self.intra_attention and i >= max_depth - 2:
                 nodes.append(state[0])
         h, c = state
@@ -553,7 +631,7 @@ class BinaryTreeLSTMLayer(nn.Module):
 
         hlr_cat = torch.cat([hl, hr], dim=2)
         treelstm_vector = apply_nd(fn=self.comp_linear, input=hlr_cat)
-        i, fl, fr, u, o = treelstm_vector.chunk(num_chunks=5, dim=2)
+        i, fl, fr, u, o = treelstm_vector.chunk(5, dim=2)
         c = (cl * (fl + 1).sigmoid() + cr * (fr + 1).sigmoid()
              + u.tanh() * i.sigmoid())
         h = o.sigmoid() * c.tanh()
@@ -17,7 +17,7 @@ from spinn.data.boolean import load_boolean_data
 from spinn.data.listops import load_listops_data
 from spinn.data.sst import load_sst_data, load_sst_binary_data
 from spinn.data.nli import load_nli_data
-from spinn.util.blocks import ModelTrainer, ModelTrainer_ES, bundle
+from spinn.util.blocks import ModelTrainer, ModelTrainer_ES, LSTMStateBatch
 from spinn.util.blocks import EncodeGRU, IntraAttention, Linear, ReduceTreeGRU, ReduceTreeLSTM
 from spinn.util.misc import Args
 from spinn.util.logparse import parse_flags
@@ -55,8 +55,12 @@ def log_path(FLAGS, load=False):
     return os.path.join(lp, en) + ".log"
 
 
+def transition_plans():
+    return FLAGS.stack_type == "thin" and not FLAGS.use_internal_parser and not sequential_only()
+
+
 def get_batch(batch):
-    X_batch, transitions_batch, y_batch, num_transitions_batch, example_ids = batch
+    X_batch, transitions_batch, y_batch, num_transitions_batch, example_ids, plans_batch = batch
 
     # Truncate each batch to max length within the batch.
     X_batch_is_left_padded = pad_from_left()
@@ -68,8 +72,11 @@ def get_batch(batch):
     X_batch = truncate(X_batch, seq_length, max_length, X_batch_is_left_padded)
     transitions_batch = truncate(transitions_batch, seq_length,
                                  max_length, transitions_batch_is_left_padded)
+    if plans_batch.shape[1] > 0:
+        plans_batch = truncate(plans_batch, seq_length,
+                               max_length, transitions_batch_is_left_padded)
 
-    return X_batch, transitions_batch, y_batch, num_transitions_batch, example_ids
+    return X_batch, transitions_batch, y_batch, num_transitions_batch, example_ids, plans_batch
 
 
 def truncate(data, seq_length, max_length, left_padded):
@@ -125,7 +132,32 @@ def get_checkpoint_path(
     return checkpoint_path
 
 
-def load_data_and_embeddings(
+def data_cache_key(FLAGS, training_data_path, eval_data_path):
+    """Identifies the inputs and settings that preprocessing depends on. The
+    model type enters only through the data layout it needs, so that e.g.
+    SPINN and RLSPINN runs share a cache."""
+    paths = eval_data_path.split(':') + [FLAGS.embedding_data_path]
+    if not FLAGS.expanded_eval_only_mode:
+        paths.append(training_data_path)
+    settings = dict(
+        data_type=FLAGS.data_type,
+        training_data_path=None if FLAGS.expanded_eval_only_mode else training_data_path,
+        eval_data_path=eval_data_path,
+        embedding_data_path=FLAGS.embedding_data_path,
+        lowercase=FLAGS.lowercase,
+        train_genre=FLAGS.train_genre,
+        eval_genre=FLAGS.eval_genre,
+        seq_length=FLAGS.seq_length,
+        eval_seq_length=FLAGS.eval_seq_length,
+        allow_cropping=FLAGS.allow_cropping,
+        allow_eval_cropping=FLAGS.allow_eval_cropping,
+        sequential_only=sequential_only(),
+        pad_from_left=pad_from_left(),
+        transition_plans=transition_plans())
+    return util.DataCacheKey(paths, settings)
+
+
+def preprocess_data(
         FLAGS,
         data_manager,
         logger,
@@ -180,21 +212,13 @@ def load_data_and_embeddings(
         vocabulary = data_manager.FIXED_VOCABULARY
         logger.Log("In fixed vocabulary mode. Training embeddings.")
 
-    # Load pretrained embeddings.
-    if FLAGS.embedding_data_path:
-        logger.Log("Loading vocabulary with " + str(len(vocabulary))
-                   + " words from " + FLAGS.embedding_data_path)
-        initial_embeddings = util.LoadEmbeddingsFromText(
-            vocabulary, FLAGS.word_embedding_dim, FLAGS.embedding_data_path)
-    else:
-        initial_embeddings = None
-
     # Trim dataset, convert token sequences to integer sequences, crop, and
-    # pad.
+    # pad. Tokens resolved for one dataset are reused for the next.
+    token_ids = util.Vocabulary(vocabulary)
     logger.Log("Preprocessing training data.")
     training_data = util.PreprocessDataset(
         raw_training_data,
-        vocabulary,
+        token_ids,
         FLAGS.seq_length,
         data_manager,
         eval_mode=False,
@@ -202,29 +226,90 @@ def load_data_and_embeddings(
         sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
         simple=sequential_only(),
         allow_cropping=FLAGS.allow_cropping,
-        pad_from_left=pad_from_left()) if raw_training_data is not None else None
-    training_data_iter = util.MakeTrainingIterator(
-        training_data, FLAGS.batch_size, FLAGS.smart_batching, FLAGS.use_peano,
-        sentence_pair_data=data_manager.SENTENCE_PAIR_DATA) if raw_training_data is not None else None
+        pad_from_left=pad_from_left(),
+        compile_plans=transition_plans(),
+        num_workers=FLAGS.preprocessing_workers) if raw_training_data is not None else None
 
     # Preprocess eval sets.
-    eval_iterators = []
+    eval_sets = []
     for filename, raw_eval_set in raw_eval_sets:
         logger.Log("Preprocessing eval data: " + filename)
         eval_data = util.PreprocessDataset(
-            raw_eval_set, vocabulary,
+            raw_eval_set, token_ids,
             FLAGS.eval_seq_length if FLAGS.eval_seq_length is not None else FLAGS.seq_length,
             data_manager, eval_mode=True, logger=logger,
             sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
             simple=sequential_only(),
-            allow_cropping=FLAGS.allow_eval_cropping, pad_from_left=pad_from_left())
+            allow_cropping=FLAGS.allow_eval_cropping, pad_from_left=pad_from_left(),
+            compile_plans=transition_plans(), num_workers=FLAGS.preprocessing_workers)
+        eval_sets.append((filename, eval_data))
+
+    return vocabulary, training_data, eval_sets
+
+
+def load_data_and_embeddings(
+        FLAGS,
+        data_manager,
+        logger,
+        training_data_path,
+        eval_data_path):
+
+    # Reuse preprocessed data from an earlier run if possible.
+    cache_path = None
+    if FLAGS.data_cache_path:
+        cache_path = os.path.join(FLAGS.data_cache_path, data_cache_key(
+            FLAGS, training_data_path, eval_data_path))
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.Log("Loading preprocessed data from " + cache_path)
+        vocabulary, training_data, eval_sets = util.LoadPreprocessedData(
+            cache_path)
+        if data_manager.FIXED_VOCABULARY:
+            vocabulary = data_manager.FIXED_VOCABULARY
+    else:
+        vocabulary, training_data, eval_sets = preprocess_data(
+            FLAGS, data_manager, logger, training_data_path, eval_data_path)
+        if cache_path is not None:
+            logger.Log("Caching preprocessed data in " + cache_path)
+            util.SavePreprocessedData(
+                cache_path, vocabulary, training_data, eval_sets)
+
+    # Load pretrained embeddings.
+    if FLAGS.embedding_data_path:
+        logger.Log("Loading vocabulary with " + str(len(vocabulary))
+                   + " words from " + FLAGS.embedding_data_path)
+        initial_embeddings = util.LoadEmbeddings(
+            vocabulary, FLAGS.word_embedding_dim, FLAGS.embedding_data_path)
+    else:
+        initial_embeddings = None
+
+    training_data_iter = util.MakeTrainingIterator(
+        training_data, FLAGS.batch_size, FLAGS.smart_batching, FLAGS.use_peano,
+        sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
+        num_splits=FLAGS.smart_batching_splits,
+        token_budget=FLAGS.batch_token_budget) if training_data is not None else None
+
+    # Truncate and unwrap training batches ahead of the train loop.
+    def prepare_batch(batch):
+        batch = get_batch(batch)
+        if data_manager.SENTENCE_PAIR_DATA:
+            batch = util.UnwrapSentencePairBatch(batch)
+        return batch
+
+    if training_data_iter is not None:
+        training_data_iter = util.MakePrefetchingIterator(
+            training_data_iter, prepare_batch, FLAGS.prefetch_batches,
+            use_process=FLAGS.prefetch_process)
+
+    eval_iterators = []
+    for filename, eval_data in eval_sets:
         eval_it = util.MakeEvalIterator(
             eval_data,
             FLAGS.batch_size,
             FLAGS.eval_data_limit,
             bucket_eval=FLAGS.bucket_eval,
             shuffle=FLAGS.shuffle_eval,
-            rseed=FLAGS.shuffle_eval_seed)
+            rseed=FLAGS.shuffle_eval_seed,
+            token_budget=FLAGS.batch_token_budget)
         eval_iterators.append((filename, eval_it))
 
     return vocabulary, initial_embeddings, training_data_iter, eval_iterators
@@ -320,6 +405,12 @@ def get_flags():
         "smart_batching",
         True,
         "Organize batches using sequence length.")
+    gflags.DEFINE_integer(
+        "smart_batching_splits",
+        10,
+        "With smart_batching, the number of random splits of the training "
+        "set that are sorted by length separately each epoch. More splits "
+        "give more random batches with less uniform lengths.")
     gflags.DEFINE_boolean("use_peano", True, "A mind-blowing sorting key.")
     gflags.DEFINE_integer(
         "eval_data_limit",
@@ -335,7 +426,15 @@ def get_flags():
         123,
         "Seed shuffling of eval data.")
     gflags.DEFINE_string("embedding_data_path", None,
-                         "If set, load GloVe-formatted embeddings from here.")
+                         "If set, load GloVe-formatted embeddings from here. A path ending in "
+                         ".npy is read as a binary store made by scripts/convert_embeddings.py.")
+    gflags.DEFINE_integer(
+        "preprocessing_workers", 0, "If > 0, map tokens to IDs with this many "
+        "worker processes. Only helps for large corpora on machines with free cores.")
+    gflags.DEFINE_string(
+        "data_cache_path", None, "If set, save the preprocessed datasets and "
+        "vocabulary in this directory, and memory-map them in later runs that use the "
+        "same data files and preprocessing settings.")
 
     # Model architecture settings.
     gflags.DEFINE_enum(
@@ -383,17 +482,54 @@ def get_flags():
         "When True, layer normalization is used in TreeLSTM composition.")
     gflags.DEFINE_boolean("predict_use_cell", True,
                           "Use cell output as feature for transition net.")
+    gflags.DEFINE_boolean(
+        "compact_active_rows",
+        False,
+        "Only run the tracker and transition net on examples whose current "
+        "transition is not SKIP. Padded examples then keep their initial "
+        "tracker state instead of stepping through the padding.")
+    gflags.DEFINE_boolean(
+        "fused_gates",
+        False,
+        "Compute the gate inputs of the tracker and the TreeLSTM with a single "
+        "matrix multiply over their concatenated inputs. Checkpoints saved "
+        "without this are re-packed on load, dropping the optimizer state.")
+    gflags.DEFINE_boolean(
+        "profile_spinn",
+        False,
+        "Time each phase of the SPINN transition loop and log the totals. "
+        "On GPU, this waits for queued work before every reading of the clock.")
 
     # Reduce settings.
     gflags.DEFINE_enum(
         "reduce", "treelstm", [
             "treelstm", "treegru", "tanh"], "Specify composition function.")
+    gflags.DEFINE_enum(
+        "stack_type", "fat", [
+            "fat", "thin"],
+        "Keep SPINN's buffers and stacks as lists of per-example items (fat) "
+        "or as preallocated tensors with back-pointers (thin).")
+    gflags.DEFINE_boolean(
+        "level_wise_composition", False,
+        "Without a tracker and with gold transitions, compose all nodes of the "
+        "same height in a batch together. Uses the thin stack. Encodings differ "
+        "slightly from the transition loop when composition_ln is on.")
+    gflags.DEFINE_boolean(
+        "hash_cons_subtrees", False,
+        "In eval, compose each distinct subtree of a batch once. Turns on "
+        "level_wise_composition. Ignored with an encoder that sees context "
+        "(gru, attn).")
 
     # Pyramid model settings
     gflags.DEFINE_boolean(
         "pyramid_trainable_temperature",
         None,
         "If set, add a scalar trained temperature parameter.")
+    gflags.DEFINE_boolean(
+        "pyramid_incremental_composition", False,
+        "ChoiPyramid only. After each merge, compose only the two pairs next "
+        "to it and reuse the other compositions of the previous layer. "
+        "Compositions differ slightly when composition_ln is on.")
     gflags.DEFINE_float("pyramid_temperature_decay_per_10k_steps",
                         0.5, "What it says on the box.")
     gflags.DEFINE_float(
@@ -494,6 +630,22 @@ def get_flags():
         500000,
         "Stop training after this point.")
     gflags.DEFINE_integer("batch_size", 32, "SGD minibatch size.")
+    gflags.DEFINE_integer(
+        "prefetch_batches",
+        2,
+        "Number of training batches to prepare ahead in a background "
+        "worker. 0 prepares each batch in the train loop.")
+    gflags.DEFINE_boolean(
+        "prefetch_process",
+        False,
+        "Prefetch training batches in a forked process instead of a thread.")
+    gflags.DEFINE_integer(
+        "batch_token_budget",
+        0,
+        "If positive, size each training batch, and each bucket_eval batch, "
+        "to hold as many examples as fit in this many transitions, counted "
+        "as the number of examples times the longest one. Overrides "
+        "batch_size for those batches.")
     gflags.DEFINE_float("learning_rate", 0.001, "Used in optimizer.")
     gflags.DEFINE_float(
         "learning_rate_decay_per_10k_steps",
@@ -549,6 +701,23 @@ def get_flags():
         True,
         "When in expanded_eval_only_mode, load the ckpt_best checkpoint.")
     gflags.DEFINE_boolean("write_eval_report", False, "")
+    gflags.DEFINE_boolean(
+        "dedup_eval_sentences",
+        False,
+        "SPINN only. In eval, encode each distinct sentence of a batch once, "
+        "e.g. a premise that comes with several hypotheses. Transition "
+        "statistics then cover distinct sentences.")
+    gflags.DEFINE_integer(
+        "eval_encoding_cache_size",
+        0,
+        "SPINN only. If positive, also keep this many sentence encodings in "
+        "an LRU cache that is reused across the batches of an evaluation.")
+    gflags.DEFINE_boolean(
+        "eval_projection_table",
+        False,
+        "SPINN and CBOW only. In eval, with encode projection or pass, look up "
+        "encoded embeddings in a (vocab, model_dim) table computed once per "
+        "evaluation.")
     gflags.DEFINE_boolean(
         "eval_report_use_preds", True, "If False, use the given transitions in the report, "
         "otherwise use predicted transitions. Note that when predicting transitions but not using them, the "
@@ -630,6 +799,17 @@ def flag_defaults(FLAGS, load_log_flags=False):
     if FLAGS.model_type == "CBOW" or FLAGS.model_type == "RNN" or FLAGS.model_type == "Pyramid" or FLAGS.model_type == "ChoiPyramid":
         FLAGS.num_samples = 0
 
+    if FLAGS.hash_cons_subtrees:
+        FLAGS.level_wise_composition = True
+
+    if FLAGS.level_wise_composition:
+        FLAGS.stack_type = "thin"
+
+    # Eval reports read the predicted transitions of every example.
+    if FLAGS.write_eval_report:
+        FLAGS.dedup_eval_sentences = False
+        FLAGS.eval_encoding_cache_size = 0
+
     if not torch.cuda.is_available():
         FLAGS.gpu = -1
 
@@ -662,6 +842,7 @@ def init_model(
     context_args.reshape_input = lambda x, batch_size, seq_length: x
     context_args.reshape_context = lambda x, batch_size, seq_length: x
     context_args.input_dim = FLAGS.word_embedding_dim
+    context_args.token_wise = FLAGS.encode in ["projection", "pass"]
 
     if FLAGS.encode == "projection":
         encoder = Linear()(FLAGS.word_embedding_dim, FLAGS.model_dim)
@@ -705,13 +886,20 @@ def init_model(
 
     composition_args.detach = FLAGS.transition_detach
     composition_args.evolution = FLAGS.evolution
+    composition_args.stack_type = FLAGS.stack_type
+    composition_args.level_wise = FLAGS.level_wise_composition
+    composition_args.hash_cons = FLAGS.hash_cons_subtrees and \
+        context_args.token_wise
+    composition_args.compact_active_rows = FLAGS.compact_active_rows
+    composition_args.fused_gates = FLAGS.fused_gates
+    composition_args.profile = FLAGS.profile_spinn
 
     if FLAGS.reduce == "treelstm":
         assert FLAGS.model_dim % 2 == 0, 'model_dim must be an even number.'
         if FLAGS.model_dim != FLAGS.word_embedding_dim:
             print('If you are setting different hidden layer and word '
                   'embedding sizes, make sure you specify an encoder')
-        composition_args.wrap_items = lambda x: bundle(x)
+        composition_args.wrap_items = LSTMStateBatch.wrap
         composition_args.extract_h = lambda x: x.h
         composition_args.extract_c = lambda x: x.c
         composition_args.size = FLAGS.model_dim / 2
@@ -719,13 +907,16 @@ def init_model(
             FLAGS.model_dim / 2,
             tracker_size=FLAGS.tracking_lstm_hidden_dim,
             use_tracking_in_composition=FLAGS.use_tracking_in_composition,
-            composition_ln=FLAGS.composition_ln)
+            composition_ln=FLAGS.composition_ln,
+            fused=FLAGS.fused_gates)
     elif FLAGS.reduce == "tanh":
         class ReduceTanh(nn.Module):
             def forward(self, lefts, rights, tracking=None):
-                batch_size = len(lefts)
-                ret = torch.cat(lefts, 0) + F.tanh(torch.cat(rights, 0))
-                return torch.chunk(ret, batch_size, 0)
+                batched = isinstance(lefts, LSTMStateBatch)
+                lefts = LSTMStateBatch.wrap(lefts).both
+                rights = LSTMStateBatch.wrap(rights).both
+                ret = LSTMStateBatch(lefts + F.tanh(rights))
+                return ret if batched else ret.unbundle()
         composition = ReduceTanh()
     elif FLAGS.reduce == "treegru":
         composition = ReduceTreeGRU(FLAGS.model_dim,
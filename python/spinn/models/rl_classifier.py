@@ -10,10 +10,11 @@ import numpy as np
 
 from spinn.util import afs_safe_logger
 from spinn.util.data import SimpleProgressBar
-from spinn.util.blocks import get_l2_loss, the_gpu, to_gpu
-from spinn.util.misc import Accumulator, EvalReporter
+from spinn.util.blocks import get_l2_loss, the_gpu, to_gpu, synchronize
+from spinn.util.misc import Accumulator, EvalReporter, Profiler
 from spinn.util.misc import recursively_set_device
 from spinn.util.logging import stats, train_accumulate, create_log_formatter
+from spinn.util.logging import timing_stats
 from spinn.util.logging import train_rl_accumulate
 from spinn.util.logging import eval_stats, eval_accumulate, prettyprint_trees
 from spinn.util.loss import auxiliary_loss
@@ -59,14 +60,15 @@ def evaluate(FLAGS, model, eval_set, log_entry,
     model.eval()
     for i, dataset_batch in enumerate(dataset):
         batch = get_batch(dataset_batch)
-        eval_X_batch, eval_transitions_batch, eval_y_batch, eval_num_transitions_batch, eval_ids = batch
+        eval_X_batch, eval_transitions_batch, eval_y_batch, eval_num_transitions_batch, eval_ids, eval_plans_batch = batch
 
         # Run model.
         output = model(eval_X_batch, eval_transitions_batch, eval_y_batch,
                        use_internal_parser=FLAGS.use_internal_parser,
                        validate_transitions=FLAGS.validate_transitions,
                        store_parse_masks=show_sample,
-                       example_lengths=eval_num_transitions_batch)
+                       example_lengths=eval_num_transitions_batch,
+                       transition_plans=eval_plans_batch)
 
         can_sample = (FLAGS.model_type ==
                       "RLSPINN" and FLAGS.use_internal_parser)
@@ -172,6 +174,10 @@ def train_loop(
     # Accumulate useful statistics.
     A = Accumulator(maxlen=FLAGS.deque_length)
 
+    # Time each stage of a step. Waits for the GPU so that asynchronous work
+    # is counted in the stage that queued it.
+    timer = Profiler(enabled=True, synchronize=synchronize)
+
     # Checkpoint paths.
     standard_checkpoint_path = get_checkpoint_path(
         FLAGS.ckpt_path, FLAGS.experiment_name)
@@ -180,11 +186,11 @@ def train_loop(
 
     # Build log format strings.
     model.train()
-    X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids = get_batch(
-        training_data_iter.next())
+    X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids, plans_batch = training_data_iter.next()
     model(X_batch, transitions_batch, y_batch,
           use_internal_parser=FLAGS.use_internal_parser,
-          validate_transitions=FLAGS.validate_transitions
+          validate_transitions=FLAGS.validate_transitions,
+          transition_plans=plans_batch
           )
 
     # Train.
@@ -206,14 +212,19 @@ def train_loop(
         log_entry.step = step
         should_log = False
 
+        timer.reset()
         start = time.time()
 
-        batch = get_batch(training_data_iter.next())
-        X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids = batch
+        t = timer.start()
+        batch = training_data_iter.next()
+        timer.stop('data_wait', t)
+        X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids, plans_batch = batch
 
         total_tokens = sum(
             [(nt + 1) / 2 for nt in num_transitions_batch.reshape(-1)])
 
+        t = timer.start()
+
         # Reset cached gradients.
         optimizer.zero_grad()
 
@@ -242,7 +253,8 @@ def train_loop(
         # Run model.
         output = model(X_batch, transitions_batch, y_batch,
                        use_internal_parser=FLAGS.use_internal_parser,
-                       validate_transitions=FLAGS.validate_transitions
+                       validate_transitions=FLAGS.validate_transitions,
+                       transition_plans=plans_batch
                        )
 
         # Normalize output.
@@ -254,7 +266,7 @@ def train_loop(
         # get the index of the max log-probability
         pred = logits.data.max(1, keepdim=False)[1].cpu()
 
-        class_acc = pred.eq(target).sum() / float(target.size(0))
+        class_correct = pred.eq(target).sum()
 
         # Calculate class loss.
         xent_loss = nn.NLLLoss()(
@@ -277,6 +289,9 @@ def train_loop(
             total_loss += transition_loss
         aux_loss = auxiliary_loss(model)
         total_loss += aux_loss
+        timer.stop('forward', t)
+
+        t = timer.start()
 
         # Backward pass.
         total_loss.backward()
@@ -286,6 +301,9 @@ def train_loop(
         for p in model.parameters():
             if p.requires_grad:
                 p.grad.data.clamp_(min=-clip, max=clip)
+        timer.stop('backward', t)
+
+        t = timer.start()
 
         # Learning Rate Decay
         if FLAGS.actively_decay_learning_rate:
@@ -294,13 +312,15 @@ def train_loop(
 
         # Gradient descent step.
         optimizer.step()
+        timer.stop('optimizer', t)
 
         end = time.time()
 
         total_time = end - start
 
-        train_accumulate(model, A, batch)
-        A.add('class_acc', class_acc)
+        train_accumulate(model, A, batch, timer)
+        A.add('class_correct', class_correct)
+        A.add('class_total', target.size(0))
         A.add('total_tokens', total_tokens)
         A.add('total_time', total_time)
 
@@ -321,7 +341,8 @@ def train_loop(
             model.train()
             model(X_batch, transitions_batch, y_batch,
                   use_internal_parser=FLAGS.use_internal_parser,
-                  validate_transitions=FLAGS.validate_transitions
+                  validate_transitions=FLAGS.validate_transitions,
+                  transition_plans=plans_batch
                   )
             tr_transitions_per_example, tr_strength = model.spinn.get_transitions_per_example(
             )
@@ -329,7 +350,8 @@ def train_loop(
             model.eval()
             model(X_batch, transitions_batch, y_batch,
                   use_internal_parser=FLAGS.use_internal_parser,
-                  validate_transitions=FLAGS.validate_transitions
+                  validate_transitions=FLAGS.validate_transitions,
+                  transition_plans=plans_batch
                   )
             ev_transitions_per_example, ev_strength = model.spinn.get_transitions_per_example(
             )
@@ -364,23 +386,30 @@ def train_loop(
         if step > 0 and step % FLAGS.eval_interval_steps == 0:
             should_log = True
             for index, eval_set in enumerate(eval_iterators):
+                t = timer.start()
                 acc, _ = evaluate(
                     FLAGS, model, eval_set, log_entry, logger, step, eval_index=index)
+                timer.stop('eval', t)
                 if FLAGS.ckpt_on_best_dev_error and index == 0 and (
                         1 - acc) < 0.99 * best_dev_error and step > FLAGS.ckpt_step:
                     best_dev_error = 1 - acc
                     best_dev_step = step
                     logger.Log(
                         "Checkpointing with new best dev accuracy of %f" % acc)
+                    t = timer.start()
                     trainer.save(best_checkpoint_path, step, best_dev_error, best_dev_step)
+                    timer.stop('save', t)
             progress_bar.reset()
 
         if step > FLAGS.ckpt_step and step % FLAGS.ckpt_interval_steps == 0:
             should_log = True
             logger.Log("Checkpointing.")
+            t = timer.start()
             trainer.save(standard_checkpoint_path, step, best_dev_error, best_dev_step)
+            timer.stop('save', t)
 
         if should_log:
+            timing_stats(timer, log_entry)
             logger.LogEntry(log_entry)
 
         progress_bar.step(i=(step % FLAGS.statistics_interval_steps) + 1,
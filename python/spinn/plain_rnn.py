@@ -183,9 +183,13 @@ class RNNModel(nn.Module):
     # --- Sentence Specific ---
 
     def unwrap_sentence_pair(self, sentences, transitions):
-        x_prem = sentences[:, :, 0]
-        x_hyp = sentences[:, :, 1]
-        x = np.concatenate([x_prem, x_hyp], axis=0)
+        if sentences.ndim == 2:
+            # Already unwrapped, with the premises stacked over the hypotheses.
+            x = sentences
+        else:
+            x_prem = sentences[:, :, 0]
+            x_hyp = sentences[:, :, 1]
+            x = np.concatenate([x_prem, x_hyp], axis=0)
 
         return to_gpu(
             Variable(
@@ -14,6 +14,8 @@ from spinn.util.blocks import the_gpu, to_gpu
 from spinn.spinn_core_model import BaseModel as _BaseModel
 from spinn.spinn_core_model import SPINN
 
+from spinn.data import T_SHIFT, T_REDUCE
+
 
 TINY = 1e-8
 
@@ -57,6 +59,9 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         rl_transition_acc_as_reward=FLAGS.rl_transition_acc_as_reward,
         context_args=context_args,
         composition_args=composition_args,
+        dedup_eval_sentences=FLAGS.dedup_eval_sentences,
+        eval_encoding_cache_size=FLAGS.eval_encoding_cache_size,
+        eval_projection_table=FLAGS.eval_projection_table,
     )
 
 
@@ -66,16 +71,21 @@ class RLSPINN(SPINN):
     catalan_backprop = False
     epsilon = 1.0  # unused. kept to prevent logging from breaking.
 
-    def predict_actions(self, transition_output):
+    def predict_actions(self, transition_output, rows=None, allowed=None):
         transition_output_t = transition_output / max(self.temperature, TINY)
         transition_dist = F.softmax(transition_output_t)
 
         if self.catalan:
             # Use the catalan distribution as a prior.
+            n_reduces, n_steps = self.n_reduces.cpu().numpy(), self.n_steps.cpu().numpy()
+            n_tokens = self.n_tokens
+            if rows is not None:
+                n_reduces, n_steps = n_reduces[rows], n_steps[rows]
+                n_tokens = [n_tokens[i] for i in rows]
             p_shift_catalan = [
                 self.shift_probabilities.prob(
                     n_red, n_step, n_tok) for n_red, n_step, n_tok in zip(
-                    self.n_reduces, self.n_steps, self.n_tokens)]
+                    n_reduces, n_steps, n_tokens)]
             p_shift_catalan = torch.FloatTensor(p_shift_catalan).view(-1, 1)
             p_catalan = torch.cat([p_shift_catalan, 1. - p_shift_catalan], 1)
             p_catalan = to_gpu(Variable(p_catalan))
@@ -91,14 +101,20 @@ class RLSPINN(SPINN):
         shift_probs = transition_dist.data[:, 0]
 
         if self.training:
-            np_shift_probs = shift_probs.cpu().numpy()
-            transition_preds = (np.random.rand(
-                *np_shift_probs.shape) > np_shift_probs).astype('int32')
+            noise = shift_probs.new(shift_probs.size()).uniform_()
+            unconstrained_preds = (noise > shift_probs).long()
         else:
             # Greedy prediction
-            transition_preds = torch.round(
-                1 - shift_probs).cpu().numpy().astype('int32')
-        return transition_logdist, transition_preds
+            unconstrained_preds = torch.round(1 - shift_probs).long()
+
+        if allowed is None:
+            return transition_logdist, unconstrained_preds, unconstrained_preds
+
+        # Masking out an action sets its probability to zero. With the same
+        # noise, that only changes the examples that have one allowed action.
+        transition_preds = unconstrained_preds.masked_fill(
+            1 - allowed[:, 1], T_SHIFT).masked_fill(1 - allowed[:, 0], T_REDUCE)
+        return transition_logdist, transition_preds, unconstrained_preds
 
 
 class BaseModel(_BaseModel):
@@ -181,7 +197,7 @@ class BaseModel(_BaseModel):
 
         # HACK: This is a pretty simple way to create the inference time version of SPINN.
         # The reason a copy is necessary is because there is some retained state in the
-        # memories and loss variables that break deep copy.
+        # transition record and loss variables that break deep copy.
         inference_model = inference_model_cls(**self.kwargs)
         inference_model.load_state_dict(copy.deepcopy(self.state_dict()))
         inference_model.eval()
@@ -262,14 +278,11 @@ class BaseModel(_BaseModel):
         # TODO: Many of these ops are on the cpu. Might be worth shifting to
         # GPU.
 
-        t_preds = np.concatenate([m['t_preds']
-                                  for m in self.spinn.memories if 't_preds' in m])
-        t_mask = np.concatenate([m['t_mask']
-                                 for m in self.spinn.memories if 't_mask' in m])
-        t_valid_mask = np.concatenate(
-            [m['t_valid_mask'] for m in self.spinn.memories if 't_mask' in m])
-        t_logprobs = torch.cat(
-            [m['t_logprobs'] for m in self.spinn.memories if 't_logprobs' in m], 0)
+        record = self.spinn.record
+        t_preds = record.flat('preds')
+        t_mask = record.flat('mask')
+        t_valid_mask = record.flat('valid_mask')
+        t_logprobs = record.logprobs
 
         if self.rl_valid:
             t_mask = np.logical_and(t_mask, t_valid_mask)
@@ -327,8 +340,7 @@ class BaseModel(_BaseModel):
         # Get Reward.
         if self.rl_transition_acc_as_reward:
             ground = np.transpose(transitions)
-            pred = np.array([m['t_preds']
-                             for m in self.spinn.memories if 't_preds' in m])
+            pred = self.spinn.record.preds
             correct = (ground == pred).astype(np.float32)
             trans_acc = np.sum(correct, axis=0) / correct.shape[0]
             rewards = torch.from_numpy(trans_acc)
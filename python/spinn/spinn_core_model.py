@@ -1,19 +1,21 @@
-import itertools
 
 import numpy as np
 
 # PyTorch
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
+from torch.autograd import Function, Variable
+from torch.autograd.function import once_differentiable
 import torch.nn.functional as F
 
-from spinn.util.blocks import Embed, Linear, MLP
-from spinn.util.blocks import bundle, lstm, to_gpu, unbundle
+from spinn.util.blocks import Embed, Linear, MLP, TokenTable
+from spinn.util.blocks import LSTMStateBatch, lstm, synchronize, to_gpu
 from spinn.util.blocks import LayerNormalization
-from spinn.util.misc import Example, Vocab
-from spinn.util.blocks import HeKaimingInitializer
+from spinn.util.misc import Example, LRUCache, Profiler, Vocab
+from spinn.util.blocks import HeKaimingInitializer, DefaultUniformInitializer
+from spinn.util.blocks import FusedLinear
 from spinn.util.catalan import ShiftProbabilities
+from spinn.util.data import CompileTransitionPlans
 
 from spinn.data import T_SHIFT, T_REDUCE, T_SKIP
 
@@ -47,6 +49,9 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         composition_args=composition_args,
         detach=FLAGS.transition_detach,
         evolution=FLAGS.evolution,
+        dedup_eval_sentences=FLAGS.dedup_eval_sentences,
+        eval_encoding_cache_size=FLAGS.eval_encoding_cache_size,
+        eval_projection_table=FLAGS.eval_projection_table,
     )
 
 
@@ -59,7 +64,8 @@ class Tracker(nn.Module):
             size,
             tracker_size,
             lateral_tracking=True,
-            tracking_ln=True):
+            tracking_ln=True,
+            fused=False):
         '''Args:
             size: input size (parser hidden state) = FLAGS.model_dim
             tracker_size: FLAGS.tracking_lstm_hidden_dim
@@ -67,7 +73,14 @@ class Tracker(nn.Module):
         super(Tracker, self).__init__()
 
         # Initialize layers.
-        if lateral_tracking:
+        fused = fused and lateral_tracking
+        if fused:
+            self.gates = FusedLinear(
+                [size, size, size, tracker_size], 4 * tracker_size,
+                initializer=[DefaultUniformInitializer] * 3 +
+                [HeKaimingInitializer])
+            self.state_size = tracker_size
+        elif lateral_tracking:
             self.buf = Linear()(size, 4 * tracker_size, bias=True)
             self.stack1 = Linear()(size, 4 * tracker_size, bias=False)
             self.stack2 = Linear()(size, 4 * tracker_size, bias=False)
@@ -84,49 +97,440 @@ class Tracker(nn.Module):
 
         self.lateral_tracking = lateral_tracking
         self.tracking_ln = tracking_ln
+        self.fused = fused
 
         self.reset_state()
 
     def reset_state(self):
         self.c = self.h = None
 
-    def forward(self, top_buf, top_stack_1, top_stack_2):
+    def repack_state_dict(self, state_dict, prefix):
+        if not self.fused:
+            return False
+        return FusedLinear.pack_state_dict(
+            state_dict, prefix, ['buf', 'stack1', 'stack2', 'lateral'], 'gates')
+
+    def forward(self, top_buf, top_stack_1, top_stack_2, rows=None):
+        '''If rows is given, only those rows of the inputs are used and only
+        their state is updated. The outputs have one row per entry in rows.'''
+        batch_size = top_buf.size(0)
+        if rows is not None:
+            top_buf = top_buf.index_select(0, rows)
+            top_stack_1 = top_stack_1.index_select(0, rows)
+            top_stack_2 = top_stack_2.index_select(0, rows)
+
         if self.tracking_ln:
             top_buf = self.buf_ln(top_buf)
             top_stack_1 = self.stack1_ln(top_stack_1)
             top_stack_2 = self.stack2_ln(top_stack_2)
 
         if self.lateral_tracking:
-            tracker_inp = self.buf(top_buf)
-            tracker_inp += self.stack1(top_stack_1)
-            tracker_inp += self.stack2(top_stack_2)
-
-            batch_size = tracker_inp.size(0)
-
-            if self.h is not None:
-                tracker_inp += self.lateral(self.h)
             if self.c is None:
                 self.c = to_gpu(Variable(torch.from_numpy(
                     np.zeros((batch_size, self.state_size),
                              dtype=np.float32)),
-                    volatile=tracker_inp.volatile))
+                    volatile=top_buf.volatile))
+
+            if rows is None:
+                c, h = self.c, self.h
+            else:
+                c = self.c.index_select(0, rows)
+                h = None if self.h is None else self.h.index_select(0, rows)
+
+            if self.fused:
+                # The initial state is all zeros, so it can stand in for a
+                # missing lateral input.
+                tracker_inp = self.gates(
+                    top_buf, top_stack_1, top_stack_2, c if h is None else h)
+            else:
+                tracker_inp = self.buf(top_buf)
+                tracker_inp += self.stack1(top_stack_1)
+                tracker_inp += self.stack2(top_stack_2)
+                if h is not None:
+                    tracker_inp += self.lateral(h)
 
             # Run tracking lstm.
-            self.c, self.h = lstm(self.c, tracker_inp)
+            c, h = lstm(c, tracker_inp)
 
-            return self.h, self.c
+            if rows is None:
+                self.c, self.h = c, h
+            else:
+                # Rows that were not stepped keep their previous state, which
+                # is all zeros before their first step.
+                if self.h is None:
+                    self.h = self.c
+                self.c = self.c.index_copy(0, rows, c)
+                self.h = self.h.index_copy(0, rows, h)
+
+            return h, c
         else:
             return torch.cat([top_buf, top_stack_1, top_stack_2], 1), None
 
     @property
     def states(self):
-        return unbundle((self.c, self.h))
+        return LSTMStateBatch((self.c, self.h))
 
     @states.setter
-    def states(self, state_iter):
-        if state_iter is not None:
-            state = bundle(state_iter)
-            self.c, self.h = state.c, state.h
+    def states(self, states):
+        states = LSTMStateBatch.wrap(states)
+        if states is not None:
+            self.c, self.h = states.c, states.h
+
+
+# The thin stack keeps every buffer and stack item in one preallocated memory
+# tensor. Reads and writes to that memory go through the autograd functions
+# below, which accumulate gradients into a single buffer of the same size as
+# the memory rather than letting autograd materialize a full-size gradient for
+# every read and write. Each function consumes and/or produces a one-element
+# "token" that orders the operations: a write is only differentiated after all
+# the operations that come after it, so all reads of the slots it wrote have
+# already added their gradients to the buffer.
+
+class ThinStackLoad(Function):
+
+    @staticmethod
+    def forward(ctx, embeds, stack):
+        ctx.stack = stack
+        stack.memory.narrow(0, 1, stack.buf_size).copy_(embeds)
+        return embeds.new(1).zero_()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_token):
+        stack = ctx.stack
+        return stack.grad_memory().narrow(0, 1, stack.buf_size).clone(), None
+
+
+class ThinStackRead(Function):
+
+    @staticmethod
+    def forward(ctx, token, stack, slots):
+        ctx.stack, ctx.slots = stack, slots
+        return stack.memory.index_select(0, slots)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        ctx.stack.grad_memory().index_add_(0, ctx.slots, grad_output)
+        return grad_output.new(1).zero_(), None, None
+
+
+class ThinStackWrite(Function):
+
+    @staticmethod
+    def forward(ctx, token, values, stack, slots):
+        ctx.stack, ctx.slots = stack, slots
+        stack.memory.index_copy_(0, slots, values)
+        return token.new(1).zero_()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_token):
+        grad_values = ctx.stack.grad_memory().index_select(0, ctx.slots)
+        return grad_token, grad_values, None, None
+
+
+class ThinStack(object):
+    '''Tensor-backed buffers and stacks for a batch of examples.
+
+    Memory layout: slot 0 is a zero vector (standing in for the zeros that pad
+    the list-based buffers and stacks), followed by the ``B * L`` buffer
+    embeddings, followed by ``T`` slots per example for the results of REDUCE.
+    Each buffer is a cursor into its example's embeddings, and each stack is a
+    row of back-pointers into the memory. SHIFT only moves pointers, and
+    REDUCE writes the composed item into the next free slot of its example.
+
+    Bookkeeping is kept in LongTensors on the same device as the memory. When
+    the transitions are known ahead of time, the plans computed by
+    :func:`~spinn.util.data.CompileTransitionPlans` are expanded into per-step
+    index arrays instead, and the stacks are replayed without bookkeeping.'''
+
+    def __init__(self, embeds, n_tokens, transitions, plans=None):
+        batch_size, seq_length, size = embeds.size()
+        num_transitions = transitions.shape[1]
+
+        self.batch_size = batch_size
+        self.buf_size = batch_size * seq_length
+        self.width = num_transitions + 2
+
+        self.memory = embeds.data.new(
+            1 + self.buf_size + batch_size * num_transitions, size).zero_()
+        self._grad_memory = None
+        self.token = ThinStackLoad.apply(
+            embeds.contiguous().view(self.buf_size, size), self)
+
+        self.replay = plans is not None
+        if self.replay:
+            self.load_plan(transitions, plans, n_tokens)
+            return
+
+        rows = to_gpu(torch.arange(0, batch_size).long())
+        self.buf_base = 1 + rows * seq_length
+        self.write_base = 1 + self.buf_size + rows * num_transitions
+        self.n_tokens = to_gpu(torch.LongTensor(n_tokens))
+        self.buf_cursor = rows.new(batch_size).zero_()
+        self.n_written = rows.new(batch_size).zero_()
+
+        # Every stack starts with two zeros, like the list-based stacks.
+        self.stack_ptrs = rows.new(batch_size, self.width).zero_()
+        self.stack_lens = rows.new(batch_size).fill_(2)
+
+    def load_plan(self, transitions, plans, n_tokens):
+        batch_size, num_transitions = transitions.shape
+        seq_length = self.buf_size // batch_size
+        rows = np.arange(batch_size)[:, np.newaxis]
+        buf_base = 1 + rows * seq_length
+        write_base = 1 + self.buf_size + rows * num_transitions
+
+        def to_slots(local):
+            local = local.astype(np.int64)
+            return np.where(local > 0, buf_base + local - 1,
+                            np.where(local < 0, write_base - local - 1, 0))
+
+        self.is_shift = transitions == T_SHIFT
+        self.is_reduce = transitions == T_REDUCE
+        self.cursor = np.cumsum(self.is_shift, axis=1) - self.is_shift
+        self.n_tokens = np.array(n_tokens)[:, np.newaxis]
+        buf_top = np.where(self.cursor < self.n_tokens,
+                           buf_base + self.cursor, 0)
+        top1, top2 = to_slots(plans[:, :, 0]), to_slots(plans[:, :, 1])
+        written = write_base + \
+            np.cumsum(self.is_reduce, axis=1) - self.is_reduce
+
+        # Inputs to the tracker, one row per step.
+        self.plan_tops = to_gpu(torch.from_numpy(np.concatenate(
+            [buf_top.T, top1.T, top2.T], 1).astype(np.int64)))
+
+        # Rows that REDUCE, their children and the slots they write to,
+        # grouped by step.
+        steps, reduce_rows = np.nonzero(self.is_reduce.T)
+        self.plan_offsets = np.searchsorted(
+            steps, np.arange(num_transitions + 1))
+
+        self.plan_reduce_np = np.stack([
+            reduce_rows,
+            top2[reduce_rows, steps],
+            top1[reduce_rows, steps],
+            written[reduce_rows, steps]]).astype(np.int64)
+        self.plan_reduce = to_gpu(torch.from_numpy(self.plan_reduce_np))
+
+        final = transitions[:, -1]
+        self.plan_root_np = np.where(
+            final == T_REDUCE, written[:, -1],
+            np.where(final == T_SHIFT, buf_top[:, -1], top1[:, -1])).astype(np.int64)
+        self.plan_root = to_gpu(torch.from_numpy(self.plan_root_np))
+        self.plan_stack_lens = None
+
+    def planned_reduce(self, t_step):
+        start, end = self.plan_offsets[t_step], self.plan_offsets[t_step + 1]
+        if start == end:
+            return None
+        rows, left, right, slots = self.plan_reduce[:, start:end]
+        return rows, left, right, slots
+
+    def plan_levels(self, leaf_keys=None):
+        '''Group the planned REDUCEs by the height of the node they create,
+        so that all nodes of a level can be composed together.
+
+        If ``leaf_keys`` gives a key for each buffer slot, such that slots with
+        equal keys hold equal embeddings, equal subtrees are composed only
+        once. See :meth:`hash_cons`.'''
+        rows, left, right, written = self.plan_reduce_np
+        self.n_nodes = self.n_composed = len(written)
+        if len(written) == 0:
+            return []
+
+        # Nodes are planned in the order they are created, so the heights of
+        # their children are always known.
+        heights = np.zeros(self.memory.size(0), dtype=np.int64)
+        for start, end in zip(self.plan_offsets[:-1], self.plan_offsets[1:]):
+            if start < end:
+                heights[written[start:end]] = 1 + np.maximum(
+                    heights[left[start:end]], heights[right[start:end]])
+
+        node_heights = heights[written]
+        order = np.argsort(node_heights, kind='mergesort')
+        bounds = np.searchsorted(
+            node_heights[order], np.arange(1, node_heights.max() + 2))
+        plan = self.plan_reduce_np[:, order]
+        if leaf_keys is not None:
+            plan, bounds = self.hash_cons(plan, bounds, leaf_keys)
+        levels = to_gpu(torch.from_numpy(np.ascontiguousarray(plan)))
+        return [levels[:, start:end]
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def hash_cons(self, plan, bounds, leaf_keys):
+        '''Merge equal subtrees of the batch into a DAG. A leaf is identified
+        by its key and a node by the identities of its children, and each is
+        represented by the first slot that holds it. Equal subtrees have equal
+        heights, so one level at a time is enough to find every repeat. Only
+        the representatives are composed, their parents read them in place of
+        the repeats, and so do the roots.'''
+        canon = np.arange(self.memory.size(0))
+        _, first, inverse = np.unique(
+            leaf_keys, return_index=True, return_inverse=True)
+        canon[1:1 + self.buf_size] = 1 + first[inverse]
+
+        keep = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            _, left, right, written = plan[:, start:end]
+            keys = canon[left] * canon.size + canon[right]
+            _, first, inverse = np.unique(
+                keys, return_index=True, return_inverse=True)
+            canon[written] = written[first[inverse]]
+            keep.append(np.sort(first))
+
+        plan = plan.copy()
+        plan[1:3] = canon[plan[1:3]]
+        plan = plan[:, np.concatenate(
+            [start + k for start, k in zip(bounds[:-1], keep)])]
+        bounds = np.concatenate([[0], np.cumsum([len(k) for k in keep])])
+        self.n_composed = plan.shape[1]
+        self.plan_root = to_gpu(torch.from_numpy(canon[self.plan_root_np]))
+        return plan, bounds
+
+    def grad_memory(self):
+        if self._grad_memory is None:
+            self._grad_memory = self.memory.new(self.memory.size()).zero_()
+        return self._grad_memory
+
+    def read(self, slots):
+        return ThinStackRead.apply(self.token, self, slots)
+
+    def write(self, rows, values, slots=None):
+        if slots is not None:
+            self.token = ThinStackWrite.apply(self.token, values, self, slots)
+            return
+        slots = self.write_base.index_select(0, rows) + \
+            self.n_written.index_select(0, rows)
+        self.n_written.index_add_(0, rows, self.ones(rows))
+        self.token = ThinStackWrite.apply(self.token, values, self, slots)
+        self.push(rows, slots)
+
+    def ones(self, rows):
+        return rows.new(rows.size(0)).fill_(1)
+
+    def buffer_top(self, rows=None):
+        cursor = self.buf_cursor
+        slots = self.buf_base + cursor
+        valid = (cursor < self.n_tokens).long()
+        slots = slots * valid
+        return slots if rows is None else slots.index_select(0, rows)
+
+    def stack_top(self, depth, rows=None):
+        lens, ptrs = self.stack_lens, self.stack_ptrs
+        if rows is not None:
+            lens, ptrs = lens.index_select(0, rows), ptrs.index_select(0, rows)
+        pos = lens - depth
+        slots = ptrs.gather(1, pos.clamp(min=0).unsqueeze(1)).squeeze(1)
+        return slots * (pos >= 0).long()
+
+    def push(self, rows, slots):
+        lens = self.stack_lens.index_select(0, rows)
+        self.stack_ptrs.view(-1).index_copy_(0, rows * self.width + lens, slots)
+        self.stack_lens.index_add_(0, rows, self.ones(rows))
+
+    def pop(self, rows):
+        # Popping an empty stack yields zeros.
+        slots = self.stack_top(1, rows)
+        lens = self.stack_lens.index_select(0, rows)
+        self.stack_lens.index_copy_(0, rows, (lens - 1).clamp(min=0))
+        return slots
+
+    def shift(self, rows):
+        slots = self.buffer_top(rows)
+        self.buf_cursor.index_add_(0, rows, self.ones(rows))
+        self.push(rows, slots)
+
+    def reduce(self, rows):
+        # The right-most input will be popped first.
+        right = self.pop(rows)
+        left = self.pop(rows)
+        return left, right
+
+    def tops(self, t_step):
+        if self.replay:
+            slots = self.plan_tops[t_step]
+        else:
+            slots = torch.cat(
+                [self.buffer_top(), self.stack_top(1), self.stack_top(2)], 0)
+        return torch.chunk(self.read(slots), 3, 0)
+
+    def roots(self):
+        if self.replay:
+            return self.read(self.plan_root)
+        return self.read(self.stack_top(1))
+
+    def lengths(self, t_step):
+        '''Lengths of the stacks and buffers before the given step, not
+        counting the zero padding, as LongTensors.'''
+        if self.replay:
+            if self.plan_stack_lens is None:
+                stack_lens = np.zeros(self.is_shift.shape, dtype=np.int64)
+                lens = 2
+                for t in range(self.is_shift.shape[1]):
+                    stack_lens[:, t] = lens - 2
+                    lens = np.where(self.is_reduce[:, t], np.maximum(lens - 2, 0), lens) + \
+                        np.logical_or(self.is_shift[:, t], self.is_reduce[:, t])
+                buf_lens = self.n_tokens - self.cursor
+                self.plan_stack_lens = to_gpu(torch.from_numpy(
+                    np.ascontiguousarray(stack_lens.T)))
+                self.plan_buf_lens = to_gpu(torch.from_numpy(
+                    np.ascontiguousarray(buf_lens.T.astype(np.int64))))
+            return self.plan_stack_lens[t_step], self.plan_buf_lens[t_step]
+        return self.stack_lens - 2, self.n_tokens - self.buf_cursor
+
+
+class TransitionRecord(object):
+    '''Transition predictions made during one forward pass of SPINN.
+
+    The arrays are (T, B) and are preallocated and filled in place by
+    SPINN.run, one step at a time. Steps where nothing was predicted (every
+    example skips) read as SKIP with an all-zero log distribution. Flattened
+    accessors return step-major (T * B,) views, which is the layout of
+    logprobs.'''
+
+    def __init__(self, num_transitions, batch_size):
+        '''Predictions and valid masks are added as tensors and only copied
+        into the arrays when the record is finished.'''
+        shape = (num_transitions, batch_size)
+        self.num_transitions = num_transitions
+        self.batch_size = batch_size
+        self.preds = np.full(shape, T_SKIP, dtype=np.int32)
+        self.given = np.full(shape, T_SKIP, dtype=np.int32)
+        self.mask = np.zeros(shape, dtype=np.bool)
+        self.valid_mask = np.ones(shape, dtype=np.bool)
+        self.steps = np.zeros(num_transitions, dtype=np.bool)
+        self.logprobs = None
+        self._preds, self._valid_mask, self._logprobs = [], [], []
+
+    def add(self, t_step, preds, given, mask, valid_mask, logprobs):
+        self.given[t_step] = given
+        self.mask[t_step] = mask
+        self.steps[t_step] = True
+        self._preds.append(preds)
+        self._valid_mask.append(valid_mask)
+        self._logprobs.append(logprobs)
+
+    def finish(self):
+        '''Copy the predictions to the host, and gather the per-step log
+        distributions into one (T * B, 2) tensor. This is a single
+        concatenation, rather than a copy into a preallocated tensor, so that
+        backward does not copy the whole tensor once per step.'''
+        if len(self._logprobs) == 0:
+            return
+        self.preds[self.steps] = torch.stack(self._preds).cpu().numpy()
+        self.valid_mask[self.steps] = torch.stack(
+            self._valid_mask).cpu().numpy()
+
+        logprobs = iter(self._logprobs)
+        zeros = self._logprobs[0].new(self._logprobs[0].size()).zero_()
+        self.logprobs = torch.cat(
+            [next(logprobs) if recorded else zeros for recorded in self.steps], 0)
+        self._preds = self._valid_mask = self._logprobs = None
+
+    def flat(self, name):
+        return getattr(self, name).ravel()
 
 
 class SPINN(nn.Module):
@@ -138,6 +542,14 @@ class SPINN(nn.Module):
         self.debug = False
         self.detach = args.detach
         self.evolution = args.evolution
+        self.stack_type = args.stack_type
+        self.level_wise = args.level_wise
+        self.hash_cons = args.hash_cons
+        self.subtree_stats = None
+        self.compact_active_rows = args.compact_active_rows
+
+        # Optional per-phase timers, reset on every run.
+        self.profiler = Profiler(enabled=args.profile, synchronize=synchronize)
 
         self.transition_weight = args.transition_weight
 
@@ -151,7 +563,8 @@ class SPINN(nn.Module):
                 args.size,
                 args.tracker_size,
                 lateral_tracking=args.lateral_tracking,
-                tracking_ln=args.tracking_ln)
+                tracking_ln=args.tracking_ln,
+                fused=args.fused_gates)
             if args.transition_weight is not None:
                 # TODO: Might be interesting to try a different network here.
                 self.predict_use_cell = predict_use_cell
@@ -167,7 +580,7 @@ class SPINN(nn.Module):
         self.shift_probabilities = ShiftProbabilities()
 
     def reset_state(self):
-        self.memories = []
+        self.record = None
 
     def forward(
             self,
@@ -183,34 +596,57 @@ class SPINN(nn.Module):
             assert all(buf_n <= (seq_length + 1) // 2 for buf_n in self.n_tokens), \
                 "All sentences (including cropped) must be the appropriate length."
 
-        self.bufs = example.bufs
-
-        # Notes on adding zeros to bufs/stacks.
-        # - After the buffer is consumed, we need one zero on the buffer
-        #   used as input to the tracker.
-        # - For the first two steps, the stack would be empty, but we add
-        #   zeros so that the tracker still gets input.
-        zeros = self.zeros = to_gpu(Variable(torch.from_numpy(
-            np.zeros(self.bufs[0][0].size(), dtype=np.float32)),
-            volatile=self.bufs[0][0].volatile))
-
-        # Initialize Buffers. Trim unused tokens.
-        self.bufs = [[zeros] + b[-b_n:]
-                     for b, b_n in zip(self.bufs, self.n_tokens)]
+        if not hasattr(example, 'transitions'):
+            # TODO: Support no transitions. In the meantime, must at least pass
+            # dummy transitions.
+            raise ValueError('Transitions must be included.')
 
-        # Initialize Stacks.
-        self.stacks = [[zeros, zeros] for buf in self.bufs]
+        if self.stack_type == "thin":
+            # Gold transitions can be replayed from precompiled plans.
+            plans = None if use_internal_parser else getattr(
+                example, 'plans', None)
+            if plans is None and not use_internal_parser and self.use_level_wise():
+                plans = CompileTransitionPlans(
+                    example.transitions, np.array(self.n_tokens))
+
+            # Leaves with the same token hold the same embedding, so long as
+            # the encoder sees no context and dropout is off.
+            self.leaf_keys = None
+            if self.hash_cons and not self.training:
+                self.leaf_keys = example.tokens.data.cpu().numpy().ravel()
+            self.thin_stack = ThinStack(
+                example.embeds, self.n_tokens, example.transitions,
+                plans=plans)
+        else:
+            embeds = example.embeds
+            batch_size, seq_length, size = embeds.size()
+
+            # Notes on adding zeros to bufs/stacks.
+            # - After the buffer is consumed, we need one zero on the buffer
+            #   used as input to the tracker.
+            # - For the first two steps, the stack would be empty, but we add
+            #   zeros so that the tracker still gets input.
+            zeros = self.zeros = Variable(
+                embeds.data.new(1, size).zero_(), volatile=embeds.volatile)
+
+            # Initialize Buffers. Each buffer is a cursor over the first
+            # n_tokens embeddings of its example, and row 0 of buf_memory is
+            # the zero read from a consumed buffer.
+            self.buf_memory = torch.cat(
+                [zeros, embeds.contiguous().view(-1, size)], 0)
+            self.buf_base = 1 + np.arange(batch_size) * seq_length
+            self.buf_n = np.array(self.n_tokens)
+            self.buf_cursor = np.zeros(batch_size, dtype=np.int64)
+
+            # Initialize Stacks.
+            self.stacks = [[zeros, zeros] for _ in range(batch_size)]
 
         # Initialize other.
-        self.n_reduces = np.zeros(len(self.bufs), dtype=np.int32)
-        self.n_steps = np.zeros(len(self.bufs), dtype=np.int32)
+        self.n_reduces = to_gpu(torch.zeros(len(self.n_tokens)).long())
+        self.n_steps = to_gpu(torch.zeros(len(self.n_tokens)).long())
 
         if hasattr(self, 'tracker'):
             self.tracker.reset_state()
-        if not hasattr(example, 'transitions'):
-            # TODO: Support no transitions. In the meantime, must at least pass
-            # dummy transitions.
-            raise ValueError('Transitions must be included.')
         return self.run(example.transitions,
                         run_internal_parser=True,
                         use_internal_parser=use_internal_parser,
@@ -222,13 +658,6 @@ class SPINN(nn.Module):
         buf_adjust = 1 if zero_padded else 0
         stack_adjust = 2 if zero_padded else 0
 
-        _transitions = np.array(transitions)
-        _preds = preds.copy()
-        _invalid = np.zeros(preds.shape, dtype=np.bool)
-
-        cant_skip = _transitions != T_SKIP
-        must_skip = _transitions == T_SKIP
-
         # Fixup predicted skips.
         if len(self.choices) > 2:
             raise NotImplementedError(
@@ -237,6 +666,16 @@ class SPINN(nn.Module):
         buf_lens = [len(buf) - buf_adjust for buf in bufs]
         stack_lens = [len(stack) - stack_adjust for stack in stacks]
 
+        return self.validate_lengths(transitions, preds, stack_lens, buf_lens)
+
+    def validate_lengths(self, transitions, preds, stack_lens, buf_lens):
+        _transitions = np.array(transitions)
+        _preds = preds.copy()
+        _invalid = np.zeros(preds.shape, dtype=np.bool)
+
+        cant_skip = _transitions != T_SKIP
+        must_skip = _transitions == T_SKIP
+
         # Cannot reduce on too small a stack
         must_shift = np.array([length < 2 for length in stack_lens])
         check_mask = np.logical_and(cant_skip, must_shift)
@@ -254,47 +693,94 @@ class SPINN(nn.Module):
 
         return _preds, _invalid
 
-    def predict_actions(self, transition_output):
+    def action_constraints(self, t_step):
+        '''ByteTensors marking the examples that must SHIFT because their
+        stack is too small to REDUCE, and those that must REDUCE because their
+        buffer is empty, before the given step.'''
+        if self.stack_type == "thin":
+            stack_lens, buf_lens = self.thin_stack.lengths(t_step)
+        else:
+            stack_lens = to_gpu(torch.LongTensor(
+                [len(stack) - 2 for stack in self.stacks]))
+            buf_lens = to_gpu(torch.from_numpy(self.buffer_lengths()))
+        return stack_lens < 2, buf_lens < 1
+
+    def allowed_actions(self, must_shift, must_reduce):
+        '''A (B, 2) ByteTensor of the actions each example may take. When an
+        example can neither SHIFT nor REDUCE, it must REDUCE.'''
+        return torch.stack([1 - must_reduce, (1 - must_shift) | must_reduce], 1)
+
+    def invalid_actions(self, transitions, preds, must_shift, must_reduce):
+        cant_skip = transitions != T_SKIP
+        return cant_skip & ((must_shift & (preds != T_SHIFT)) |
+                            (must_reduce & (preds != T_REDUCE)))
+
+    def predict_actions(self, transition_output, rows=None, allowed=None):
+        '''Returns the log distribution over actions, the predicted actions
+        restricted to the allowed ones, and the actions that would have been
+        predicted without the restriction. Predictions stay on the device.'''
         transition_logdist = F.log_softmax(transition_output)
-        transition_preds = transition_logdist.data.cpu().numpy().argmax(axis=1)
-        return transition_logdist, transition_preds
+        scores = transition_logdist.data
+        unconstrained_preds = scores.max(1)[1]
+        if allowed is None:
+            return transition_logdist, unconstrained_preds, unconstrained_preds
+        transition_preds = scores.masked_fill(
+            1 - allowed, -float('inf')).max(1)[1]
+        return transition_logdist, transition_preds, unconstrained_preds
 
     def get_transitions_per_example(self, style="preds"):
+        record = self.record
         if style == "preds":
-            source = "t_preds"
+            transitions = record.preds.T
         elif style == "given":
-            source = "t_given"
+            transitions = record.given.T
         else:
             raise NotImplementedError
 
-        t_preds = np.concatenate([m['t_preds']
-                                  for m in self.memories if 't_preds' in m])
-        t_preds = torch.from_numpy(t_preds).long()
-        t_logprobs = torch.cat(
-            [m['t_logprobs'] for m in self.memories if 't_logprobs' in m], 0).data.cpu()
+        t_preds = torch.from_numpy(record.flat('preds')).long()
+        t_logprobs = record.logprobs.data.cpu()
         t_logprobs = torch.cat(
             [t_logprobs, torch.zeros(t_logprobs.size(0), 1)], 1)
         t_strength = torch.gather(t_logprobs, 1, t_preds.view(-1, 1))
 
-        _transitions = [m[source].reshape(
-            1, -1) for m in self.memories if m.get(source, None) is not None]
-        transitions = np.concatenate(_transitions).T
-
         t_strength = torch.exp(t_strength.view(
             *list(reversed(transitions.shape))).t())
 
-        skip_mask = (torch.from_numpy(transitions) == T_SKIP).byte()
+        skip_mask = (torch.from_numpy(
+            np.ascontiguousarray(transitions)) == T_SKIP).byte()
         t_strength[skip_mask] = 0.
 
         return transitions, t_strength
 
-    def t_shift(self, buf, stack, tracking, buf_tops, trackings):
-        """SHIFT: Should dequeue buffer and item to stack."""
-        buf_tops.append(buf.pop() if len(buf) > 0 else self.zeros)
-        trackings.append(tracking)
-
-    def t_reduce(self, buf, stack, tracking, lefts, rights, trackings):
-        """REDUCE: Should compose top two items of the stack into new item."""
+    def buffer_top(self, rows=None):
+        cursor, base, n = self.buf_cursor, self.buf_base, self.buf_n
+        if rows is not None:
+            cursor, base, n = cursor[rows], base[rows], n[rows]
+        slots = np.where(cursor < n, base + cursor, 0)
+        return self.buf_memory.index_select(
+            0, to_gpu(Variable(torch.from_numpy(slots))))
+
+    def buffer_lengths(self):
+        # Not counting the zero padding.
+        return self.buf_n - self.buf_cursor
+
+    def shift_buffers(self, rows):
+        """Dequeue the top of the buffers of the given examples."""
+        if len(rows) == 0:
+            return []
+        rows = np.array(rows)
+        tops = self.buffer_top(rows)
+        self.buf_cursor[rows] += 1
+        return torch.chunk(tops, len(rows), 0)
+
+    def t_shift(self, stack):
+        """SHIFT: Should dequeue buffer and item to stack. The buffers of all
+        shifting examples are read together by shift_buffers."""
+
+    def t_reduce(self, stack, lefts, rights):
+        """REDUCE: Should compose top two items of the stack into new item.
+        The tracking states of all reducing examples are gathered together by
+        tracking_states."""
 
         # The right-most input will be popped first.
         for reduce_inp in [rights, lefts]:
@@ -309,12 +795,18 @@ class SPINN(nn.Module):
                 # NOTE: Only happens on cropped data.
                 reduce_inp.append(self.zeros)
 
-        trackings.append(tracking)
-
     def t_skip(self):
         """SKIP: Acts as padding and is a noop."""
 
-    def shift_phase(self, tops, trackings, stacks):
+    def tracking_states(self, rows):
+        """The tracker states of the given examples as an LSTMStateBatch, or
+        None if there are none yet. The rows are a LongTensor on the same
+        device as the tracker."""
+        if not hasattr(self, 'tracker') or self.tracker.h is None:
+            return None
+        return self.tracker.states.select(Variable(rows))
+
+    def shift_phase(self, tops, stacks):
         """SHIFT: Should dequeue buffer and item to stack."""
         if len(stacks) > 0:
             shift_candidates = iter(tops)
@@ -330,6 +822,58 @@ class SPINN(nn.Module):
                 new_stack_item = next(reduced)
                 stack.append(new_stack_item)
 
+    def use_level_wise(self):
+        # Without a tracker, the only dependencies between REDUCEs are the
+        # ones given by the tree.
+        return self.level_wise and not hasattr(self, 'tracker')
+
+    def thin_action_phase(self, t_step, transitions):
+        """SHIFT and REDUCE on the thin stack, batched over examples. The
+        transitions are a LongTensor on the same device as the stack."""
+        stack = self.thin_stack
+
+        if stack.replay:
+            planned = stack.planned_reduce(t_step)
+            if planned is None:
+                return
+            rows, left_slots, right_slots, write_slots = planned
+        else:
+            shift_rows = (transitions == T_SHIFT).nonzero()
+            if shift_rows.numel() > 0:
+                t = self.profiler.start()
+                stack.shift(shift_rows.view(-1))
+                self.profiler.stop('shift_phase', t)
+                self.profiler.count('shift_calls')
+                self.profiler.count('shift_rows', shift_rows.numel())
+
+            reduce_rows = (transitions == T_REDUCE).nonzero()
+            if reduce_rows.numel() == 0:
+                return
+            rows = reduce_rows.view(-1)
+            left_slots, right_slots = stack.reduce(rows)
+            write_slots = None
+
+        self.thin_reduce(rows, left_slots, right_slots, write_slots)
+
+    def thin_reduce(self, rows, left_slots, right_slots, write_slots=None):
+        t = self.profiler.start()
+        stack = self.thin_stack
+        n = rows.size(0)
+        inputs = LSTMStateBatch(stack.read(
+            torch.cat([left_slots, right_slots], 0)))
+        positions = Variable(torch.arange(0, 2 * n, out=rows.new()))
+        lefts = inputs.select(positions[:n])
+        rights = inputs.select(positions[n:])
+        trackings = self.tracking_states(rows)
+
+        reduced = self.reduce(lefts, rights, trackings)
+        stack.write(rows, reduced.both, write_slots)
+        self.profiler.stop('reduce_phase', t)
+        self.profiler.count('reduce_calls')
+        self.profiler.count('reduce_rows', n)
+
+        self.reduce_phase_hook(lefts, rights, trackings, rows)
+
     def reduce_phase_hook(self, lefts, rights, trackings, reduce_stacks):
         pass
 
@@ -343,64 +887,121 @@ class SPINN(nn.Module):
         return [(k, v) for k, v in zip(self.transition_net.state_dict(
         ).keys(), self.transition_net.state_dict().values())]
 
+    def run_level_wise(self, inp_transitions):
+        '''Compose the nodes of every tree in the batch one level at a time,
+        rather than one transition at a time. The number of sequential steps
+        is the height of the tallest tree.
+
+        This gives the same encodings as the transition loop only if the
+        composition function treats every row independently. LayerNormalization
+        normalizes over the whole group of nodes being composed, so it does not.
+
+        With hash-consing, subtrees that repeat within the batch are composed
+        once, and ``subtree_stats`` counts the nodes before and after.'''
+        stack = self.thin_stack
+        for rows, left_slots, right_slots, write_slots in stack.plan_levels(
+                self.leaf_keys):
+            self.thin_reduce(rows, left_slots, right_slots, write_slots)
+        if self.leaf_keys is not None:
+            self.subtree_stats = dict(
+                nodes=stack.n_nodes, composed=stack.n_composed)
+
+        self.n_reduces = to_gpu(torch.from_numpy(
+            (inp_transitions == T_REDUCE).sum(1).astype(np.int64)))
+        self.n_steps = to_gpu(torch.from_numpy(
+            (inp_transitions != T_SKIP).sum(1).astype(np.int64)))
+
+        t = self.profiler.start()
+        self.loss_phase_hook()
+        self.profiler.stop('loss_phase', t)
+
+        outputs = torch.chunk(stack.roots(), stack.batch_size, 0)
+        return list(outputs), 0.0, None
+
     def run(self, inp_transitions, run_internal_parser=False,
             use_internal_parser=False, validate_transitions=True):
+        # Fraction of (step, example) pairs that are not SKIP. This is the
+        # share of the tracker work done when compacting to active rows.
+        self.active_fraction = (inp_transitions != T_SKIP).mean()
+        self.subtree_stats = None
+        self.profiler.reset()
+
+        if self.stack_type == "thin" and self.thin_stack.replay and self.use_level_wise():
+            return self.run_level_wise(inp_transitions)
+
         transition_loss = None
         transition_acc = 0.0
         num_transitions = inp_transitions.shape[1]
         batch_size = inp_transitions.shape[0]
-        invalid_count = np.zeros(batch_size)
+        inp_transitions_t = to_gpu(torch.from_numpy(
+            inp_transitions.astype(np.int64)))
+        invalid_count = inp_transitions_t.new(batch_size).zero_()
+
+        if hasattr(self, 'transition_net') and run_internal_parser:
+            self.record = TransitionRecord(num_transitions, batch_size)
 
         # Transition Loop
         # ===============
 
         for t_step in range(num_transitions):
             transitions = inp_transitions[:, t_step]
+            transitions_t = inp_transitions_t[:, t_step]
             transition_arr = list(transitions)
 
             # A mask based on SKIP transitions.
             cant_skip = np.array(transitions) != T_SKIP
-            must_skip = np.array(transitions) == T_SKIP
-
-            # Memories
-            # ========
-            # Keep track of key values to determine accuracy and loss.
-            self.memory = {}
 
             # Prepare tracker input.
-            if self.debug and any(len(buf) < 1 or len(stack)
-                                  for buf, stack in zip(self.bufs, self.stacks)):
-                # To elaborate on this exception, when cropping examples it is possible
-                # that your first 1 or 2 actions is a reduce action. It is unclear if this
-                # is a bug in cropping or a bug in how we think about cropping. In the meantime,
-                # turn on the truncate batch flag, and set the eval_seq_length
-                # very high.
-                raise IndexError(
-                    "Warning: You are probably trying to encode examples"
-                    "with cropped transitions. Although, this is a reasonable"
-                    "feature, when predicting/validating transitions, you"
-                    "probably will not get the behavior that you expect. Disable"
-                    "this exception if you dare.")
-            self.memory['top_buf'] = self.wrap_items(
-                [buf[-1] if len(buf) > 0 else self.zeros for buf in self.bufs])
-            self.memory['top_stack_1'] = self.wrap_items(
-                [stack[-1] if len(stack) > 0 else self.zeros for stack in self.stacks])
-            self.memory['top_stack_2'] = self.wrap_items(
-                [stack[-2] if len(stack) > 1 else self.zeros for stack in self.stacks])
+            if self.stack_type == "thin":
+                top_buf, top_stack_1, top_stack_2 = self.thin_stack.tops(t_step)
+                top_buf = self.wrap_items([top_buf])
+                top_stack_1 = self.wrap_items([top_stack_1])
+                top_stack_2 = self.wrap_items([top_stack_2])
+            else:
+                if self.debug and (any(self.buffer_lengths() < 0) or any(
+                        len(stack) < 2 for stack in self.stacks)):
+                    # To elaborate on this exception, when cropping examples it is possible
+                    # that your first 1 or 2 actions is a reduce action. It is unclear if this
+                    # is a bug in cropping or a bug in how we think about cropping. In the meantime,
+                    # turn on the truncate batch flag, and set the eval_seq_length
+                    # very high.
+                    raise IndexError(
+                        "Warning: You are probably trying to encode examples"
+                        "with cropped transitions. Although, this is a reasonable"
+                        "feature, when predicting/validating transitions, you"
+                        "probably will not get the behavior that you expect. Disable"
+                        "this exception if you dare.")
+                top_buf = self.wrap_items([self.buffer_top()])
+                top_stack_1 = self.wrap_items(
+                    [stack[-1] if len(stack) > 0 else self.zeros for stack in self.stacks])
+                top_stack_2 = self.wrap_items(
+                    [stack[-2] if len(stack) > 1 else self.zeros for stack in self.stacks])
 
             # Run if:
             # A. We have a tracking component and,
             # B. There is at least one transition that will not be skipped.
             if hasattr(self, 'tracker') and sum(cant_skip) > 0:
 
+                # Only step the examples that have a transition, unless all
+                # of them do.
+                if self.compact_active_rows and not cant_skip.all():
+                    active_rows = np.nonzero(cant_skip)[0]
+                    rows = to_gpu(Variable(torch.from_numpy(active_rows)))
+                else:
+                    active_rows, rows = None, None
+
                 # Get hidden output from the tracker. Used to predict
                 # transitions.
+                t = self.profiler.start()
                 tracker_h, tracker_c = self.tracker(
-                    self.extract_h(self.memory['top_buf']),
-                    self.extract_h(self.memory['top_stack_1']),
-                    self.extract_h(self.memory['top_stack_2']))
+                    self.extract_h(top_buf),
+                    self.extract_h(top_stack_1),
+                    self.extract_h(top_stack_2),
+                    rows=rows)
+                self.profiler.stop('tracker', t)
 
                 if hasattr(self, 'transition_net'):
+                    t = self.profiler.start()
                     transition_inp = [tracker_h]
                     if self.tracker.lateral_tracking and self.predict_use_cell:
                         transition_inp += [tracker_c]
@@ -410,116 +1011,141 @@ class SPINN(nn.Module):
                         transition_inp = torch.cat(transition_inp, 1)
 
                     transition_output = self.transition_net(transition_inp)
+                    self.profiler.stop('transition_net', t)
 
                 if hasattr(self, 'transition_net') and run_internal_parser:
 
                     # Predict Actions
                     # ===============
 
-                    # TODO: Mask before predicting. This should simplify things and reduce computation.
-                    # The downside is that in the Action Phase, need to be smarter about which stacks/bufs
-                    # are selected.
-                    transition_logdist, transition_preds = self.predict_actions(
-                        transition_output)
-
-                    # Distribution of transitions use to calculate transition
-                    # loss.
-                    self.memory["t_logprobs"] = transition_logdist
-
-                    # Given transitions.
-                    self.memory["t_given"] = transitions
-
-                    # Constrain to valid actions
-                    # ==========================
-
-                    validated_preds, invalid_mask = self.validate(
-                        transition_arr, transition_preds, self.stacks, self.bufs)
+                    # Invalid actions are masked out before predicting, so
+                    # that the predictions never leave the device.
+                    t = self.profiler.start()
+                    must_shift, must_reduce = self.action_constraints(t_step)
                     if validate_transitions:
-                        transition_preds = validated_preds
-
-                    # Keep track of which predictions have been valid.
-                    self.memory["t_valid_mask"] = np.logical_not(invalid_mask)
-                    invalid_count += invalid_mask
+                        allowed = self.allowed_actions(must_shift, must_reduce)
+                        if rows is not None:
+                            allowed = allowed.index_select(0, rows.data)
+                    else:
+                        allowed = None
+                    self.profiler.stop('validate', t)
+
+                    t = self.profiler.start()
+                    transition_logdist, transition_preds, unconstrained_preds = \
+                        self.predict_actions(transition_output, active_rows, allowed)
+
+                    if active_rows is not None:
+                        transition_logdist = transition_logdist.new(
+                            batch_size, transition_logdist.size(1)).zero_(
+                        ).index_copy(0, rows, transition_logdist)
+                        transition_preds = transitions_t.new(batch_size).fill_(
+                            T_SKIP).index_copy_(0, rows.data, transition_preds)
+                        unconstrained_preds = transitions_t.new(batch_size).fill_(
+                            T_SKIP).index_copy_(0, rows.data, unconstrained_preds)
+                    self.profiler.stop('predict_actions', t)
+
+                    # Keep track of which predictions would have been invalid.
+                    t = self.profiler.start()
+                    invalid_mask = self.invalid_actions(
+                        transitions_t, unconstrained_preds, must_shift, must_reduce)
+                    invalid_count += invalid_mask.long()
 
                     # If the given action is skip, then must skip.
-                    transition_preds[must_skip] = T_SKIP
-
-                    # Actual transition predictions. Used to measure transition
-                    # accuracy.
-                    self.memory["t_preds"] = transition_preds
-
-                    # Binary mask of examples that have a transition.
-                    self.memory["t_mask"] = cant_skip
+                    transition_preds = transition_preds.masked_fill(
+                        transitions_t == T_SKIP, T_SKIP)
+
+                    # Record the actual predictions (used to measure transition
+                    # accuracy), the given transitions, which examples have a
+                    # transition, which predictions were valid, and the
+                    # distribution used to calculate transition loss.
+                    self.record.add(t_step,
+                                    preds=transition_preds,
+                                    given=transitions,
+                                    mask=cant_skip,
+                                    valid_mask=1 - invalid_mask,
+                                    logprobs=transition_logdist)
+                    self.profiler.stop('validate', t)
 
                     # If this FLAG is set, then use the predicted actions
                     # rather than the given.
                     if use_internal_parser:
-                        transition_arr = transition_preds.tolist()
-
-            # Pre-Action Phase
-            # ================
-
-            # TODO: See if PyTorch's 'Advanced Indexing for Tensors and Variables' features would simplify this.
-
-            # For SHIFT
-            s_stacks, s_tops, s_trackings, s_idxs = [], [], [], []
-
-            # For REDUCE
-            r_stacks, r_lefts, r_rights, r_trackings = [], [], [], []
-
-            batch = zip(transition_arr, self.bufs, self.stacks, self.tracker.states if hasattr(
-                self, 'tracker') and self.tracker.h is not None else itertools.repeat(None))
+                        transitions_t = transition_preds
+                        if self.stack_type != "thin":
+                            # The list-based stacks are updated on the host.
+                            transition_arr = transition_preds.cpu().tolist()
 
-            for batch_idx, (transition, buf, stack,
-                            tracking) in enumerate(batch):
-                if transition == T_SHIFT:  # shift
-                    self.t_shift(buf, stack, tracking, s_tops, s_trackings)
-                    s_idxs.append(batch_idx)
-                    s_stacks.append(stack)
-                elif transition == T_REDUCE:  # reduce
-                    self.t_reduce(
-                        buf,
-                        stack,
-                        tracking,
-                        r_lefts,
-                        r_rights,
-                        r_trackings)
-                    r_stacks.append(stack)
-                elif transition == T_SKIP:  # skip
-                    self.t_skip()
-
-            # Action Phase
-            # ============
-
-            self.shift_phase(s_tops, s_trackings, s_stacks)
-            self.reduce_phase(r_lefts, r_rights, r_trackings, r_stacks)
-            self.reduce_phase_hook(r_lefts, r_rights, r_trackings, r_stacks)
-
-            # Memory Phase
-            # ============
-
-            # APPEND ALL MEMORIES. MASK LATER.
+            if self.stack_type == "thin":
+                self.thin_action_phase(t_step, transitions_t)
+            else:
 
-            self.memories.append(self.memory)
+                # Pre-Action Phase
+                # ================
+
+                # TODO: See if PyTorch's 'Advanced Indexing for Tensors and Variables' features would simplify this.
+
+                t = self.profiler.start()
+
+                # For SHIFT
+                s_stacks, s_idxs = [], []
+
+                # For REDUCE
+                r_stacks, r_lefts, r_rights, r_idxs = [], [], [], []
+
+                for batch_idx, (transition, stack) in enumerate(
+                        zip(transition_arr, self.stacks)):
+                    if transition == T_SHIFT:  # shift
+                        self.t_shift(stack)
+                        s_idxs.append(batch_idx)
+                        s_stacks.append(stack)
+                    elif transition == T_REDUCE:  # reduce
+                        self.t_reduce(stack, r_lefts, r_rights)
+                        r_idxs.append(batch_idx)
+                        r_stacks.append(stack)
+                    elif transition == T_SKIP:  # skip
+                        self.t_skip()
+
+                r_trackings = None
+                if len(r_idxs) > 0:
+                    r_trackings = self.tracking_states(to_gpu(
+                        torch.LongTensor(r_idxs)))
+                self.profiler.stop('pre_action', t)
+
+                # Action Phase
+                # ============
+
+                t = self.profiler.start()
+                s_tops = self.shift_buffers(s_idxs)
+                self.shift_phase(s_tops, s_stacks)
+                self.profiler.stop('shift_phase', t)
+                if len(s_idxs) > 0:
+                    self.profiler.count('shift_calls')
+                    self.profiler.count('shift_rows', len(s_idxs))
+
+                t = self.profiler.start()
+                self.reduce_phase(r_lefts, r_rights, r_trackings, r_stacks)
+                self.profiler.stop('reduce_phase', t)
+                if len(r_idxs) > 0:
+                    self.profiler.count('reduce_calls')
+                    self.profiler.count('reduce_rows', len(r_idxs))
+
+                self.reduce_phase_hook(r_lefts, r_rights, r_trackings, r_stacks)
 
             # Update number of reduces seen so far.
-            self.n_reduces += (np.array(transition_arr) == T_REDUCE)
+            self.n_reduces += (transitions_t == T_REDUCE).long()
 
             # Update number of non-skip actions seen so far.
-            self.n_steps += (np.array(transition_arr) != T_SKIP)
+            self.n_steps += (transitions_t != T_SKIP).long()
 
         # Loss Phase
         # ==========
 
-        if hasattr(self, 'tracker') and hasattr(self, 'transition_net'):
-            t_preds = np.concatenate([m['t_preds']
-                                      for m in self.memories if 't_preds' in m])
-            t_given = np.concatenate([m['t_given']
-                                      for m in self.memories if 't_given' in m])
-            t_mask = np.concatenate([m['t_mask']
-                                     for m in self.memories if 't_mask' in m])
-            t_logprobs = torch.cat([m['t_logprobs']
-                                    for m in self.memories if 't_logprobs' in m], 0)
+        t = self.profiler.start()
+        if self.record is not None:
+            self.record.finish()
+            t_preds = self.record.flat('preds')
+            t_given = self.record.flat('given')
+            t_mask = self.record.flat('mask')
+            t_logprobs = self.record.logprobs
 
             # We compute accuracy and loss after all transitions have complete,
             # since examples can have different lengths when not using skips.
@@ -543,17 +1169,29 @@ class SPINN(nn.Module):
             transition_loss = nn.NLLLoss()(select_t_logprobs, select_t_given) * \
                 self.transition_weight
 
-            self.n_invalid = (invalid_count > 0).sum()
+            self.n_invalid = (invalid_count.cpu().numpy() > 0).sum()
             self.invalid = self.n_invalid / float(batch_size)
 
         self.loss_phase_hook()
+        self.profiler.stop('loss_phase', t)
+
+        if self.stack_type == "thin":
+            stack = self.thin_stack
+            if self.debug and not stack.replay:
+                stack_lens, buf_lens = stack.lengths(num_transitions)
+                assert all(stack_lens == 1), \
+                    "Stacks should be fully reduced and hold only the sentence encoding."
+                assert all(buf_lens == 0), \
+                    "Buffers should be fully shifted."
+            outputs = torch.chunk(stack.roots(), stack.batch_size, 0)
+            return list(outputs), transition_acc, transition_loss
 
         if self.debug:
             assert all(len(stack) == 3 for stack in self.stacks), \
                 "Stacks should be fully reduced and have 3 elements: " \
                 "two zeros and the sentence encoding."
-            assert all(len(buf) == 1 for buf in self.bufs), \
-                "Stacks should be fully shifted and have 1 zero."
+            assert all(self.buffer_lengths() == 0), \
+                "Buffers should be fully shifted."
 
         return [stack[-1]
                 for stack in self.stacks], transition_acc, transition_loss
@@ -589,6 +1227,9 @@ class BaseModel(nn.Module):
                  composition_args=None,
                  detach=None,
                  evolution=None,
+                 dedup_eval_sentences=False,
+                 eval_encoding_cache_size=0,
+                 eval_projection_table=False,
                  **kwargs
                  ):
         super(BaseModel, self).__init__()
@@ -637,8 +1278,36 @@ class BaseModel(nn.Module):
         self.reshape_input = context_args.reshape_input
         self.reshape_context = context_args.reshape_context
 
+        # In eval, look up encoded embeddings in a table computed once per
+        # evaluation, if the encoder sees one token at a time.
+        self.projection_table = TokenTable(self.embed, self.encode) \
+            if eval_projection_table and context_args.token_wise else None
+
         self.inverted_vocabulary = None
 
+        # In eval, encode each distinct sentence of a batch once, and
+        # optionally reuse encodings across batches.
+        self.dedup_eval_sentences = dedup_eval_sentences or eval_encoding_cache_size > 0
+        self.encoding_cache = LRUCache(
+            eval_encoding_cache_size) if eval_encoding_cache_size > 0 else None
+        self.encoding_stats = None
+
+    def clear_eval_caches(self):
+        # Cached encodings are only valid for the weights they were made with.
+        if self.encoding_cache is not None:
+            self.encoding_cache.clear()
+        if self.projection_table is not None:
+            self.projection_table.clear()
+
+    def train(self, mode=True):
+        self.clear_eval_caches()
+        return super(BaseModel, self).train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        self.clear_eval_caches()
+        return super(BaseModel, self).load_state_dict(
+            state_dict, *args, **kwargs)
+
     def get_features_dim(self):
         features_dim = self.hidden_dim * 2 if self.use_sentence_pair else self.hidden_dim
         if self.use_sentence_pair:
@@ -672,8 +1341,84 @@ class BaseModel(nn.Module):
         self.spinn.reset_state()
         h_list, transition_acc, transition_loss = self.spinn(
             example, use_internal_parser=use_internal_parser, validate_transitions=validate_transitions)
-        h = self.wrap(h_list)
-        return h, transition_acc, transition_loss
+        return h_list, transition_acc, transition_loss
+
+    def encode_sentences(
+            self,
+            example,
+            use_internal_parser,
+            validate_transitions=True):
+        b, l = example.tokens.size()[:2]
+
+        if self.projection_table is not None and not self.training:
+            embeds = self.projection_table.lookup(example.tokens)
+        else:
+            embeds = self.embed(example.tokens)
+            embeds = self.reshape_input(embeds, b, l)
+            embeds = self.encode(embeds)
+            embeds = self.reshape_context(embeds, b, l)
+        self.forward_hook(embeds, b, l)
+        embeds = F.dropout(
+            embeds,
+            self.embedding_dropout_rate,
+            training=self.training)
+
+        # Make Buffers. SPINN reads them in place from the embeddings.
+        example.embeds = embeds.view(b, l, -1)
+
+        return self.run_spinn(example, use_internal_parser, validate_transitions)
+
+    def encode_distinct_sentences(
+            self,
+            example,
+            use_internal_parser,
+            validate_transitions=True):
+        '''Encodes each distinct row of tokens and transitions once, and takes
+        rows found in the encoding cache from there. Transition statistics
+        cover only the rows that were encoded.'''
+        tokens = example.tokens.data.cpu().numpy()
+        rows = np.concatenate([tokens.astype(np.int64),
+                               example.transitions.astype(np.int64)], axis=1)
+        keys = [row.tobytes() for row in rows]
+
+        # Map every row to the first row with the same key.
+        first_rows = []
+        distinct_index = dict()
+        inverse = np.zeros(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            if key not in distinct_index:
+                distinct_index[key] = len(first_rows)
+                first_rows.append(i)
+            inverse[i] = distinct_index[key]
+
+        items = [None] * len(first_rows)
+        if self.encoding_cache is not None:
+            for j, i in enumerate(first_rows):
+                items[j] = self.encoding_cache.get(keys[i])
+        fresh = [j for j, item in enumerate(items) if item is None]
+        self.encoding_stats = dict(
+            sentences=len(keys),
+            distinct=len(first_rows),
+            cached=len(first_rows) - len(fresh))
+
+        transition_acc, transition_loss = None, None
+        if len(fresh) > 0:
+            fresh_rows = np.array([first_rows[j] for j in fresh])
+            sub_example = Example()
+            sub_example.tokens = example.tokens.index_select(
+                0, to_gpu(Variable(torch.from_numpy(fresh_rows),
+                                   volatile=example.tokens.volatile)))
+            sub_example.transitions = example.transitions[fresh_rows]
+            sub_example.plans = example.plans[fresh_rows] \
+                if example.plans is not None else None
+            h_list, transition_acc, transition_loss = self.encode_sentences(
+                sub_example, use_internal_parser, validate_transitions)
+            for j, h in zip(fresh, h_list):
+                items[j] = h
+                if self.encoding_cache is not None:
+                    self.encoding_cache.put(keys[first_rows[j]], h.clone())
+
+        return [items[j] for j in inverse], transition_acc, transition_loss
 
     def forward_hook(self, embeds, batch_size, seq_length):
         pass
@@ -688,37 +1433,22 @@ class BaseModel(nn.Module):
             y_batch=None,
             use_internal_parser=False,
             validate_transitions=True,
+            transition_plans=None,
             **kwargs):
-        example = self.unwrap(sentences, transitions)
-
-        b, l = example.tokens.size()[:2]
-
-        embeds = self.embed(example.tokens)
-        embeds = self.reshape_input(embeds, b, l)
-        embeds = self.encode(embeds)
-        embeds = self.reshape_context(embeds, b, l)
-        self.forward_hook(embeds, b, l)
-        embeds = F.dropout(
-            embeds,
-            self.embedding_dropout_rate,
-            training=self.training)
-
-        # Make Buffers
-        # _embeds = torch.chunk(to_cpu(embeds), b, 0)
-        # _embeds = [torch.chunk(x, l, 0) for x in _embeds]
-        # buffers = [list(reversed(x)) for x in _embeds]
-        ee = torch.chunk(embeds, b * l, 0)[::-1]
-        bb = []
-        for ii in range(b):
-            ex = list(ee[ii * l:(ii + 1) * l])
-            bb.append(ex)
-        buffers = bb[::-1]
-
-        example.bufs = buffers
-
-        h, transition_acc, transition_loss = self.run_spinn(
-            example, use_internal_parser, validate_transitions)
+        example = self.unwrap(sentences, transitions, transition_plans)
+
+        # In training, dropout and sampled parses make every copy of a
+        # sentence different. Parse samples need every row to be encoded.
+        if self.dedup_eval_sentences and not self.training and \
+                not kwargs.get('store_parse_masks', False):
+            h_list, transition_acc, transition_loss = self.encode_distinct_sentences(
+                example, use_internal_parser, validate_transitions)
+        else:
+            self.encoding_stats = None
+            h_list, transition_acc, transition_loss = self.encode_sentences(
+                example, use_internal_parser, validate_transitions)
 
+        h = self.wrap(h_list)
         self.spinn_outp = h
 
         self.transition_acc = transition_acc
@@ -735,10 +1465,12 @@ class BaseModel(nn.Module):
 
     # --- Sentence Style Switches ---
 
-    def unwrap(self, sentences, transitions):
+    def unwrap(self, sentences, transitions, plans=None):
+        if plans is not None and plans.shape[1] == 0:
+            plans = None
         if self.use_sentence_pair:
-            return self.unwrap_sentence_pair(sentences, transitions)
-        return self.unwrap_sentence(sentences, transitions)
+            return self.unwrap_sentence_pair(sentences, transitions, plans)
+        return self.unwrap_sentence(sentences, transitions, plans)
 
     def wrap(self, h_list):
         if self.use_sentence_pair:
@@ -747,7 +1479,7 @@ class BaseModel(nn.Module):
 
     # --- Sentence Model Specific ---
 
-    def unwrap_sentence(self, sentences, transitions):
+    def unwrap_sentence(self, sentences, transitions, plans=None):
         # Build Tokens
         x = sentences
 
@@ -760,6 +1492,7 @@ class BaseModel(nn.Module):
                 torch.from_numpy(x),
                 volatile=not self.training))
         example.transitions = t
+        example.plans = plans
 
         return example
 
@@ -769,7 +1502,11 @@ class BaseModel(nn.Module):
 
     # --- Sentence Pair Model Specific ---
 
-    def unwrap_sentence_pair(self, sentences, transitions):
+    def unwrap_sentence_pair(self, sentences, transitions, plans=None):
+        if sentences.ndim == 2:
+            # Already unwrapped, with the premises stacked over the hypotheses.
+            return self.unwrap_sentence(sentences, transitions, plans)
+
         # Build Tokens
         x_prem = sentences[:, :, 0]
         x_hyp = sentences[:, :, 1]
@@ -786,6 +1523,9 @@ class BaseModel(nn.Module):
                 torch.from_numpy(x),
                 volatile=not self.training))
         example.transitions = t
+        if plans is not None:
+            plans = np.concatenate([plans[:, :, :, 0], plans[:, :, :, 1]], axis=0)
+        example.plans = plans
 
         return example
 
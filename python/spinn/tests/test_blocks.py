@@ -1,16 +1,20 @@
 import unittest
 import tempfile
 
+import numpy as np
 
 # PyTorch
 import torch
 import torch.nn as nn
+from torch.autograd import Variable
 
 
 from spinn.util.blocks import DefaultUniformInitializer as SimpleInitializer
 from spinn.util.blocks import ZeroInitializer as SimpleBiasInitializer
 from spinn.util.blocks import HeKaimingLinear as CustomLinear
 from spinn.util.blocks import Linear
+from spinn.util.blocks import ReduceTreeLSTM, repack_state_dict
+from spinn.util.blocks import IntraAttention, LSTMStateBatch
 
 from spinn.util.test import compare_models
 
@@ -100,6 +104,83 @@ class PytorchTestCase(unittest.TestCase):
         # Cleanup temporary file.
         temp.close()
 
+    def test_fused_tree_lstm_repack(self):
+        size, tracker_size, batch_size = 6, 4, 3
+        unfused = ReduceTreeLSTM(size, tracker_size=tracker_size,
+                                 use_tracking_in_composition=True)
+        fused = ReduceTreeLSTM(size, tracker_size=tracker_size,
+                               use_tracking_in_composition=True, fused=True)
+
+        state_dict = unfused.state_dict()
+        assert repack_state_dict(fused, state_dict)
+        fused.load_state_dict(state_dict)
+
+        def inputs(dim):
+            return [Variable(torch.randn(1, dim))
+                    for _ in range(batch_size)]
+        lefts, rights = inputs(2 * size), inputs(2 * size)
+        tracking = inputs(2 * tracker_size)
+
+        expected = torch.cat(unfused(lefts, rights, tracking), 0)
+        actual = torch.cat(fused(lefts, rights, tracking), 0)
+        np.testing.assert_allclose(actual.data.numpy(),
+                                   expected.data.numpy(), rtol=1e-5, atol=1e-6)
+
+        # A state dict that is already fused is left alone.
+        assert not repack_state_dict(fused, fused.state_dict())
+
+    def test_lstm_state_batch(self):
+        c = torch.arange(0, 8).view(4, 2).float()
+        h = torch.arange(8, 16).view(4, 2).float()
+        states = LSTMStateBatch((Variable(c), Variable(h)))
+
+        rows = states.select(Variable(torch.LongTensor([3, 1, 2])))
+        rows = rows.select(Variable(torch.LongTensor([2, 0])))
+        assert len(rows) == 2
+        np.testing.assert_array_equal(rows.c.data.numpy(), c.numpy()[[2, 3]])
+        np.testing.assert_array_equal(rows.h.data.numpy(), h.numpy()[[2, 3]])
+        np.testing.assert_array_equal(
+            rows.both.data.numpy(), torch.cat([c, h], 1).numpy()[[2, 3]])
+
+        scattered = states.scatter(Variable(torch.LongTensor([0])), rows.select(
+            Variable(torch.LongTensor([1]))))
+        np.testing.assert_array_equal(scattered.c.data.numpy(),
+                                      c.numpy()[[3, 1, 2, 3]])
+        np.testing.assert_array_equal(states.c.data.numpy(), c.numpy())
+
+        # Batched and per-example inputs give the same compositions.
+        reduce = ReduceTreeLSTM(2, tracker_size=2,
+                                use_tracking_in_composition=True)
+        batched = reduce(states, scattered, states)
+        unbatched = reduce(states.unbundle(), scattered.unbundle(),
+                           states.unbundle())
+        np.testing.assert_allclose(batched.both.data.numpy(),
+                                   torch.cat(unbatched, 0).data.numpy())
+
+    def test_intra_attention(self):
+        batch_size, seq_len, hidden_dim = 3, 12, 5
+        attention = IntraAttention(4, hidden_dim)
+        x = Variable(torch.randn(batch_size, seq_len, 4))
+        outputs = attention(x).data.numpy()
+
+        # Reference: attend through a (B, L, L, H) broadcast, with distances
+        # capped at 10.
+        f = attention.f(x.view(-1, 4)).data.numpy().reshape(
+            batch_size, seq_len, hidden_dim)
+        positions = np.arange(seq_len)
+        d = 0.01 * np.minimum(
+            np.abs(positions[np.newaxis] - positions[:, np.newaxis]), 10)
+        e = np.einsum('bih,bjh->bij', f, f) + d
+        e = np.exp(e - e.max(2, keepdims=True))
+        e /= e.sum(2, keepdims=True)
+        expected = (f[:, np.newaxis, :, :] * e[:, :, :, np.newaxis]).sum(2)
+        np.testing.assert_allclose(outputs, expected, rtol=1e-5, atol=1e-6)
+
+        # The distance bias is built once per sequence length.
+        attention(x[:, :6].contiguous())
+        attention(x)
+        assert sorted(attention.bias_cache.keys()) == [6, seq_len]
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 
 from spinn.cbow import BaseModel
 
@@ -23,6 +24,32 @@ class CBOWTestCase(unittest.TestCase):
         outputs = model(X, transitions)
         assert outputs.size() == (2, 3)
 
+        # Pairs may also come unwrapped, premises stacked over hypotheses.
+        X = np.concatenate([X[:, :, 0], X[:, :, 1]], axis=0)
+        unwrapped_outputs = model(X, transitions)
+        assert (unwrapped_outputs.data == outputs.data).all()
+
+    def test_projection_table(self):
+        model = MockModel(BaseModel, default_args())
+        table_model = MockModel(
+            BaseModel, default_args(eval_projection_table=True))
+        table_model.load_state_dict(model.state_dict())
+        model.eval()
+        table_model.eval()
+        X, transitions = get_batch()
+
+        expected = model(X, transitions).data.numpy()
+        outputs = table_model(X, transitions).data.numpy()
+        np.testing.assert_allclose(expected, outputs, rtol=1e-5, atol=1e-5)
+
+        # New weights make a new table.
+        model.encode.bias.data.fill_(1.0)
+        table_model.load_state_dict(model.state_dict())
+        assert table_model.projection_table.table is None
+        expected = model(X, transitions).data.numpy()
+        outputs = table_model(X, transitions).data.numpy()
+        np.testing.assert_allclose(expected, outputs, rtol=1e-5, atol=1e-5)
+
 
 if __name__ == '__main__':
     unittest.main()
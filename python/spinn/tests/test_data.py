@@ -1,7 +1,10 @@
 import unittest
+import numpy as np
 
 
 import os
+import shutil
+import tempfile
 from spinn import util
 from spinn.data.nli import load_nli_data
 from spinn.data.sst import load_sst_data
@@ -165,6 +168,215 @@ class DataTestCase(unittest.TestCase):
             vocabulary, word_embedding_dim, embedding_data_path)
         assert initial_embeddings.shape == (10, 5)
 
+    def test_preprocessed_data_cache(self):
+        data_manager = load_nli_data
+        raw_data = data_manager.load_data(nli_data_path)
+        data_sets = [(nli_data_path, raw_data)]
+        vocabulary = util.BuildVocabulary(
+            raw_data, data_sets, embedding_data_path, logger=MockLogger(),
+            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA)
+        data = util.PreprocessDataset(
+            raw_data, vocabulary, 25, data_manager, logger=MockLogger(),
+            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
+            compile_plans=True)
+
+        key = util.DataCacheKey([nli_data_path], dict(seq_length=25))
+        assert key == util.DataCacheKey([nli_data_path], dict(seq_length=25))
+        assert key != util.DataCacheKey([nli_data_path], dict(seq_length=26))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(cache_dir, key)
+            util.SavePreprocessedData(path, vocabulary, None,
+                                      [(nli_data_path, data)])
+            cached_vocabulary, training_data, eval_sets = \
+                util.LoadPreprocessedData(path)
+            assert training_data is None
+            assert cached_vocabulary == vocabulary
+            filename, cached = eval_sets[0]
+            assert filename == nli_data_path
+            for expected, actual in zip(data, cached):
+                assert isinstance(actual, np.memmap)
+                np.testing.assert_array_equal(actual, expected)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_binary_embedding_store(self):
+        data_manager = load_nli_data
+        raw_data = data_manager.load_data(nli_data_path)
+        data_sets = [(nli_data_path, raw_data)]
+        vocabulary = util.BuildVocabulary(
+            raw_data, data_sets, embedding_data_path, logger=MockLogger(),
+            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA)
+        initial_embeddings = util.LoadEmbeddingsFromText(
+            vocabulary, word_embedding_dim, embedding_data_path)
+
+        store_dir = tempfile.mkdtemp()
+        try:
+            store_path = os.path.join(store_dir, "embeddings.npy")
+            assert util.ConvertEmbeddingsToBinary(
+                embedding_data_path, store_path) == (10, 5)
+
+            # The store gives the same vocabulary and embeddings as the text file.
+            binary_vocabulary = util.BuildVocabulary(
+                raw_data, data_sets, store_path, logger=MockLogger(),
+                sentence_pair_data=data_manager.SENTENCE_PAIR_DATA)
+            assert binary_vocabulary == vocabulary
+            binary_embeddings = util.LoadEmbeddings(
+                vocabulary, word_embedding_dim - 1, store_path)
+            np.testing.assert_array_equal(
+                binary_embeddings, initial_embeddings[:, :word_embedding_dim - 1])
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_vocabulary(self):
+        vocabulary = util.Vocabulary({util.PADDING_TOKEN: 0, util.UNK_TOKEN: 1,
+                                      "the": 2, "NASA": 3})
+        tokens = ["the", "The", "nasa", "moon", "the"]
+        ids, counts = vocabulary.lookup(tokens)
+        assert ids.tolist() == [2, 2, 3, 1, 2]
+        assert counts.tolist() == [2, 1, 1, 1]
+        assert len(vocabulary.cache) == 4
+
+        # Without an UNK token, missing tokens are an error.
+        with self.assertRaises(KeyError):
+            util.Vocabulary({"the": 0}).lookup(["moon"])
+
+        # Worker processes give the same IDs.
+        dataset = [dict(tokens=tokens[:2]), dict(tokens=tokens[2:])]
+        util.TokensToIDs(vocabulary, dataset, num_workers=2)
+        assert [example["tokens"] for example in dataset] == [[2, 2], [3, 1, 2]]
+
+    def test_crop_and_pad(self):
+        dataset = [
+            dict(tokens=[3, 4, 5], transitions=[0, 0, 1, 0, 1]),
+            dict(tokens=[6], transitions=[0]),
+        ]
+
+        # Transitions are cropped and padded on the left. Tokens shifted by
+        # cropped transitions are dropped, and tokens are padded on the right.
+        X, transitions, num_transitions = util.CropAndPadForSPINN(
+            dataset, 4, allow_cropping=True)
+        assert (X == [[4, 5, 0, 0], [6, 0, 0, 0]]).all()
+        assert (transitions == [[0, 1, 0, 1], [2, 2, 2, 0]]).all()
+        assert (num_transitions == [5, 1]).all()
+        with self.assertRaises(NotImplementedError):
+            util.CropAndPadForSPINN(dataset, 4)
+
+        X = util.CropAndPadSimple(dataset, 2, pad_from_left=True)
+        assert (X == [[4, 5], [0, 6]]).all()
+        X = util.CropAndPadSimple(dataset, 2, pad_from_left=False)
+        assert (X == [[3, 4], [6, 0]]).all()
+
+    def test_batch_plan(self):
+        # Bits of the first length land above the matching bits of the second.
+        keys = util.MortonCode(np.array([1, 0, 3, 300]), np.array([0, 1, 3, 5]))
+        assert keys.tolist() == [2, 1, 15, 2**17 + 2**11 + 2**7 + 2**5 + 2**4 + 1]
+
+        num_transitions = np.array([[5, 9], [2, 1], [7, 7], [1, 2]])
+        assert util.SortKeys(num_transitions, use_peano=False).tolist() == [
+            9, 2, 7, 2]
+
+        lengths = np.random.permutation(103)
+        rng = np.random.RandomState(0)
+        plan = util.MakeBatchPlan(103, 10, lengths, num_splits=2, rng=rng)
+        assert plan.shape == (10, 10)
+        assert len(np.unique(plan)) == 100
+        # Each batch comes from one sorted split of about half the data.
+        spread = lengths[plan].max(axis=1) - lengths[plan].min(axis=1)
+        assert spread.max() < 40
+
+        plan = util.MakeBatchPlan(103, 10, rng=rng)
+        assert plan.shape == (10, 10)
+        assert len(np.unique(plan)) == 100
+
+        sources = (np.arange(25), np.zeros(25), np.zeros(25), np.arange(25))
+        it = util.MakeTrainingIterator(
+            sources, 10, sentence_pair_data=False, num_splits=2)
+        seen = np.concatenate([next(it)[0] for _ in range(4)])
+        assert len(np.unique(seen[:20])) == 20
+        assert len(np.unique(seen[20:])) == 20
+
+    def test_token_budget(self):
+        lengths = np.array([10, 10, 10, 2, 2, 2, 2, 2, 50, 3])
+        batches = util.SplitByTokenBudget(np.arange(10), lengths, 30)
+        assert [b.tolist() for b in batches] == [
+            [0, 1, 2], [3, 4, 5, 6, 7], [8], [9]]
+
+        rng = np.random.RandomState(0)
+        lengths = rng.randint(1, 40, size=500)
+        plan = util.MakeBatchPlan(500, 32, lengths, num_splits=3, rng=rng,
+                                  lengths=lengths, token_budget=100)
+        assert sorted(np.concatenate(plan).tolist()) == range(500)
+        for batch in plan:
+            assert len(batch) == 1 or \
+                len(batch) * lengths[batch].max() <= 100
+
+        num_transitions = np.stack([lengths, lengths[::-1]], axis=1)
+        sources = (np.arange(500), np.zeros(500), np.zeros(500),
+                   num_transitions)
+        batches = util.MakeBucketEvalIterator(sources, 32, token_budget=100)
+        assert sum(len(b[0]) for b in batches) == 500
+        for batch in batches:
+            assert len(batch[0]) * batch[3].max() <= 100
+
+    def test_eval_iterators(self):
+        num_transitions = np.array([3, 9, 1, 7, 5])
+        sources = (np.arange(5), np.zeros(5), np.zeros(5), num_transitions)
+
+        # Every example is scored, including those past the last full batch.
+        batches = util.MakeEvalIterator(sources, 2)
+        assert len(batches) == 3
+        assert [b[0].tolist() for b in batches] == [[0, 1], [2, 3], [4]]
+        batches = util.MakeEvalIterator(sources, 2, limit=3)
+        assert [b[0].tolist() for b in batches] == [[0, 1], [2]]
+
+        batches = util.MakeEvalIterator(sources, 2, bucket_eval=True)
+        assert [b[3].tolist() for b in batches] == [[9, 7], [5, 3], [1]]
+        assert [b[3].tolist() for b in batches[:2]] == [[9, 7], [5, 3]]
+        assert batches[1][0].tolist() == [4, 0]
+
+    def test_prefetching_iterator(self):
+        X = np.arange(24).reshape(3, 4, 2)
+        transitions = np.arange(30).reshape(3, 5, 2)
+        plans = np.arange(60).reshape(3, 5, 2, 2)
+        batch = (X, transitions, np.arange(3), np.ones((3, 2)),
+                 np.arange(3), plans)
+        X, transitions, y, _, _, plans = util.UnwrapSentencePairBatch(batch)
+        assert X.shape == (6, 4) and transitions.shape == (6, 5)
+        assert plans.shape == (6, 5, 2) and y.shape == (3,)
+        assert (X[3] == batch[0][0, :, 1]).all()
+        assert (plans[4] == batch[5][1, :, :, 1]).all()
+
+        def prepare(x):
+            return x * 2
+
+        for use_process in [False, True]:
+            it = util.MakePrefetchingIterator(
+                iter(range(5)), prepare, depth=2, use_process=use_process)
+            assert list(it) == [0, 2, 4, 6, 8]
+        assert list(util.MakePrefetchingIterator(
+            iter(range(3)), prepare, depth=0)) == [0, 2, 4]
+
+        it = util.MakePrefetchingIterator(iter([1, None]), prepare)
+        assert next(it) == 2
+        with self.assertRaises(RuntimeError):
+            next(it)
+
+    def test_compile_transition_plans(self):
+        transitions = np.array([
+            [0, 0, 0, 0, 1, 1, 1],
+            [2, 2, 0, 0, 1, 0, 1],
+        ], dtype=np.int32)
+        num_tokens = np.array([4, 3])
+        expected = np.array([
+            [[0, 0], [1, 0], [2, 1], [3, 2], [4, 3], [-1, 2], [-2, 1]],
+            [[0, 0], [0, 0], [0, 0], [1, 0], [2, 1], [-1, 0], [3, -1]],
+        ])
+        plans = util.CompileTransitionPlans(transitions, num_tokens)
+        assert plans.shape == (2, 7, 2)
+        assert (plans == expected).all()
+
     def test_convert_binary_bracketing(self):
         given = "( 0 ( ( 1 2 ) 3 ) ) )"
         expected_tokens = [str(x) for x in range(4)]
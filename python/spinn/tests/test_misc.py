@@ -1,9 +1,13 @@
 import unittest
 
+import numpy as np
 
 # PyTorch
 
-from spinn.util.misc import Accumulator
+from spinn.util.misc import Accumulator, LRUCache, Profiler
+from spinn.util.logging import train_accumulate, timing_stats, TIMING_STAGES
+from spinn.util.logging import eval_stats, get_weighted_avg
+import spinn.util.logging_pb2 as pb
 
 
 class MiscTestCase(unittest.TestCase):
@@ -17,6 +21,63 @@ class MiscTestCase(unittest.TestCase):
         assert len(A.get('key')) == 2
         assert len(A.get('key')) == 0
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+
+        # 'b' is now the least recently used entry.
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_train_timing(self):
+        A = Accumulator()
+        timer = Profiler(enabled=True)
+        y_batch = np.zeros(4, dtype=np.int64)
+        batch = (None, None, y_batch, None, None, None)
+
+        for elapsed in [1.0, 3.0]:
+            timer.reset()
+            timer.stop('forward', timer.start() - elapsed)
+            train_accumulate(object(), A, batch, timer)
+
+        assert sum(A.get('total_examples')) == 8
+        forward = A.get('timing_forward')
+        assert np.isclose(np.mean(forward), 2.0, atol=1e-2)
+        for key in TIMING_STAGES:
+            if key != 'forward':
+                assert sum(A.get('timing_' + key)) == 0.0
+
+        # Eval and checkpoint times are only logged for the step they ran in.
+        log_entry = pb.SpinnEntry()
+        timing_stats(timer, log_entry)
+        assert not log_entry.timing.HasField('eval')
+        timer.stop('eval', timer.start() - 5.0)
+        timing_stats(timer, log_entry)
+        assert np.isclose(log_entry.timing.eval, 5.0, atol=1e-2)
+
+    def test_variable_batch_stats(self):
+        A = Accumulator()
+        for correct, total in [(1, 1), (10, 40)]:
+            A.add('class_correct', correct)
+            A.add('class_total', total)
+            A.add('total_examples', total)
+        A.add('total_tokens', 100)
+        A.add('total_time', 2.0)
+
+        # Accuracy is per example, not an average over batches.
+        eval_data = eval_stats(object(), A, pb.EvalData())
+        assert np.isclose(eval_data.eval_class_accuracy, 11 / 41.)
+        assert np.isclose(eval_data.examples_per_second, 20.5)
+
+        A.add('invalid', 1.0)
+        A.add('invalid', 0.0)
+        assert np.isclose(get_weighted_avg(A, 'invalid', [1, 40]), 1 / 41.)
+
 
 if __name__ == '__main__':
     unittest.main()
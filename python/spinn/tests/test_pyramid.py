@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+
+from spinn.choi_pyramid import ChoiPyramid
+
+# PyTorch
+import torch
+
+from spinn.util.test import MockModel, default_args, get_batch
+
+
+def get_ragged_batch():
+    lengths = np.array([9, 1, 2, 5, 7], dtype=np.int64)
+    X = np.zeros((len(lengths), lengths.max()), dtype=np.int32)
+    for i, n in enumerate(lengths):
+        X[i, :n] = np.arange(1, n + 1) % 13 + 1
+    return X, lengths
+
+
+class PyramidTestCase(unittest.TestCase):
+
+    def test_single_pyramid(self):
+        model = MockModel(ChoiPyramid, default_args())
+        X, transitions = get_batch()
+        outputs = model(X, transitions, example_lengths=np.array([4, 4]))
+        assert outputs.size() == (2, 3)
+
+    def test_incremental_composition(self):
+        X, lengths = get_ragged_batch()
+        model = MockModel(ChoiPyramid, default_args())
+        incremental_model = MockModel(
+            ChoiPyramid, default_args(incremental=True))
+        incremental_model.load_state_dict(model.state_dict())
+
+        # Greedy merges in eval, Gumbel samples with the same noise in
+        # training.
+        for training in [False, True]:
+            outputs, masks = [], []
+            for m in [model, incremental_model]:
+                m.train(training)
+                torch.manual_seed(3)
+                outputs.append(m(X, None, example_lengths=lengths,
+                                 store_parse_masks=True).data.numpy())
+                masks.append(m.mask_memory)
+            np.testing.assert_allclose(outputs[0], outputs[1], rtol=1e-5,
+                                       atol=1e-5)
+            for expected, mask in zip(*masks):
+                np.testing.assert_array_equal(expected, mask)
+
+        incremental_model(X, None, example_lengths=lengths).sum().backward()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,13 +7,18 @@ from spinn.spinn_core_model import BaseModel
 import spinn.spinn_core_model
 import spinn.rl_spinn
 from spinn.util.blocks import ModelTrainer
+from spinn.util.data import CompileTransitionPlans
 
 # PyTorch
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.nn.functional as F
+from torch.autograd import Variable
 
-from spinn.util.test import MockModel, default_args, get_batch, compare_models
+from spinn.data import T_SKIP
+
+from spinn.util.test import MockModel, default_args, get_batch, get_batch_pair, compare_models
 
 
 class SPINNTestCase(unittest.TestCase):
@@ -99,6 +104,254 @@ class SPINNTestCase(unittest.TestCase):
         assert outputs[0][0].data[0] == (3 - (1 - (2 - 1)))
         assert outputs[1][0].data[0] == ((3 - 2) - (4 - 5))
 
+    def test_thin_stack_matches_fat(self):
+        X, transitions = get_batch()
+        plans = CompileTransitionPlans(transitions, (X != 0).sum(1))
+
+        for use_internal_parser, transition_plans in [
+                (False, None), (False, plans), (True, None)]:
+            fat_args = default_args()
+            fat_args['composition_args'].transition_weight = 1.0
+            fat_model = MockModel(BaseModel, fat_args)
+
+            thin_args = default_args()
+            thin_args['composition_args'].transition_weight = 1.0
+            thin_args['composition_args'].stack_type = "thin"
+            thin_model = MockModel(BaseModel, thin_args)
+            thin_model.load_state_dict(fat_model.state_dict())
+
+            outputs, grads = [], []
+            for model in [fat_model, thin_model]:
+                output = model(X, transitions,
+                               use_internal_parser=use_internal_parser,
+                               transition_plans=transition_plans)
+                loss = output.sum() + model.transition_loss
+                loss.backward()
+                outputs.append(output.data.numpy())
+                grads.append([p.grad.data.numpy()
+                              for p in model.parameters() if p.grad is not None])
+
+            np.testing.assert_allclose(outputs[0], outputs[1], rtol=1e-6)
+            assert len(grads[0]) == len(grads[1])
+            for fat_grad, thin_grad in zip(*grads):
+                np.testing.assert_allclose(fat_grad, thin_grad, rtol=1e-6)
+
+    def test_level_wise_matches_fat(self):
+        X, transitions = get_batch()
+
+        fat_args = default_args()
+        fat_args['composition_args'].tracker_size = None
+        fat_args['composition_args'].use_internal_parser = False
+        fat_model = MockModel(BaseModel, fat_args)
+
+        level_args = default_args()
+        level_args['composition_args'].tracker_size = None
+        level_args['composition_args'].use_internal_parser = False
+        level_args['composition_args'].stack_type = "thin"
+        level_args['composition_args'].level_wise = True
+        level_model = MockModel(BaseModel, level_args)
+        level_model.load_state_dict(fat_model.state_dict())
+
+        fat_model(X, transitions)
+        level_model(X, transitions)
+
+        np.testing.assert_allclose(fat_model.spinn_outp[0].data.numpy(),
+                                   level_model.spinn_outp[0].data.numpy(),
+                                   rtol=1e-6)
+
+    def test_hash_cons_subtrees(self):
+        # Both trees contain ( 3 1 ), and the first one twice.
+        X = np.array([
+            [3, 1, 3, 1],
+            [3, 1, 2, 1]
+        ], dtype=np.int32)
+        transitions = np.array([
+            [0, 0, 1, 0, 0, 1, 1],
+            [0, 0, 1, 0, 1, 0, 1]
+        ], dtype=np.int32)
+
+        fat_args = default_args()
+        fat_args['composition_args'].tracker_size = None
+        fat_args['composition_args'].use_internal_parser = False
+        fat_model = MockModel(BaseModel, fat_args)
+
+        dag_args = default_args()
+        dag_args['composition_args'].tracker_size = None
+        dag_args['composition_args'].use_internal_parser = False
+        dag_args['composition_args'].stack_type = "thin"
+        dag_args['composition_args'].level_wise = True
+        dag_args['composition_args'].hash_cons = True
+        dag_model = MockModel(BaseModel, dag_args)
+        dag_model.load_state_dict(fat_model.state_dict())
+        dag_model.eval()
+
+        fat_model(X, transitions)
+        dag_model(X, transitions)
+
+        assert dag_model.spinn.subtree_stats == dict(nodes=6, composed=4)
+        np.testing.assert_allclose(fat_model.spinn_outp[0].data.numpy(),
+                                   dag_model.spinn_outp[0].data.numpy(),
+                                   rtol=1e-5, atol=1e-5)
+
+    def test_compact_active_rows(self):
+        X = np.array([
+            [3, 1, 2, 1],
+            [4, 5, 0, 0]
+        ], dtype=np.int32)
+        transitions = np.array([
+            [0, 0, 0, 0, 1, 1, 1],
+            [2, 2, 2, 2, 0, 0, 1]
+        ], dtype=np.int32)
+
+        for stack_type in ["fat", "thin"]:
+            args = default_args()
+            args['composition_args'].transition_weight = 1.0
+            args['composition_args'].stack_type = stack_type
+            args['composition_args'].compact_active_rows = True
+            model = MockModel(BaseModel, args)
+            model(X, transitions)
+            batch_logprobs = model.spinn.record.logprobs.view(
+                transitions.shape[1], X.shape[0], 2).transpose(0, 1)
+            assert model.spinn.active_fraction == 10 / 14.
+
+            # A padded example should be tracked as if it had been run alone
+            # without any padding.
+            for i, n in enumerate([7, 3]):
+                model(X[i:i + 1, :(n + 1) // 2], transitions[i:i + 1, -n:])
+                logprobs = model.spinn.record.logprobs.view(n, 1, 2).transpose(0, 1)
+                np.testing.assert_allclose(
+                    batch_logprobs[i, -n:].data.numpy(),
+                    logprobs[0].data.numpy(), rtol=1e-5)
+
+    def test_dedup_eval_sentences(self):
+        X, transitions = get_batch_pair()
+
+        model = MockModel(BaseModel, default_args(use_sentence_pair=True))
+        dedup_model = MockModel(
+            BaseModel,
+            default_args(use_sentence_pair=True, eval_encoding_cache_size=2))
+        dedup_model.load_state_dict(model.state_dict())
+        model.eval()
+        dedup_model.eval()
+
+        expected = model(X, transitions).data.numpy()
+        assert model.encoding_stats is None
+
+        # The two examples share both sentences.
+        outp = dedup_model(X, transitions).data.numpy()
+        np.testing.assert_allclose(expected, outp, rtol=1e-5, atol=1e-5)
+        assert dedup_model.encoding_stats == dict(
+            sentences=4, distinct=2, cached=0)
+
+        outp = dedup_model(X, transitions).data.numpy()
+        np.testing.assert_allclose(expected, outp, rtol=1e-5, atol=1e-5)
+        assert dedup_model.encoding_stats['cached'] == 2
+
+        # Switching modes drops encodings made with older weights.
+        dedup_model.train()
+        dedup_model.eval()
+        assert len(dedup_model.encoding_cache) == 0
+
+    def test_projection_table(self):
+        X, transitions = get_batch()
+
+        model = MockModel(BaseModel, default_args())
+        table_model = MockModel(
+            BaseModel, default_args(eval_projection_table=True))
+        table_model.load_state_dict(model.state_dict())
+        model.eval()
+        table_model.eval()
+
+        expected = model(X, transitions).data.numpy()
+        outputs = table_model(X, transitions).data.numpy()
+        np.testing.assert_allclose(expected, outputs, rtol=1e-5, atol=1e-5)
+
+        # The table is dropped in training, where the weights change.
+        table_model.train()
+        assert table_model.projection_table.table is None
+
+    def test_load_unfused_checkpoint(self):
+        X, transitions = get_batch()
+
+        unfused_args = default_args()
+        unfused_args['composition_args'].transition_weight = 1.0
+        unfused_model = MockModel(BaseModel, unfused_args)
+        unfused_trainer = ModelTrainer(
+            unfused_model, optim.SGD(unfused_model.parameters(), lr=0.1))
+
+        fused_args = default_args()
+        fused_args['composition_args'].transition_weight = 1.0
+        fused_args['composition_args'].fused_gates = True
+        fused_model = MockModel(BaseModel, fused_args)
+        fused_trainer = ModelTrainer(
+            fused_model, optim.SGD(fused_model.parameters(), lr=0.1))
+
+        temp = tempfile.NamedTemporaryFile()
+        unfused_trainer.save(temp.name, 0, 0, 0)
+        fused_trainer.load(temp.name, cpu=True)
+        temp.close()
+
+        logprobs = []
+        for model in [unfused_model, fused_model]:
+            model(X, transitions)
+            logprobs.append(model.spinn.record.logprobs.data.numpy())
+        np.testing.assert_allclose(logprobs[0], logprobs[1],
+                                   rtol=1e-5, atol=1e-6)
+
+    def test_profile_counts(self):
+        X, transitions = get_batch()
+        n_shifts = (transitions == 0).sum()
+        n_reduces = (transitions == 1).sum()
+
+        for stack_type in ["fat", "thin"]:
+            args = default_args()
+            args['composition_args'].transition_weight = 1.0
+            args['composition_args'].stack_type = stack_type
+            args['composition_args'].profile = True
+            model = MockModel(BaseModel, args)
+            model(X, transitions)
+
+            profiler = model.spinn.profiler
+            assert profiler.counts['shift_rows'] == n_shifts
+            assert profiler.counts['reduce_rows'] == n_reduces
+            for key in ['tracker', 'transition_net', 'predict_actions',
+                        'validate', 'shift_phase', 'reduce_phase', 'loss_phase']:
+                assert key in profiler.times, key
+
+        # Nothing is recorded unless profiling is turned on.
+        model = MockModel(BaseModel, default_args())
+        model(X, transitions)
+        assert len(model.spinn.profiler.times) == 0
+        assert len(model.spinn.profiler.counts) == 0
+
+    def test_masked_predictions_match_validate(self):
+        model = MockModel(BaseModel, default_args())
+
+        rng = np.random.RandomState(0)
+        n = 200
+        transitions = rng.randint(0, 3, size=n)
+        stack_lens = rng.randint(0, 4, size=n)
+        buf_lens = rng.randint(0, 3, size=n)
+        logits = rng.randn(n, 2).astype(np.float32)
+
+        _, unconstrained = F.log_softmax(
+            torch.from_numpy(logits), 1).data.max(1)
+        expected_preds, expected_invalid = model.spinn.validate_lengths(
+            transitions, unconstrained.numpy(), stack_lens, buf_lens)
+
+        transitions = torch.from_numpy(transitions)
+        must_shift = torch.from_numpy(stack_lens) < 2
+        must_reduce = torch.from_numpy(buf_lens) < 1
+        allowed = model.spinn.allowed_actions(must_shift, must_reduce)
+        _, preds, unconstrained = model.spinn.predict_actions(
+            Variable(torch.from_numpy(logits)), allowed=allowed)
+        preds = preds.masked_fill(transitions == T_SKIP, T_SKIP)
+        invalid = model.spinn.invalid_actions(
+            transitions, unconstrained, must_shift, must_reduce)
+
+        np.testing.assert_array_equal(preds.numpy(), expected_preds)
+        np.testing.assert_array_equal(invalid.numpy(), expected_invalid)
+
     def test_validate_transitions_cantskip(self):
         model = MockModel(BaseModel, default_args())
 
@@ -74,52 +74,107 @@ def to_cpu(var):
     return to_cuda(var, -1)
 
 
-class LSTMState:
-    """Class for intelligent LSTM state object.
+def synchronize():
+    """Wait for queued GPU work, if any, to finish."""
+    if the_gpu() >= 0:
+        torch.cuda.synchronize()
 
-    It can be initialized from either a tuple ``(c, h)`` or a single variable
-    `both`, and provides lazy attribute access to ``c``, ``h``, and ``both``.
-    Since the SPINN conducts all LSTM operations on GPU and all tensor
-    shuffling on CPU, ``c`` and ``h`` are automatically moved to GPU while
-    ``both`` is automatically moved to CPU.
 
-    Args:
-        inpt: Either a tuple of ~chainer.Variable objects``(c, h)`` or a single
-        concatenated ~chainer.Variable containing both.
+class LSTMStateBatch(object):
+    """A batch of LSTM states stored as rows of a single tensor.
+
+    It can be initialized from either a tuple ``(c, h)`` or a single variable
+    ``both`` with ``c`` and ``h`` concatenated on axis 1, and provides lazy
+    attribute access to ``c``, ``h``, and ``both``. Composition functions whose
+    state is not split into ``c`` and ``h`` only use ``both``.
 
-    Attributes:
-        c (~chainer.Variable): LSTM memory state, moved to GPU if necessary.
-        h (~chainer.Variable): LSTM hidden state, moved to GPU if necessary.
-        both (~chainer.Variable): Concatenated LSTM state, moved to CPU if
-            necessary.
+    A batch can refer to a subset of the rows of its tensor, given by
+    ``indices``. Rows are only gathered when ``c``, ``h`` or ``both`` is read,
+    so that a batch can be passed to a composition function without splitting
+    it into one variable per example.
 
+    Args:
+        inpt: Either a tuple of Variables ``(c, h)`` or a single
+            concatenated Variable containing both, each with one row per
+            state.
+        indices: LongTensor Variable with the rows of ``inpt`` in this batch,
+            or None for all of them.
     """
 
-    def __init__(self, inpt):
+    def __init__(self, inpt, indices=None):
         if isinstance(inpt, tuple):
             self._c, self._h = inpt
+            self.size = self._c.size(1)
         else:
             self._both = inpt
-            self.size = inpt.data.size()[1] // 2
+            self.size = inpt.size(1) // 2
+        self.indices = indices
+
+    @staticmethod
+    def wrap(items):
+        """Build a batch from another batch, a tensor with one state per row,
+        or an iterable of single-row states. Returns None for missing
+        states."""
+        if items is None or isinstance(items, LSTMStateBatch):
+            return items
+        if isinstance(items, (Variable, torch.Tensor)):
+            return LSTMStateBatch(items)
+        items = tuple(items)
+        if len(items) == 0 or items[0] is None:
+            return None
+        return LSTMStateBatch(torch.cat(items, 0))
+
+    def __len__(self):
+        if self.indices is not None:
+            return self.indices.size(0)
+        if hasattr(self, '_both'):
+            return self._both.size(0)
+        return self._c.size(0)
+
+    def _gather(self, x):
+        if self.indices is None:
+            return x
+        return x.index_select(0, self.indices)
 
     @property
     def h(self):
-        if not hasattr(self, '_h'):
-            self._h = to_gpu(get_h(self._both, self.size))
-        return self._h
+        if hasattr(self, '_h'):
+            return self._gather(self._h)
+        return get_h(self.both, self.size)
 
     @property
     def c(self):
-        if not hasattr(self, '_c'):
-            self._c = to_gpu(get_c(self._both, self.size))
-        return self._c
+        if hasattr(self, '_c'):
+            return self._gather(self._c)
+        return get_c(self.both, self.size)
 
     @property
     def both(self):
         if not hasattr(self, '_both'):
-            self._both = torch.cat(
-                (to_cpu(self._c), to_cpu(self._h)), 1)
-        return self._both
+            self._both = torch.cat((self._c, self._h), 1)
+        return self._gather(self._both)
+
+    def select(self, indices):
+        """The states in the given rows of this batch."""
+        if self.indices is not None:
+            indices = self.indices.index_select(0, indices)
+        selected = LSTMStateBatch.__new__(LSTMStateBatch)
+        selected.__dict__.update(self.__dict__)
+        selected.indices = indices
+        return selected
+
+    def scatter(self, indices, values):
+        """A batch with the given rows of this batch replaced by ``values``,
+        another batch or a tensor of concatenated states. This batch is not
+        modified."""
+        if isinstance(values, LSTMStateBatch):
+            values = values.both
+        return LSTMStateBatch(self.both.index_copy(0, indices, values))
+
+    def unbundle(self):
+        """Split the batch into a tuple of single-row concatenated states."""
+        both = self.both
+        return torch.chunk(both, both.size(0), 0)
 
 
 def get_h(state, hidden_dim):
@@ -134,51 +189,6 @@ def get_state(c, h):
     return torch.cat([h, c], 1)
 
 
-def bundle(lstm_iter):
-    """Bundle an iterable of concatenated LSTM states into a batched LSTMState.
-
-    Used between CPU and GPU computation. Reversed by :func:`~unbundle`.
-
-    Args:
-        lstm_iter: Iterable of ``B`` ~chainer.Variable objects, each with
-            shape ``(1,2*S)``, consisting of ``c`` and ``h`` concatenated on
-            axis 1.
-
-    Returns:
-        state: :class:`~LSTMState` object, with ``c`` and ``h`` attributes
-            each with shape ``(B,S)``.
-    """
-    if lstm_iter is None:
-        return None
-    lstm_iter = tuple(lstm_iter)
-    if lstm_iter[0] is None:
-        return None
-    return LSTMState(torch.cat(lstm_iter, 0))
-
-
-def unbundle(state):
-    """Unbundle a batched LSTM state into a tuple of concatenated LSTM states.
-
-    Used between GPU and CPU computation. Reversed by :func:`~bundle`.
-
-    Args:
-        state: :class:`~LSTMState` object, with ``c`` and ``h`` attributes
-            each with shape ``(B,S)``, or an ``inpt`` to
-            :func:`~LSTMState.__init__` that would produce such an object.
-
-    Returns:
-        lstm_iter: Iterable of ``B`` ~chainer.Variable objects, each with
-            shape ``(1,2*S)``, consisting of ``c`` and ``h`` concatenated on
-            axis 1.
-    """
-    if state is None:
-        return itertools.repeat(None)
-    if not isinstance(state, LSTMState):
-        state = LSTMState(state)
-    return torch.chunk(
-        state.both, state.both.data.size()[0], 0)
-
-
 def extract_gates(x, n):
     r = x.view(x.size(0), x.size(1) // n, n)
     return [r[:, :, i] for i in range(n)]
@@ -257,14 +267,18 @@ class ReduceTreeGRU(nn.Module):
                 3 * size)
 
     def forward(self, left, right, tracking=None):
+        """The children and the tracking state are either
+        :class:`~LSTMStateBatch` objects, in which case the output is one too,
+        or iterables of single-row states, in which case the output is a tuple
+        of single-row states."""
         def slice_gate(gate_data, hidden_dim, i):
             return gate_data[:, i * hidden_dim:(i + 1) * hidden_dim]
 
-        batch_size = len(left)
+        batched = isinstance(left, LSTMStateBatch)
         size = self.size
 
-        left = torch.cat(left, 0)
-        right = torch.cat(right, 0)
+        left = LSTMStateBatch.wrap(left).both
+        right = LSTMStateBatch.wrap(right).both
         hprev = left + right
 
         W = self.W(hprev)
@@ -272,7 +286,7 @@ class ReduceTreeGRU(nn.Module):
         c = 0
 
         if hasattr(self, "U"):
-            tracking = bundle(tracking)
+            tracking = LSTMStateBatch.wrap(tracking)
             U = self.U(tracking.h)
             Ur, Uz, Uc = [slice_gate(U, size, i) for i in range(3)]
             r = Ur + r
@@ -284,7 +298,8 @@ class ReduceTreeGRU(nn.Module):
         c = F.tanh(c + self.Vl(left * r) + self.Vr(right * r))
         h = hprev + z * (c - hprev)
 
-        return torch.chunk(h, batch_size, 0)
+        out = LSTMStateBatch(h)
+        return out if batched else out.unbundle()
 
 
 def treelstm(c_left, c_right, gates):
@@ -351,8 +366,13 @@ class ModelTrainer(object):
         ) and 'baseline' not in model_state_dict:
             model_state_dict['baseline'] = torch.FloatTensor([0.0])
 
+        # Checkpoints saved without fused layers are re-packed, which leaves
+        # the saved optimizer state unusable.
+        repacked = repack_state_dict(self.model, model_state_dict)
+
         self.model.load_state_dict(model_state_dict)
-        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if not repacked:
+            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
         if 'best_dev_step' in checkpoint:
             best_dev_step = checkpoint['best_dev_step']
@@ -401,8 +421,13 @@ class ModelTrainer_ES(object):
         ) and 'baseline' not in model_state_dict:
             model_state_dict['baseline'] = torch.FloatTensor([0.0])
 
+        # Checkpoints saved without fused layers are re-packed, which leaves
+        # the saved optimizer state unusable.
+        repacked = repack_state_dict(self.model, model_state_dict)
+
         self.model.load_state_dict(model_state_dict)
-        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if not repacked:
+            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
         if 'best_dev_step' in checkpoint:
             best_dev_step = checkpoint['best_dev_step']
@@ -432,6 +457,53 @@ class Embed(nn.Module):
 
         return embeds
 
+    def weights(self):
+        '''The embeddings of the whole vocabulary.'''
+        if self.vectors is None:
+            return self.embed.weight
+        return to_gpu(Variable(torch.from_numpy(self.vectors), volatile=True))
+
+
+class TokenTable(object):
+    '''The encoded embedding of every token in the vocabulary, for an encoder
+    that sees one token at a time. In eval, looking tokens up here replaces
+    the embedding lookup and the encoder. The table is computed on first use,
+    and the owner clears it whenever the weights may have changed.'''
+
+    def __init__(self, embed, encode):
+        self.embed = embed
+        self.encode = encode
+        self.table = None
+
+    def clear(self):
+        self.table = None
+
+    def get(self):
+        if self.table is None:
+            self.table = self.encode(self.embed.weights()).data
+        return self.table
+
+    def lookup(self, tokens):
+        '''Encoded embeddings of a (B, L) Variable of tokens, flattened to
+        (B * L, size) as they come out of the encoder.'''
+        return Variable(self.get().index_select(
+            0, tokens.data.contiguous().view(-1).long()), volatile=True)
+
+    def bag_of_words(self, tokens):
+        '''Sums of the encoded embeddings of each row of tokens, computed as
+        a sparse (B, vocab) matrix of token counts times the table.'''
+        tokens = tokens.data.contiguous().long()
+        batch_size, seq_length = tokens.size()
+        rows = torch.arange(0, batch_size, out=tokens.new()).unsqueeze(
+            1).expand(batch_size, seq_length)
+        indices = torch.stack([rows.contiguous().view(-1), tokens.view(-1)])
+        table = self.get()
+        sparse = torch.cuda.sparse if table.is_cuda else torch.sparse
+        counts = sparse.FloatTensor(
+            indices, table.new(indices.size(1)).fill_(1),
+            torch.Size([batch_size, table.size(0)]))
+        return Variable(torch.mm(counts, table), volatile=True)
+
 
 class GRU(nn.Module):
     def __init__(self, inp_dim, model_dim, num_layers=1,
@@ -483,70 +555,57 @@ class IntraAttention(nn.Module):
         self.distance_bias = distance_bias
         self.f = nn.Linear(inp_size, outp_size)
 
-    def d(self, batch_size, seq_len, max_distance=10, scale=0.01):
+        # Distance bias matrices, by sequence length.
+        self.bias_cache = dict()
+
+    def d(self, seq_len, max_distance=10, scale=0.01):
         """
         Generates a bias term based on distance. Something like:
 
-        [[[0, 1, 2, 3],
-          [1, 0, 1, 2],
-          [2, 1, 0, 1],
-          ...
-          ],
-         [[0, 1, 2, 3],
-          [1, 0, 1, 2],
-          [2, 1, 0, 1],
-          ...
-          ],
-          ...
+        [[0, 1, 2, 3],
+         [1, 0, 1, 2],
+         [2, 1, 0, 1],
+         ...
          ]
 
+        The matrix only depends on the sequence length, so it is built once
+        per length and shared across the batch.
         """
 
-        bias = torch.range(
-            0,
-            seq_len -
-            1).float().unsqueeze(0).repeat(
-            seq_len,
-            1)
-        diff = torch.range(0, seq_len - 1).float().unsqueeze(1)
-        bias = (bias - diff).abs()
-        bias = bias.clamp(0, max_distance)
+        if seq_len not in self.bias_cache:
+            bias = torch.arange(0, seq_len).float().unsqueeze(0).repeat(
+                seq_len, 1)
+            diff = torch.arange(0, seq_len).float().unsqueeze(1)
+            bias = (bias - diff).abs()
+            bias = bias.clamp(0, max_distance)
 
-        bias = bias * scale
+            bias = bias * scale
 
-        bias = bias.unsqueeze(0).expand(batch_size, seq_len, seq_len)
-        bias = bias.contiguous()
+            self.bias_cache[seq_len] = to_gpu(bias)
 
-        bias = to_gpu(Variable(bias, volatile=not self.training))
-
-        return bias
+        return Variable(self.bias_cache[seq_len], volatile=not self.training)
 
     def forward(self, x):
-        hidden_dim = self.outp_size
         batch_size, seq_len, _ = x.size()
 
         f = self.f(x.view(batch_size * seq_len, -1)
                    ).view(batch_size, seq_len, -1)
 
-        f_broadcast = f.unsqueeze(1).expand(
-            batch_size, seq_len, seq_len, hidden_dim)
-
-        # assert f_broadcast[0, 0, 0, :] == f_broadcast[0, 1, 0, :]
-
         e = torch.bmm(f, f.transpose(1, 2))
-        e = e.view(batch_size * seq_len, seq_len)
 
         if self.distance_bias:
-            d = self.d(batch_size, seq_len).view(batch_size * seq_len, seq_len)
+            d = self.d(seq_len).unsqueeze(0).expand(
+                batch_size, seq_len, seq_len)
             e = e + d
 
-        e = F.softmax(e)
-        e = e.view(batch_size, seq_len, seq_len, 1)
-        e = e
+        e = F.softmax(e.view(batch_size * seq_len, seq_len))
+        e = e.view(batch_size, seq_len, seq_len)
 
-        # assert e[0, 0, :, 0].sum() == 1
+        # assert e[0, 0, :].sum() == 1
 
-        a = (f_broadcast * e).sum(2).squeeze()
+        # Each position attends over every position of its sequence, as a
+        # batched matmul rather than a (B, L, L, H) broadcast.
+        a = torch.bmm(e, f)
 
         return a
 
@@ -652,24 +711,41 @@ class ReduceTreeLSTM(nn.Module):
             tracker is present.
         use_tracking_in_composition: If specified, use the tracking state as input.
         composition_ln: Whether to use layer normalization.
+        fused: Whether to project all inputs with a single FusedLinear.
     """
 
     def __init__(self, size, tracker_size=None,
-                 use_tracking_in_composition=None, composition_ln=True):
+                 use_tracking_in_composition=None, composition_ln=True,
+                 fused=False):
         super(ReduceTreeLSTM, self).__init__()
         self.composition_ln = composition_ln
-        self.left = Linear(initializer=HeKaimingInitializer)(size, 5 * size)
-        self.right = Linear(
-            initializer=HeKaimingInitializer)(
-            size, 5 * size, bias=False)
+        self.fused = fused
+        use_tracking = tracker_size is not None and use_tracking_in_composition
+        if fused:
+            in_sizes = [size, size] + ([tracker_size] if use_tracking else [])
+            self.gates = FusedLinear(
+                in_sizes, 5 * size, initializer=HeKaimingInitializer)
+        else:
+            self.left = Linear(initializer=HeKaimingInitializer)(size, 5 * size)
+            self.right = Linear(
+                initializer=HeKaimingInitializer)(
+                size, 5 * size, bias=False)
         if composition_ln:
             self.left_ln = LayerNormalization(size)
             self.right_ln = LayerNormalization(size)
-        if tracker_size is not None and use_tracking_in_composition:
-            self.track = Linear(initializer=HeKaimingInitializer)(
-                tracker_size, 5 * size, bias=False)
+        if use_tracking:
+            if not fused:
+                self.track = Linear(initializer=HeKaimingInitializer)(
+                    tracker_size, 5 * size, bias=False)
             if composition_ln:
                 self.track_ln = LayerNormalization(tracker_size)
+        self.use_tracking = use_tracking
+
+    def repack_state_dict(self, state_dict, prefix):
+        if not self.fused:
+            return False
+        names = ['left', 'right'] + (['track'] if self.use_tracking else [])
+        return FusedLinear.pack_state_dict(state_dict, prefix, names, 'gates')
 
     def forward(self, left_in, right_in, tracking=None):
         """Perform batched TreeLSTM composition.
@@ -681,25 +757,44 @@ class ReduceTreeLSTM(nn.Module):
         The TreeLSTM has two to three inputs: the first two are the left and
         right children being composed; the third is the current state of the
         tracker LSTM if one is present in the SPINN model. All are provided
-        as iterables and batched internally into tensors.
+        either as :class:`~LSTMStateBatch` objects or as iterables that are
+        batched internally into tensors.
 
         Args:
-            left_in: Iterable of ``B`` ~chainer.Variable objects containing
-                ``c`` and ``h`` concatenated for the left child of each node
-                in the batch.
-            right_in: Iterable of ``B`` ~chainer.Variable objects containing
-                ``c`` and ``h`` concatenated for the right child of each node
-                in the batch.
-            tracking: Iterable of ``B`` ~chainer.Variable objects containing
-                ``c`` and ``h`` concatenated for the tracker LSTM state of
-                each node in the batch, or None.
+            left_in: :class:`~LSTMStateBatch` or iterable of ``B``
+                ~chainer.Variable objects containing ``c`` and ``h``
+                concatenated for the left child of each node in the batch.
+            right_in: :class:`~LSTMStateBatch` or iterable of ``B``
+                ~chainer.Variable objects containing ``c`` and ``h``
+                concatenated for the right child of each node in the batch.
+            tracking: :class:`~LSTMStateBatch` or iterable of ``B``
+                ~chainer.Variable objects containing ``c`` and ``h``
+                concatenated for the tracker LSTM state of each node in the
+                batch, or None.
 
         Returns:
-            out: Tuple of ``B`` ~chainer.Variable objects containing ``c`` and
-                ``h`` concatenated for the LSTM state of each new node.
+            out: :class:`~LSTMStateBatch` with the LSTM state of each new node
+                if ``left_in`` is one, otherwise a tuple of ``B``
+                ~chainer.Variable objects containing ``c`` and ``h``
+                concatenated for the LSTM state of each new node.
         """
-        left, right = bundle(left_in), bundle(right_in)
-        tracking = bundle(tracking)
+        batched = isinstance(left_in, LSTMStateBatch)
+        left = LSTMStateBatch.wrap(left_in)
+        right = LSTMStateBatch.wrap(right_in)
+        tracking = LSTMStateBatch.wrap(tracking)
+
+        if self.fused:
+            left_h, right_h = left.h, right.h
+            tracking_h = tracking.h if self.use_tracking else None
+            if self.composition_ln:
+                left_h, right_h = self.left_ln(left_h), self.right_ln(right_h)
+                if tracking_h is not None:
+                    tracking_h = self.track_ln(tracking_h)
+            inputs = [left_h, right_h]
+            if tracking_h is not None:
+                inputs.append(tracking_h)
+            out = LSTMStateBatch(treelstm(left.c, right.c, self.gates(*inputs)))
+            return out if batched else out.unbundle()
 
         if self.composition_ln:
             lstm_in = self.left(self.left_ln(left.h))
@@ -714,7 +809,8 @@ class ReduceTreeLSTM(nn.Module):
             else:
                 lstm_in += self.track(tracking.h)
 
-        return unbundle(treelstm(left.c, right.c, lstm_in))
+        out = LSTMStateBatch(treelstm(left.c, right.c, lstm_in))
+        return out if batched else out.unbundle()
 
 
 class SimpleTreeLSTM(nn.Module):
@@ -854,3 +950,77 @@ def Linear(initializer=DefaultUniformInitializer,
             if self.bias is not None:
                 bias_initializer(self.bias)
     return CustomLinear
+
+
+class FusedLinear(nn.Module):
+    """Sum of linear projections of several inputs, computed as a single
+    matrix multiply of the concatenated inputs against stacked weights.
+
+    Args:
+        in_sizes: The size of each input.
+        out_size: The size of the output.
+        bias: Whether to add a bias.
+        initializer: Applied to the weight block of each input separately, so
+            the initial weights have the same distribution as separate Linear
+            layers. May also be a list with one initializer per input.
+    """
+
+    def __init__(self, in_sizes, out_size, bias=True,
+                 initializer=DefaultUniformInitializer,
+                 bias_initializer=ZeroInitializer):
+        super(FusedLinear, self).__init__()
+        self.in_sizes = list(in_sizes)
+        self.out_size = out_size
+        self.initializer = initializer
+        self.bias_initializer = bias_initializer
+        self.weight = nn.Parameter(torch.Tensor(out_size, sum(self.in_sizes)))
+        if bias:
+            self.bias = nn.Parameter(torch.Tensor(out_size))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        initializers = self.initializer
+        if not isinstance(initializers, (list, tuple)):
+            initializers = [initializers] * len(self.in_sizes)
+        offset = 0
+        for in_size, initializer in zip(self.in_sizes, initializers):
+            block = nn.Parameter(torch.Tensor(self.out_size, in_size))
+            initializer(block)
+            self.weight.data[:, offset:offset + in_size].copy_(block.data)
+            offset += in_size
+        if self.bias is not None:
+            self.bias_initializer(self.bias)
+
+    def forward(self, *inputs):
+        return F.linear(torch.cat(inputs, 1), self.weight, self.bias)
+
+    @staticmethod
+    def pack_state_dict(state_dict, prefix, names, fused_name):
+        """Replace the weights of the separate Linear layers ``names`` under
+        ``prefix`` with the stacked weights of a FusedLinear ``fused_name``.
+        Their biases are summed. Returns whether anything was packed."""
+        weight_keys = [prefix + name + '.weight' for name in names]
+        if not all(key in state_dict for key in weight_keys):
+            return False
+        state_dict[prefix + fused_name + '.weight'] = torch.cat(
+            [state_dict.pop(key) for key in weight_keys], 1)
+        biases = [state_dict.pop(prefix + name + '.bias')
+                  for name in names if prefix + name + '.bias' in state_dict]
+        if len(biases) > 0:
+            state_dict[prefix + fused_name + '.bias'] = sum(biases)
+        return True
+
+
+def repack_state_dict(model, state_dict):
+    """Convert the parameters in a state dict saved with unfused layers to the
+    layout of the given model, in place. Returns whether anything changed, in
+    which case optimizer state saved alongside no longer lines up with the
+    model's parameters."""
+    repacked = False
+    for prefix, module in model.named_modules():
+        if hasattr(module, 'repack_state_dict'):
+            prefix = prefix + '.' if prefix else prefix
+            repacked = module.repack_state_dict(state_dict, prefix) or repacked
+    return repacked
@@ -4,6 +4,14 @@ import random
 import itertools
 import time
 import sys
+import os
+import json
+import hashlib
+import shutil
+import multiprocessing
+import threading
+import traceback
+import Queue
 
 import numpy as np
 
@@ -72,123 +80,210 @@ def TrimDataset(dataset, seq_length, eval_mode=False,
             return trimmed_dataset
 
 
-def TokensToIDs(vocabulary, dataset, sentence_pair_data=False):
-    """Replace strings in original boolean dataset with token IDs."""
+class Vocabulary(object):
+    """Maps tokens to IDs. If the vocabulary has an UNK token, a token that
+    is missing falls back to its lowercased form, then to its uppercased
+    form, then to UNK. Otherwise missing tokens raise a KeyError.
+
+    Every distinct token is resolved once, the first time it is looked up,
+    and the result is cached, so that mapping a corpus costs one dict lookup
+    per token.
+    """
+
+    # How a token was resolved.
+    EXACT, LOWER, UPPER, UNK = range(4)
+
+    class Cache(dict):
+        def __init__(self, vocabulary):
+            super(Vocabulary.Cache, self).__init__()
+            self.vocabulary = vocabulary
+
+        def __missing__(self, token):
+            code = self.vocabulary.resolve(token)
+            self[token] = code
+            return code
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.has_unk = UNK_TOKEN in ids
+        self.cache = Vocabulary.Cache(self)
+
+    def resolve(self, token):
+        """Returns the ID of a token and how it was found, packed into one
+        integer as 4 * ID + kind."""
+        if token in self.ids:
+            return 4 * self.ids[token] + self.EXACT
+        if not self.has_unk:
+            raise KeyError(token)
+        if token.lower() in self.ids:
+            return 4 * self.ids[token.lower()] + self.LOWER
+        if token.upper() in self.ids:
+            return 4 * self.ids[token.upper()] + self.UPPER
+        return 4 * self.ids[UNK_TOKEN] + self.UNK
+
+    def codes(self, tokens):
+        """Returns the packed IDs and kinds of a list of tokens."""
+        return np.array(map(self.cache.__getitem__, tokens), dtype=np.int64)
+
+    def lookup(self, tokens):
+        """Returns the IDs of a list of tokens as an array, and the number of
+        tokens resolved in each way."""
+        codes = self.codes(tokens)
+        return codes >> 2, np.bincount(codes & 3, minlength=4)
+
+
+# The Vocabulary and tokens read by worker processes of TokensToIDs. Set
+# before the workers are forked, so that they are inherited rather than
+# pickled, and only the resulting IDs are sent back.
+_worker_state = None
+
+
+def _WorkerCodes(span):
+    vocabulary, tokens = _worker_state
+    return vocabulary.codes(tokens[span[0]:span[1]])
+
+
+def TokensToIDs(vocabulary, dataset, sentence_pair_data=False,
+                num_workers=0):
+    """Replace strings in original boolean dataset with token IDs.
+
+    vocabulary may be a dict or a Vocabulary, which reuses the tokens it has
+    already resolved. If num_workers > 0, the lookups are split between a
+    pool of worker processes."""
+    global _worker_state
+
     if sentence_pair_data:
         keys = ["premise_tokens", "hypothesis_tokens"]
     else:
         keys = ["tokens"]
+    if not isinstance(vocabulary, Vocabulary):
+        vocabulary = Vocabulary(vocabulary)
+
+    tokens = list(itertools.chain.from_iterable(
+        example[key] for key in keys for example in dataset))
+    if num_workers > 0:
+        _worker_state = (vocabulary, tokens)
+        pool = multiprocessing.Pool(num_workers)
+        chunk_size = max(1, -(-len(tokens) // num_workers))
+        codes = np.concatenate([np.zeros(0, dtype=np.int64)] + pool.map(
+            _WorkerCodes, [(i, i + chunk_size)
+                           for i in range(0, len(tokens), chunk_size)]))
+        pool.close()
+        pool.join()
+        _worker_state = None
+    else:
+        codes = vocabulary.codes(tokens)
+    ids = (codes >> 2).tolist()
+    kinds = codes & 3
 
-    tokens = 0
-    unks = 0
-    lowers = 0
-    raises = 0
-
+    counts = np.zeros(4, dtype=np.int64)
+    offset = 0
     for key in keys:
-        if UNK_TOKEN in vocabulary:
-            unk_id = vocabulary[UNK_TOKEN]
-            for example in dataset:
-                for i, token in enumerate(example[key]):
-                    if token in vocabulary:
-                        example[key][i] = vocabulary[token]
-                    elif token.lower() in vocabulary:
-                        example[key][i] = vocabulary[token.lower()]
-                        lowers += 1
-                    elif token.upper() in vocabulary:
-                        example[key][i] = vocabulary[token.upper()]
-                        raises += 1
-                    else:
-                        example[key][i] = unk_id
-                        unks += 1
-                    tokens += 1
-            print "Unk rate {:2.6f}%, downcase rate {:2.6f}%, upcase rate {:2.6f}%".format((unks * 100.0 / tokens), (lowers * 100.0 / tokens), (raises * 100.0 / tokens))
-        else:
-            for example in dataset:
-                example[key] = [vocabulary[token]
-                                for token in example[key]]
+        start = offset
+        for example in dataset:
+            num_tokens = len(example[key])
+            example[key] = ids[offset:offset + num_tokens]
+            offset += num_tokens
+        counts += np.bincount(kinds[start:offset], minlength=4)
+
+        if vocabulary.has_unk and counts.sum() > 0:
+            total = float(counts.sum())
+            print "Unk rate {:2.6f}%, downcase rate {:2.6f}%, upcase rate {:2.6f}%".format(
+                counts[Vocabulary.UNK] * 100.0 / total,
+                counts[Vocabulary.LOWER] * 100.0 / total,
+                counts[Vocabulary.UPPER] * 100.0 / total)
     return dataset
 
 
-def CropAndPadExample(
-        example,
-        padding_amount,
-        target_length,
-        key,
+def RaggedArray(dataset, key):
+    """Flattens the sequences stored under key in every example into one
+    array, such that flat[offsets[i]:offsets[i + 1]] is the i-th sequence."""
+    lengths = np.array([len(example[key]) for example in dataset],
+                       dtype=np.int64)
+    offsets = np.zeros(len(dataset) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.fromiter(itertools.chain.from_iterable(
+        example[key] for example in dataset), dtype=np.int32, count=offsets[-1])
+    return flat, offsets
+
+
+def CropAndPadRagged(
+        flat,
+        begins,
+        ends,
+        length,
         symbol=0,
-        logger=None,
         allow_cropping=False,
         pad_from_left=True):
     """
-    Crop/pad a sequence value of the given dict `example`.
+    Crop/pad every sequence flat[begins[i]:ends[i]] of a ragged array to
+    exactly length items, and return them as rows of a matrix. Padding and
+    cropping both happen on the left if pad_from_left, and on the right
+    otherwise.
     """
-    if padding_amount < 0:
-        if not allow_cropping:
-            raise NotImplementedError(
-                "Cropping not allowed. "
-                "Please set seq_length and eval_seq_length to some sufficiently large value or (for non-SPINN models) use --allow_cropping and --allow_eval_cropping..")
-        # Crop, then pad normally.
-        if pad_from_left:
-            example[key] = example[key][-padding_amount:]
-        else:
-            example[key] = example[key][:-padding_amount]
-        padding_amount = 0
-    alternate_side_padding = target_length - \
-        (padding_amount + len(example[key]))
+    if not allow_cropping and (ends - begins > length).any():
+        raise NotImplementedError(
+            "Cropping not allowed. "
+            "Please set seq_length and eval_seq_length to some sufficiently large value or (for non-SPINN models) use --allow_cropping and --allow_eval_cropping..")
     if pad_from_left:
-        example[key] = ([symbol] * padding_amount) + \
-            example[key] + ([symbol] * alternate_side_padding)
+        begins = np.maximum(begins, ends - length)
+        lengths = ends - begins
+        starts = length - lengths
     else:
-        example[key] = ([symbol] * alternate_side_padding) + \
-            example[key] + ([symbol] * padding_amount)
+        ends = np.minimum(ends, begins + length)
+        lengths = ends - begins
+        starts = np.zeros_like(lengths)
+
+    # Copy every kept item to its row and column at once.
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,
+                                                  lengths)
+    padded = np.full((len(lengths), length), symbol, dtype=flat.dtype)
+    padded[rows, np.repeat(starts, lengths) + within] = \
+        flat[np.repeat(begins, lengths) + within]
+    return padded
 
 
 def CropAndPadForSPINN(dataset, length, logger=None,
                        sentence_pair_data=False, allow_cropping=False):
-    # NOTE: This can probably be done faster in NumPy if it winds up making a
-    # difference.
+    """Returns the padded tokens, the padded transitions and the number of
+    transitions of every example. For sentence pairs, the two sentences are
+    stacked along the last axis."""
     # Always make sure that the transitions are aligned at the left edge, so
     # the final stack top is the root of the tree. If cropping is used, it should
     # just introduce empty nodes into the tree.
     if sentence_pair_data:
-        keys = [
-            ("premise_transitions",
-             "num_premise_transitions",
-             "premise_tokens"),
-            ("hypothesis_transitions",
-             "num_hypothesis_transitions",
-             "hypothesis_tokens")]
+        keys = [("premise_transitions", "premise_tokens"),
+                ("hypothesis_transitions", "hypothesis_tokens")]
     else:
-        keys = [("transitions", "num_transitions", "tokens")]
-
-    for example in dataset:
-        for (transitions_key, num_transitions_key, tokens_key) in keys:
-            # Crop and Pad Transitions
-            example[num_transitions_key] = len(example[transitions_key])
-            transitions_padding_amount = length - example[num_transitions_key]
-            shifts_before_crop_and_pad = example[transitions_key].count(0)
-            if transitions_key in example:
-                CropAndPadExample(
-                    example,
-                    transitions_padding_amount,
-                    length,
-                    transitions_key,
-                    symbol=T_SKIP,
-                    logger=logger,
-                    allow_cropping=allow_cropping)
-            shifts_after_crop_and_pad = example[transitions_key].count(0)
-
-            # Crop and Pad Tokens
-            tokens_padding_amount = shifts_after_crop_and_pad - \
-                shifts_before_crop_and_pad
-            CropAndPadExample(
-                example,
-                tokens_padding_amount,
-                length,
-                tokens_key,
-                symbol=SENTENCE_PADDING_SYMBOL,
-                logger=logger,
-                allow_cropping=allow_cropping)
-    return dataset
+        keys = [("transitions", "tokens")]
+
+    X, transitions, num_transitions = [], [], []
+    for transitions_key, tokens_key in keys:
+        # Crop and Pad Transitions
+        flat, offsets = RaggedArray(dataset, transitions_key)
+        begins, ends = offsets[:-1], offsets[1:]
+        transitions.append(CropAndPadRagged(
+            flat, begins, ends, length, symbol=T_SKIP,
+            allow_cropping=allow_cropping))
+        num_transitions.append((ends - begins).astype(np.int32))
+
+        # Crop the tokens shifted by cropped transitions, and pad on the
+        # right.
+        shifts = np.concatenate([[0], np.cumsum(flat == T_SHIFT)])
+        cropped_shifts = shifts[np.maximum(begins, ends - length)] - \
+            shifts[begins]
+        flat, offsets = RaggedArray(dataset, tokens_key)
+        begins, ends = offsets[:-1], offsets[1:]
+        X.append(CropAndPadRagged(
+            flat, np.minimum(begins + cropped_shifts, ends), ends, length,
+            symbol=SENTENCE_PADDING_SYMBOL, allow_cropping=allow_cropping,
+            pad_from_left=False))
+
+    if sentence_pair_data:
+        return (np.stack(X, axis=2), np.stack(transitions, axis=2),
+                np.stack(num_transitions, axis=1))
+    return X[0], transitions[0], num_transitions[0]
 
 
 def CropAndPadSimple(
@@ -198,37 +293,181 @@ def CropAndPadSimple(
         sentence_pair_data=False,
         allow_cropping=True,
         pad_from_left=True):
-    # NOTE: This can probably be done faster in NumPy if it winds up making a
-    # difference.
+    """Returns the padded tokens of every example. For sentence pairs, the
+    two sentences are stacked along the last axis."""
     if sentence_pair_data:
         keys = ["premise_tokens",
                 "hypothesis_tokens"]
     else:
         keys = ["tokens"]
 
-    for example in dataset:
-        for tokens_key in keys:
-            num_tokens = len(example[tokens_key])
-            tokens_padding_amount = length - num_tokens
-            CropAndPadExample(
-                example,
-                tokens_padding_amount,
-                length,
-                tokens_key,
-                symbol=SENTENCE_PADDING_SYMBOL,
-                logger=logger,
-                allow_cropping=allow_cropping,
-                pad_from_left=pad_from_left)
-    return dataset
+    X = []
+    for tokens_key in keys:
+        flat, offsets = RaggedArray(dataset, tokens_key)
+        X.append(CropAndPadRagged(
+            flat, offsets[:-1], offsets[1:], length,
+            symbol=SENTENCE_PADDING_SYMBOL, allow_cropping=allow_cropping,
+            pad_from_left=pad_from_left))
+
+    if sentence_pair_data:
+        return np.stack(X, axis=2)
+    return X[0]
+
+
+def CompileTransitionPlans(transitions, num_tokens):
+    """Precompute the stack items read at every step of the given parses.
+
+    Simulates the SPINN stack for all examples at once, following the same
+    rules as the model: SHIFT on an empty buffer pushes zeros, and REDUCE on a
+    short stack composes zeros. Items are encoded as local slots: 0 is the
+    zero vector, 1 + i is the i-th token of the example, and -(1 + k) is the
+    node created by its k-th REDUCE.
+
+    Args:
+        transitions: ``(N, T)`` array of left-padded transitions.
+        num_tokens: ``(N,)`` array with the number of tokens in each example.
 
+    Returns:
+        plans: ``(N, T, 2)`` int16 array with the top and second item of the
+            stack before each step. These are the right and left children of
+            a REDUCE.
+    """
+    num_examples, num_steps = transitions.shape
+    rows = np.arange(num_examples)
+
+    plans = np.zeros((num_examples, num_steps, 2), dtype=np.int16)
+    stacks = np.zeros((num_examples, num_steps + 2), dtype=np.int16)
+    stack_lens = np.full(num_examples, 2, dtype=np.int64)
+    cursor = np.zeros(num_examples, dtype=np.int64)
+    num_reduces = np.zeros(num_examples, dtype=np.int64)
+
+    for t in range(num_steps):
+        plans[:, t, 0] = np.where(
+            stack_lens > 0, stacks[rows, np.maximum(stack_lens - 1, 0)], 0)
+        plans[:, t, 1] = np.where(
+            stack_lens > 1, stacks[rows, np.maximum(stack_lens - 2, 0)], 0)
+
+        is_shift = transitions[:, t] == T_SHIFT
+        is_reduce = transitions[:, t] == T_REDUCE
+
+        shifted = np.where(cursor < num_tokens, cursor + 1, 0)
+        cursor += is_shift
+        stack_lens = np.where(
+            is_reduce, np.maximum(stack_lens - 2, 0), stack_lens)
+        num_reduces += is_reduce
+
+        acting = np.logical_or(is_shift, is_reduce)
+        stacks[rows[acting], stack_lens[acting]] = np.where(
+            is_reduce, -num_reduces, shifted)[acting]
+        stack_lens += acting
+
+    return plans
+
+
+def _SpreadBits(x):
+    # Moves bit i of each 32-bit value to bit 2i.
+    x = x.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF),
+                        (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)]:
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+
+def MortonCode(x, y):
+    """Interleaves the bits of two arrays of lengths into Z-order keys.
+
+    Sorting by the key groups examples whose two lengths are both similar. The
+    bits of x take the higher position of each pair.
+    """
+    return (_SpreadBits(np.asarray(x)) << np.uint64(1)) | _SpreadBits(
+        np.asarray(y))
+
+
+def SortKeys(num_transitions, use_peano=True):
+    # One length key per example. Sentence pairs are keyed on both lengths, or
+    # on the longer one.
+    num_transitions = np.asarray(num_transitions)
+    if num_transitions.ndim == 1:
+        return num_transitions
+    if use_peano:
+        return MortonCode(num_transitions[:, 0], num_transitions[:, 1])
+    return num_transitions.max(axis=1)
+
+
+def SplitByTokenBudget(order, lengths, token_budget):
+    """Cuts an ordering of the dataset into batches that fit a token budget.
+
+    Each batch is the longest run of order whose number of examples times the
+    longest length among them is at most token_budget. An example longer than
+    the budget gets a batch of its own. Returns a list of index arrays.
+    """
+    lengths = np.asarray(lengths)[order]
+    batches = []
+    start = 0
+    window = 64
+    while start < len(order):
+        # The cost of a batch only grows with its size, so find the cut with
+        # a binary search over a window that is doubled until it holds it.
+        while True:
+            stop = min(start + window, len(order))
+            cost = np.maximum.accumulate(lengths[start:stop]) * \
+                np.arange(1, stop - start + 1)
+            rows = max(1, np.searchsorted(cost, token_budget, side='right'))
+            if rows < stop - start or stop == len(order):
+                break
+            window *= 2
+        batches.append(order[start:start + rows])
+        start += rows
+        window = max(64, 2 * rows)
+    return batches
 
-def Merge(x, y):
-    return ''.join([a for t in zip(x, y) for a in t])
 
+def MakeBatchPlan(dataset_size, batch_size, keys=None, num_splits=10,
+                  rng=np.random, lengths=None, token_budget=None):
+    """Draws an epoch of training batches as an index array.
 
-def Peano(x, y):
-    interim = ''.join(Merge(format(x, '08b'), format(y, '08b')))
-    return int(interim, base=2)
+    Returns an int array of shape (num_batches, batch_size) whose rows index the
+    dataset, in the order they should be trained on. Examples that do not fill
+    a batch are dropped, and a different random subset is dropped each epoch.
+
+    Without keys, the batches are a random permutation of the dataset. With
+    keys, the shuffled dataset is dealt into num_splits equal splits, each
+    split is sorted by key and cut into batches, and the batches are shuffled,
+    so that each batch holds examples of similar length. More splits make the
+    batches more random in content and less uniform in length.
+
+    With a token_budget, the splits are instead cut by SplitByTokenBudget on
+    the example lengths, no examples are dropped, and the plan is a list of
+    index arrays of varying size.
+    """
+    order = rng.permutation(dataset_size)
+    if token_budget:
+        if keys is None:
+            splits = [order]
+        else:
+            keys = np.asarray(keys)
+            splits = [split[np.argsort(keys[split], kind='mergesort')]
+                      for split in np.array_split(order, num_splits)]
+        plan = [batch for split in splits
+                for batch in SplitByTokenBudget(split, lengths, token_budget)]
+        return [plan[i] for i in rng.permutation(len(plan))]
+
+    if keys is None:
+        num_batches = dataset_size // batch_size
+        return order[:num_batches * batch_size].reshape(num_batches, batch_size)
+
+    num_splits = max(1, min(num_splits, dataset_size // batch_size))
+    split_size = dataset_size // num_splits
+    order = order[:num_splits * split_size].reshape(num_splits, split_size)
+    # A stable sort, so that ties keep their shuffled order.
+    ranks = np.argsort(np.asarray(keys)[order], axis=1, kind='mergesort')
+    order = order[np.arange(num_splits)[:, np.newaxis], ranks]
+    batches_per_split = split_size // batch_size
+    plan = order[:, :batches_per_split * batch_size].reshape(-1, batch_size)
+    return plan[rng.permutation(len(plan))]
 
 
 def MakeTrainingIterator(
@@ -237,87 +476,127 @@ def MakeTrainingIterator(
         smart_batches=True,
         use_peano=True,
         sentence_pair_data=True,
-        pad_from_left=True):
-    # Make an iterator that exposes a dataset as random minibatches.
+        pad_from_left=True,
+        num_splits=10,
+        token_budget=None):
+    # Make an iterator that exposes a dataset as random minibatches. The sort
+    # keys are computed once, and each epoch is planned with MakeBatchPlan.
+    dataset_size = len(sources[0])
+    if dataset_size < batch_size and not token_budget:
+        raise ValueError("The training set has %d examples, fewer than one "
+                         "batch of %d." % (dataset_size, batch_size))
+    if smart_batches:
+        keys = SortKeys(sources[3], use_peano and sentence_pair_data)
+    else:
+        keys = None
+    lengths = SortKeys(sources[3], use_peano=False) if token_budget else None
 
-    def get_key(num_transitions):
-        if use_peano and sentence_pair_data:
-            prem_len, hyp_len = num_transitions
-            key = Peano(prem_len, hyp_len)
-            return key
-        else:
-            if not isinstance(num_transitions, list):
-                num_transitions = [num_transitions]
-            return max(num_transitions)
+    def batch_iter():
+        while True:
+            plan = MakeBatchPlan(dataset_size, batch_size, keys, num_splits,
+                                 lengths=lengths, token_budget=token_budget)
+            for batch_indices in plan:
+                yield tuple(source[batch_indices] for source in sources)
 
-    def build_batches():
-        dataset_size = len(sources[0])
-        order = range(dataset_size)
-        random.shuffle(order)
-        order = np.array(order)
-
-        num_splits = 10  # TODO: Should we be smarter about split size?
-        order_limit = len(order) / num_splits * num_splits
-        order = order[:order_limit]
-        order_splits = np.split(order, num_splits)
-        batches = []
-
-        for split in order_splits:
-            # Put indices into buckets based on example length.
-            keys = []
-            for i in split:
-                num_transitions = sources[3][i]
-                key = get_key(num_transitions)
-                keys.append((i, key))
-            keys = sorted(keys, key=lambda __key: __key[1])
-
-            # Group indices from buckets into batches, so that
-            # examples in each batch have similar length.
-            batch = []
-            for i, _ in keys:
-                batch.append(i)
-                if len(batch) == batch_size:
-                    batches.append(batch)
-                    batch = []
-        return batches
+    return batch_iter()
 
-    def batch_iter():
-        batches = build_batches()
-        num_batches = len(batches)
-        idx = -1
-        order = range(num_batches)
-        random.shuffle(order)
 
-        while True:
-            idx += 1
-            if idx >= num_batches:
-                # Start another epoch.
-                batches = build_batches()
-                num_batches = len(batches)
-                idx = 0
-                order = range(num_batches)
-                random.shuffle(order)
-            batch_indices = batches[order[idx]]
-            yield tuple(source[batch_indices] for source in sources)
-
-    def data_iter():
-        dataset_size = len(sources[0])
-        start = -1 * batch_size
-        order = range(dataset_size)
-        random.shuffle(order)
+def UnwrapSentencePairBatch(batch):
+    """Stacks the premises of a sentence pair batch over its hypotheses.
+
+    The models accept tokens, transitions and plans in this layout as well as
+    with the pair on the last axis, so the copy can be made ahead of the train
+    loop. Labels, lengths and ids stay one row per pair.
+    """
+    X, transitions, y, num_transitions, example_ids, plans = batch
+    X = np.concatenate([X[:, :, 0], X[:, :, 1]], axis=0)
+    if transitions.ndim == 3 and transitions.shape[2] == 2:
+        transitions = np.concatenate(
+            [transitions[:, :, 0], transitions[:, :, 1]], axis=0)
+    if plans.ndim == 4:
+        plans = np.concatenate([plans[..., 0], plans[..., 1]], axis=0)
+    return X, transitions, y, num_transitions, example_ids, plans
+
+
+class _PrefetchError(object):
+    def __init__(self, message):
+        self.message = message
+
+
+_PREFETCH_DONE = "done"
+
+
+def _PrefetchWorker(batches, prepare, queue):
+    try:
+        for batch in batches:
+            queue.put(prepare(batch))
+        queue.put(_PREFETCH_DONE)
+    except BaseException:
+        queue.put(_PrefetchError(traceback.format_exc()))
+
 
+def MakePrefetchingIterator(batches, prepare, depth=2, use_process=False):
+    """Applies prepare to each batch of an iterator in a background worker.
+
+    Up to depth prepared batches are kept ready, so that drawing, copying and
+    truncating the next batches overlaps with the model step. The worker is a
+    daemon thread, or with use_process a forked daemon process, which also
+    takes the Python work off the trainer's interpreter at the cost of
+    pickling each batch through a pipe. Errors in the worker are raised from
+    next(). With depth 0, batches are prepared on demand with no worker.
+    """
+    if depth <= 0:
+        return itertools.imap(prepare, batches)
+
+    if use_process:
+        queue = multiprocessing.Queue(depth)
+        worker = multiprocessing.Process(
+            target=_PrefetchWorker, args=(batches, prepare, queue))
+    else:
+        queue = Queue.Queue(depth)
+        worker = threading.Thread(
+            target=_PrefetchWorker, args=(batches, prepare, queue))
+    worker.daemon = True
+    worker.start()
+
+    def prefetch_iter():
         while True:
-            start += batch_size
-            if start > dataset_size - batch_size:
-                # Start another epoch.
-                start = 0
-                random.shuffle(order)
-            batch_indices = order[start:start + batch_size]
-            yield tuple(source[batch_indices] for source in sources)
+            batch = queue.get()
+            if isinstance(batch, _PrefetchError):
+                raise RuntimeError(
+                    "Batch prefetching failed:\n" + batch.message)
+            if isinstance(batch, str) and batch == _PREFETCH_DONE:
+                return
+            yield batch
+
+    return prefetch_iter()
+
+
+class EvalBatches(object):
+    """Eval batches drawn lazily from the sources by an index plan.
+
+    Iterating yields one batch tuple at a time, so only the batch being
+    scored is copied out of the sources. Supports len, indexing and slicing,
+    so it can stand in for a list of batches, and can be iterated over again
+    for every evaluation.
+    """
+
+    def __init__(self, sources, plan):
+        self.sources = sources
+        self.plan = plan
+
+    def __len__(self):
+        return len(self.plan)
 
-    train_iter = batch_iter if smart_batches else data_iter
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EvalBatches(self.sources, self.plan[index])
+        batch_indices = self.plan[index]
+        return tuple(source[batch_indices] for source in self.sources)
 
-    return train_iter()
+    def __iter__(self):
+        for i in range(len(self.plan)):
+            yield self[i]
 
 
 def MakeEvalIterator(
@@ -326,9 +605,11 @@ def MakeEvalIterator(
         limit=None,
         shuffle=False,
         rseed=123,
-        bucket_eval=False):
+        bucket_eval=False,
+        token_budget=None):
     if bucket_eval:
-        return MakeBucketEvalIterator(sources, batch_size)[:limit]
+        return MakeBucketEvalIterator(
+            sources, batch_size, token_budget)[:limit]
     else:
         return MakeStandardEvalIterator(
             sources, batch_size, limit, shuffle, rseed)
@@ -340,79 +621,39 @@ def MakeStandardEvalIterator(
         limit=None,
         shuffle=False,
         rseed=123):
-    # Make a list of minibatches from a dataset to use as an iterator.
-    # TODO(SB): Pad out the last few examples in the eval set if they don't
-    # form a batch.
-
-    print "Warning: May be discarding eval examples at batch ends."
-
+    # Make minibatches of a dataset in order, or in a seeded random order. The
+    # last batch holds whatever examples are left over.
     dataset_size = limit if limit >= 0 else len(sources[0])
     order = range(dataset_size)
     if shuffle:
         random.seed(rseed)
         random.shuffle(order)
-    data_iter = []
-    start = -batch_size
-    while True:
-        start += batch_size
-
-        if start >= dataset_size:
-            break
-
-        batch_indices = order[start:start + batch_size]
-        candidate_batch = tuple(source[batch_indices]
-                                for source in sources)
-
-        if len(candidate_batch[0]) == batch_size:
-            data_iter.append(candidate_batch)
-        else:
-            print "Skipping " + str(len(candidate_batch[0])) + " examples."
-    return data_iter
+    order = np.array(order, dtype=np.int64)
+    plan = [order[start:start + batch_size]
+            for start in range(0, dataset_size, batch_size)]
+    return EvalBatches(sources, plan)
 
 
-def MakeBucketEvalIterator(sources, batch_size):
+def MakeBucketEvalIterator(sources, batch_size, token_budget=None):
     # Order in eval should not matter. Use batches sorted by length for speed
-    # improvement.
-
-    def single_sentence_key(num_transitions):
-        return num_transitions
-
-    def sentence_pair_key(num_transitions):
-        sent1_len, sent2_len = num_transitions
-        return Peano(sent1_len, sent2_len)
+    # improvement. With a token_budget, batches are sized to fit it instead of
+    # holding batch_size examples.
 
     dataset_size = len(sources[0])
 
     # Sort examples by length. From longest to shortest.
-    num_transitions = sources[3]
-    sort_key = sentence_pair_key if len(
-        num_transitions.shape) == 2 else single_sentence_key
-    order = sorted(zip(range(dataset_size), num_transitions),
-                   key=lambda x: sort_key(x[1]))
-    order = list(reversed(order))
-    order = [x[0] for x in order]
-
-    num_batches = dataset_size // batch_size
-    batches = []
-
-    # Roll examples into batches so they have similar length.
-    for i in range(num_batches):
-        batch_indices = order[i * batch_size:(i + 1) * batch_size]
-        batch = tuple(source[batch_indices] for source in sources)
-        batches.append(batch)
+    keys = SortKeys(sources[3])
+    order = np.argsort(keys, kind='mergesort')[::-1]
 
-    examples_leftover = dataset_size - num_batches * batch_size
-
-    # Create a short batch:
-    if examples_leftover > 0:
-        batch_indices = order[num_batches *
-                              batch_size:num_batches *
-                              batch_size +
-                              examples_leftover]
-        batch = tuple(source[batch_indices] for source in sources)
-        batches.append(batch)
-
-    return batches
+    if token_budget:
+        lengths = SortKeys(sources[3], use_peano=False)
+        plan = SplitByTokenBudget(order, lengths, token_budget)
+    else:
+        # Roll examples into batches so they have similar length. The last
+        # batch is short.
+        plan = [order[start:start + batch_size]
+                for start in range(0, dataset_size, batch_size)]
+    return EvalBatches(sources, plan)
 
 
 def PreprocessDataset(
@@ -425,7 +666,9 @@ def PreprocessDataset(
         sentence_pair_data=False,
         simple=False,
         allow_cropping=False,
-        pad_from_left=True):
+        pad_from_left=True,
+        compile_plans=False,
+        num_workers=0):
     dataset = TrimDataset(
         dataset,
         seq_length,
@@ -436,55 +679,29 @@ def PreprocessDataset(
     dataset = TokensToIDs(
         vocabulary,
         dataset,
-        sentence_pair_data=sentence_pair_data)
+        sentence_pair_data=sentence_pair_data,
+        num_workers=num_workers)
     if simple:
-        dataset = CropAndPadSimple(
+        X = CropAndPadSimple(
             dataset,
             seq_length,
             logger=logger,
             sentence_pair_data=sentence_pair_data,
             allow_cropping=allow_cropping,
             pad_from_left=pad_from_left)
+        num_transitions = (X != SENTENCE_PADDING_SYMBOL).sum(1).astype(np.int32)
+        if sentence_pair_data:
+            transitions = np.zeros((len(dataset), 2, 0))
+        else:
+            transitions = np.zeros((len(dataset), 0))
     else:
-        dataset = CropAndPadForSPINN(
+        X, transitions, num_transitions = CropAndPadForSPINN(
             dataset,
             seq_length,
             logger=logger,
             sentence_pair_data=sentence_pair_data,
             allow_cropping=allow_cropping)
 
-    if sentence_pair_data:
-        X = np.transpose(np.array([[example["premise_tokens"] for example in dataset],
-                                   [example["hypothesis_tokens"] for example in dataset]],
-                                  dtype=np.int32), (1, 2, 0))
-        if simple:
-            transitions = np.zeros((len(dataset), 2, 0))
-            num_transitions = np.transpose(np.array(
-                [[len(np.array(example["premise_tokens"]).nonzero()[0]) for example in dataset],
-                 [len(np.array(example["hypothesis_tokens"]).nonzero()[0]) for example in dataset]],
-                dtype=np.int32), (1, 0))
-        else:
-            transitions = np.transpose(np.array([[example["premise_transitions"] for example in dataset],
-                                                 [example["hypothesis_transitions"] for example in dataset]],
-                                                dtype=np.int32), (1, 2, 0))
-            num_transitions = np.transpose(np.array(
-                [[example["num_premise_transitions"] for example in dataset],
-                 [example["num_hypothesis_transitions"] for example in dataset]],
-                dtype=np.int32), (1, 0))
-    else:
-        X = np.array([example["tokens"] for example in dataset],
-                     dtype=np.int32)
-        if simple:
-            transitions = np.zeros((len(dataset), 0))
-            num_transitions = np.array(
-                [len(np.array(example["tokens"]).nonzero()[0]) for example in dataset],
-                dtype=np.int32)
-        else:
-            transitions = np.array([example["transitions"]
-                                    for example in dataset], dtype=np.int32)
-            num_transitions = np.array(
-                [example["num_transitions"] for example in dataset],
-                dtype=np.int32)
     y = np.array(
         [data_manager.LABEL_MAP[example["label"]] for example in dataset],
         dtype=np.int32)
@@ -492,7 +709,87 @@ def PreprocessDataset(
     # NP Array of Strings
     example_ids = np.array([example["example_id"] for example in dataset])
 
-    return X, transitions, y, num_transitions, example_ids
+    # Stack items read at every step, for replaying gold transitions.
+    if compile_plans:
+        if sentence_pair_data:
+            plans = np.stack([CompileTransitionPlans(
+                transitions[:, :, i], (X[:, :, i] != SENTENCE_PADDING_SYMBOL).sum(1))
+                for i in range(2)], axis=3)
+        else:
+            plans = CompileTransitionPlans(
+                transitions, (X != SENTENCE_PADDING_SYMBOL).sum(1))
+    else:
+        plans = np.zeros((len(dataset), 0))
+
+    return X, transitions, y, num_transitions, example_ids, plans
+
+
+# Arrays returned by PreprocessDataset, in order, as named in a data cache.
+DATASET_FIELDS = ["X", "transitions", "y", "num_transitions", "example_ids",
+                  "plans"]
+
+
+def DataCacheKey(paths, settings):
+    """Hashes the preprocessing settings together with the path, size and
+    modification time of every input file. Fingerprinting the files by stat
+    rather than content keeps the lookup cheap for multi-gigabyte corpora and
+    embedding files, while still invalidating the cache when a file is
+    replaced."""
+    key = hashlib.sha1()
+    key.update(json.dumps(settings, sort_keys=True))
+    for path in paths:
+        key.update(str(path))
+        if path is not None and os.path.exists(path):
+            stat = os.stat(path)
+            key.update(" {} {}".format(stat.st_size, stat.st_mtime))
+    return key.hexdigest()
+
+
+def SavePreprocessedData(path, vocabulary, training_data, eval_sets):
+    """Writes a vocabulary and the output of PreprocessDataset for the
+    training set (or None) and each (filename, data) eval set to a cache
+    directory, one .npy file per array.
+
+    The directory is written under a temporary name and renamed when
+    complete, so that concurrent jobs never read a partial cache."""
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    os.makedirs(tmp_path)
+    datasets = [("train", training_data)] + [
+        ("eval_{}".format(i), data) for i, (_, data) in enumerate(eval_sets)]
+    for name, data in datasets:
+        if data is None:
+            continue
+        os.mkdir(os.path.join(tmp_path, name))
+        for field, array in zip(DATASET_FIELDS, data):
+            np.save(os.path.join(tmp_path, name, field + ".npy"), array)
+    manifest = dict(vocabulary=vocabulary,
+                    has_training_data=training_data is not None,
+                    eval_filenames=[filename for filename, _ in eval_sets])
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another job wrote the same cache first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def LoadPreprocessedData(path, mmap_mode="r"):
+    """Reads a cache written by SavePreprocessedData. By default the arrays
+    are memory-mapped read-only, so they are paged in as batches are drawn
+    and shared between processes that load the same cache."""
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    def load(name):
+        return tuple(np.load(os.path.join(path, name, field + ".npy"),
+                             mmap_mode=mmap_mode)
+                     for field in DATASET_FIELDS)
+
+    training_data = load("train") if manifest["has_training_data"] else None
+    eval_sets = [(filename, load("eval_{}".format(i)))
+                 for i, filename in enumerate(manifest["eval_filenames"])]
+    return manifest["vocabulary"], training_data, eval_sets
 
 
 def BuildVocabulary(raw_training_data, raw_eval_sets, embedding_path,
@@ -518,8 +815,12 @@ def BuildVocabulary(raw_training_data, raw_eval_sets, embedding_path,
     # Build a vocabulary of words in the data for which we have an
     # embedding.
     assert embedding_path is not None, "Open-vocabulary models require pretrained vectors. Running with empty vocabulary."
-    vocabulary = BuildVocabularyForTextEmbeddingFile(
-        embedding_path, types_in_data, CORE_VOCABULARY)
+    if IsBinaryEmbeddingStore(embedding_path):
+        vocabulary = BuildVocabularyForBinaryEmbeddingStore(
+            embedding_path, types_in_data, CORE_VOCABULARY)
+    else:
+        vocabulary = BuildVocabularyForTextEmbeddingFile(
+            embedding_path, types_in_data, CORE_VOCABULARY)
 
     return vocabulary
 
@@ -567,6 +868,115 @@ def LoadEmbeddingsFromText(vocabulary, embedding_dim, path):
     return emb
 
 
+def LoadEmbeddings(vocabulary, embedding_dim, path):
+    """Loads embeddings from either a binary store or a GloVe-format text
+    file, depending on the extension of path."""
+    if IsBinaryEmbeddingStore(path):
+        return LoadEmbeddingsFromBinary(vocabulary, embedding_dim, path)
+    return LoadEmbeddingsFromText(vocabulary, embedding_dim, path)
+
+
+# A binary embedding store is a float32 matrix saved as foo.npy, and a UTF-8
+# text file foo.words listing the word of each row, one per line.
+def IsBinaryEmbeddingStore(path):
+    return path.endswith(".npy")
+
+
+def EmbeddingStoreWordsPath(path):
+    return os.path.splitext(path)[0] + ".words"
+
+
+def ConvertEmbeddingsToBinary(text_path, store_path):
+    """Converts a GloVe-format text vector file into a binary store. Lines
+    are parsed as in LoadEmbeddingsFromText, with the dimension taken from
+    the first line that has a vector. A word that occurs more than once keeps
+    the row of its first occurrence and the vector of its last one, as when
+    the text file is loaded directly.
+
+    Makes two passes over the text file so that the matrix can be written
+    to disk without holding it in memory."""
+    assert IsBinaryEmbeddingStore(store_path), "The store path must end in .npy."
+
+    index = {}
+    words = []
+    embedding_dim = None
+    with open(text_path, 'r') as f:
+        for line in f:
+            spl = line.rstrip("\n").split(" ")
+            if embedding_dim is None and len(spl) > 2:
+                embedding_dim = len(spl) - 1
+            if embedding_dim is None or len(spl) < embedding_dim + 1:
+                # Header row or final row
+                continue
+            word = unicode(spl[0].decode('UTF-8'))
+            if word not in index:
+                index[word] = len(words)
+                words.append(word)
+    assert embedding_dim is not None, "No word embeddings found in file."
+
+    emb = np.lib.format.open_memmap(
+        store_path, mode='w+', dtype=np.float32,
+        shape=(len(words), embedding_dim))
+    with open(text_path, 'r') as f:
+        for line in f:
+            spl = line.rstrip("\n").split(" ")
+            if len(spl) < embedding_dim + 1:
+                continue
+            row = index[unicode(spl[0].decode('UTF-8'))]
+            emb[row, :] = [float(e) for e in spl[1:embedding_dim + 1]]
+    emb.flush()
+    del emb
+
+    with open(EmbeddingStoreWordsPath(store_path), 'w') as f:
+        for word in words:
+            f.write(word.encode('UTF-8') + "\n")
+    return len(words), embedding_dim
+
+
+def LoadEmbeddingStoreIndex(path):
+    """Maps each word of a binary store to its row."""
+    with open(EmbeddingStoreWordsPath(path), 'r') as f:
+        return {unicode(line.rstrip("\n").decode('UTF-8')): row
+                for row, line in enumerate(f)}
+
+
+def BuildVocabularyForBinaryEmbeddingStore(
+        path, types_in_data, core_vocabulary):
+    """Like BuildVocabularyForTextEmbeddingFile, but looks the words of the
+    data up in the index of a binary store instead of scanning the vectors.
+    Words are numbered in the order of the original file, so the vocabulary
+    is the same as when building from the text file."""
+    index = LoadEmbeddingStoreIndex(path)
+    found = sorted((index[word], word) for word in types_in_data
+                   if word in index and word not in core_vocabulary)
+
+    vocabulary = {}
+    vocabulary.update(core_vocabulary)
+    for _, word in found:
+        vocabulary[word] = len(vocabulary)
+    return vocabulary
+
+
+def LoadEmbeddingsFromBinary(vocabulary, embedding_dim, path):
+    """Prepopulates a numpy embedding matrix indexed by vocabulary with rows
+    gathered from a memory-mapped binary store, so that only the rows of the
+    vocabulary are read from disk.
+
+    For now, values not found in the store will be set to zero."""
+    index = LoadEmbeddingStoreIndex(path)
+    store = np.load(path, mmap_mode='r')
+    assert store.shape[1] >= embedding_dim, "Embeddings in store are too small."
+
+    found = sorted((index[word], i) for word, i in vocabulary.iteritems()
+                   if word in index)
+    assert len(found) > 0, "No word embeddings of correct size found in file."
+    rows, ids = zip(*found)
+    emb = np.zeros(
+        (len(vocabulary), embedding_dim), dtype=np.float32)
+    emb[list(ids), :] = store[list(rows), :embedding_dim]
+    return emb
+
+
 class SimpleProgressBar(object):
     """ Simple Progress Bar and Timing Snippet
     """
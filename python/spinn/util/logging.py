@@ -6,12 +6,23 @@ Log format convenience methods for training spinn.
 """
 
 import numpy as np
-from spinn.util.blocks import flatten
-from spinn.util.misc import time_per_token
+from spinn.util.misc import time_per_token, per_second
 from spinn.data import T_SHIFT, T_REDUCE, T_SKIP
 from tuner_utils.yellowfin import YFOptimizer
 
 
+# Timers and counters of SPINN.profiler, in the order they are printed.
+PROFILE_PHASES = ['tracker', 'transition_net', 'predict_actions', 'validate',
+                  'pre_action', 'shift_phase', 'reduce_phase', 'loss_phase']
+PROFILE_COUNTS = ['shift_calls', 'shift_rows', 'reduce_calls', 'reduce_rows']
+
+# Stages of a training step, and the work done between steps, that are timed
+# by the train loops. Names are as printed in the Train Extra line.
+TIMING_STAGES = ['data_wait', 'forward', 'backward', 'optimizer']
+TIMING_OVERHEADS = ['eval', 'save']
+TIMING_NAMES = {'data_wait': 'wait', 'forward': 'fwd', 'backward': 'bwd',
+                'optimizer': 'opt', 'eval': 'eval', 'save': 'save'}
+
 class InspectModel(object):
     '''Examines what kind of SPINN model we are dealing with.'''
 
@@ -20,37 +31,55 @@ class InspectModel(object):
         self.has_transition_loss = hasattr(
             model, 'transition_loss') and model.transition_loss is not None
         self.has_invalid = self.has_spinn and hasattr(model.spinn, 'invalid')
+        self.has_active_fraction = self.has_spinn and hasattr(
+            model.spinn, 'active_fraction')
+        self.has_profile = self.has_spinn and hasattr(
+            model.spinn, 'profiler') and model.spinn.profiler.enabled
         self.has_policy = self.has_spinn and hasattr(model, 'policy_loss')
         self.has_value = self.has_spinn and hasattr(model, 'value_loss')
         self.has_epsilon = self.has_spinn and hasattr(model.spinn, "epsilon")
         self.has_spinn_temperature = self.has_spinn and hasattr(
             model.spinn, "temperature")
         self.has_pyramid_temperature = hasattr(model, "temperature_to_display")
+        self.has_encoding_stats = getattr(
+            model, 'encoding_stats', None) is not None
+        self.has_subtree_stats = self.has_spinn and getattr(
+            model.spinn, 'subtree_stats', None) is not None
 
 
 def inspect(model):
     return InspectModel(model)
 
 
-def train_accumulate(model, A, batch):
+def train_accumulate(model, A, batch, timer=None):
 
-    X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids = batch
+    X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids, plans_batch = batch
     im = inspect(model)
 
+    A.add('total_examples', y_batch.shape[0])
+    if timer is not None:
+        for key in TIMING_STAGES:
+            A.add('timing_' + key, timer.times.get(key, 0.0))
+
     # Accumulate stats for transition accuracy.
     if im.has_transition_loss:
-        preds = [
-            m["t_preds"] for m in model.spinn.memories if m.get(
-                't_preds', None) is not None]
-        truth = [
-            m["t_given"] for m in model.spinn.memories if m.get(
-                't_given', None) is not None]
-        A.add('preds', preds)
-        A.add('truth', truth)
+        record = model.spinn.record
+        A.add('preds', record.preds[record.steps].ravel())
+        A.add('truth', record.given[record.steps].ravel())
 
     if im.has_invalid:
         A.add('invalid', model.spinn.invalid)
 
+    if im.has_active_fraction:
+        A.add('active_fraction', model.spinn.active_fraction)
+
+    if im.has_profile:
+        profiler = model.spinn.profiler
+        for key in PROFILE_PHASES:
+            A.add('profile_' + key, profiler.times.get(key, 0.0))
+        for key in PROFILE_COUNTS:
+            A.add('profile_' + key, profiler.counts.get(key, 0))
+
 
 def train_rl_accumulate(model, A, batch):
 
@@ -68,24 +97,42 @@ def train_rl_accumulate(model, A, batch):
     A.add('adv_var_magnitude', model.stats['var_magnitude'])
 
 
+def get_weighted_avg(A, key, weights):
+    # Batches may differ in size, so weight each batch's value by its number of
+    # examples.
+    return np.average(np.array(A.get(key)), weights=weights)
+
+
 def stats(model, optimizer, A, step, log_entry):
     im = inspect(model)
 
     if im.has_transition_loss:
-        all_preds = np.array(flatten(A.get('preds')))
-        all_truth = np.array(flatten(A.get('truth')))
+        all_preds = np.concatenate(A.get('preds'))
+        all_truth = np.concatenate(A.get('truth'))
         avg_trans_acc = (all_preds == all_truth).sum() / \
             float(all_truth.shape[0])
 
-    time_metric = time_per_token(A.get('total_tokens'), A.get('total_time'))
+    total_tokens = A.get('total_tokens')
+    total_time = A.get('total_time')
+    total_examples = A.get('total_examples')
+    time_metric = time_per_token(total_tokens, total_time)
 
     log_entry.step = step
-    log_entry.class_accuracy = A.get_avg('class_acc')
+    class_correct = A.get('class_correct')
+    class_total = A.get('class_total')
+    log_entry.class_accuracy = sum(class_correct) / float(sum(class_total))
     log_entry.cross_entropy_cost = A.get_avg('xent_cost')  # not actual mean
     log_entry.l2_cost = A.get_avg('l2_cost')  # not actual mean
     if not isinstance(optimizer, YFOptimizer):
         log_entry.learning_rate = optimizer.lr
     log_entry.time_per_token_seconds = time_metric
+    log_entry.tokens_per_second = per_second(total_tokens, total_time)
+    if len(total_examples) > 0:
+        log_entry.examples_per_second = per_second(total_examples, total_time)
+    for key in TIMING_STAGES:
+        times = A.get('timing_' + key)
+        if len(times) > 0:
+            setattr(log_entry.timing, key, np.array(times).mean())
 
     total_cost = log_entry.l2_cost + log_entry.cross_entropy_cost
     if im.has_transition_loss:
@@ -94,7 +141,13 @@ def stats(model, optimizer, A, step, log_entry):
         if model.optimize_transition_loss:
             total_cost += log_entry.transition_cost
     if im.has_invalid:
-        log_entry.invalid = A.get_avg('invalid')
+        log_entry.invalid = get_weighted_avg(A, 'invalid', total_examples)
+    if im.has_active_fraction:
+        log_entry.active_fraction = get_weighted_avg(
+            A, 'active_fraction', total_examples)
+    if im.has_profile:
+        for key in PROFILE_PHASES + PROFILE_COUNTS:
+            setattr(log_entry.profile, key, A.get_avg('profile_' + key))
 
     adv_mean = np.array(A.get('adv_mean'), dtype=np.float32)
     adv_mean_magnitude = np.array(
@@ -138,24 +191,40 @@ def stats(model, optimizer, A, step, log_entry):
 
 def eval_accumulate(model, A, batch):
 
-    X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids = batch
+    X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids, plans_batch = batch
 
     im = inspect(model)
 
     # Accumulate stats for transition accuracy.
     if im.has_transition_loss:
-        preds = [
-            m["t_preds"] for m in model.spinn.memories if m.get(
-                't_preds', None) is not None]
-        truth = [
-            m["t_given"] for m in model.spinn.memories if m.get(
-                't_given', None) is not None]
-        A.add('preds', preds)
-        A.add('truth', truth)
+        record = model.spinn.record
+        A.add('preds', record.preds[record.steps].ravel())
+        A.add('truth', record.given[record.steps].ravel())
 
     if im.has_invalid:
         A.add('invalid', model.spinn.invalid)
 
+    if im.has_active_fraction:
+        A.add('active_fraction', model.spinn.active_fraction)
+
+    if im.has_encoding_stats:
+        for key in ['sentences', 'distinct', 'cached']:
+            A.add('encoding_' + key, model.encoding_stats[key])
+
+    if im.has_subtree_stats:
+        for key in ['nodes', 'composed']:
+            A.add('subtree_' + key, model.spinn.subtree_stats[key])
+
+    A.add('total_examples', y_batch.shape[0])
+
+
+def timing_stats(timer, log_entry):
+    """Records the time spent evaluating and checkpointing during a step."""
+    for key in TIMING_OVERHEADS:
+        if key in timer.times:
+            setattr(log_entry.timing, key, timer.times[key])
+    return log_entry
+
 
 def eval_stats(model, A, eval_data):
     im = inspect(model)
@@ -164,19 +233,38 @@ def eval_stats(model, A, eval_data):
     class_total = A.get('class_total')
     class_acc = sum(class_correct) / float(sum(class_total))
     eval_data.eval_class_accuracy = class_acc
+    total_examples = A.get('total_examples')
 
     if im.has_transition_loss:
-        all_preds = np.array(flatten(A.get('preds')))
-        all_truth = np.array(flatten(A.get('truth')))
+        all_preds = np.concatenate(A.get('preds'))
+        all_truth = np.concatenate(A.get('truth'))
         avg_trans_acc = (all_preds == all_truth).sum() / \
             float(all_truth.shape[0])
         eval_data.eval_transition_accuracy = avg_trans_acc
 
     if im.has_invalid:
-        eval_data.invalid = A.get_avg('invalid')
-
-    time_metric = time_per_token(A.get('total_tokens'), A.get('total_time'))
+        eval_data.invalid = get_weighted_avg(A, 'invalid', total_examples)
+    if im.has_active_fraction:
+        eval_data.active_fraction = get_weighted_avg(
+            A, 'active_fraction', total_examples)
+
+    encoding_sentences = A.get('encoding_sentences')
+    if len(encoding_sentences) > 0:
+        distinct = float(sum(A.get('encoding_distinct')))
+        eval_data.duplicate_rate = 1 - distinct / sum(encoding_sentences)
+        eval_data.cache_hit_rate = sum(A.get('encoding_cached')) / distinct
+
+    subtree_composed = A.get('subtree_composed')
+    if len(subtree_composed) > 0:
+        eval_data.subtree_dedup_ratio = sum(A.get('subtree_nodes')) / \
+            float(max(sum(subtree_composed), 1))
+
+    total_tokens = A.get('total_tokens')
+    total_time = A.get('total_time')
+    time_metric = time_per_token(total_tokens, total_time)
     eval_data.time_per_token_seconds = time_metric
+    eval_data.tokens_per_second = per_second(total_tokens, total_time)
+    eval_data.examples_per_second = per_second(total_examples, total_time)
 
     return eval_data
 
@@ -199,12 +287,19 @@ def train_format(log_entry, extra=False, rl=False):
 
     # Extra Component.
     if extra and log_entry.HasField(
-            'learning_rate') or log_entry.HasField('invalid'):
+            'learning_rate') or log_entry.HasField('invalid') or log_entry.HasField('timing'):
         stats_str += "\nTrain Extra:"
         if log_entry.HasField('learning_rate'):
             stats_str += " lr{learning_rate:.7f}"
         if log_entry.HasField('invalid'):
             stats_str += " inv{invalid:.3f}"
+        if log_entry.HasField('active_fraction'):
+            stats_str += " act{active_fraction:.3f}"
+        if log_entry.HasField('examples_per_second'):
+            stats_str += " ex/s{examples_per_second:.1f} tok/s{tokens_per_second:.1f}"
+        for key in TIMING_STAGES + TIMING_OVERHEADS:
+            if log_entry.timing.HasField(key):
+                stats_str += " " + TIMING_NAMES[key] + "{timing_" + key + ":.5f}"
 
     # RL Component.
     if rl:
@@ -218,15 +313,36 @@ def train_format(log_entry, extra=False, rl=False):
     elif hasattr(log_entry, "temperature"):
         stats_str += " Temp: {temperature:.3f}"
 
+    # Profile Component.
+    if log_entry.HasField('profile'):
+        stats_str += "\nTrain Profile:"
+        for key in PROFILE_PHASES:
+            stats_str += " " + key + " {profile_" + key + ":.5f}"
+        stats_str += " shift rows/call {shift_rows_per_call:.1f}"
+        stats_str += " reduce rows/call {reduce_rows_per_call:.1f}"
+
     return stats_str
 
 
 def eval_format(evaluation, extra=False):
     eval_str = "Step: {step} Eval acc: cl {class_acc:.5f} tr {transition_acc:.5f} {filename} Time: {time:.5f}"
 
-    if extra and evaluation.HasField('invalid'):
+    if extra and (evaluation.HasField('invalid')
+                  or evaluation.HasField('active_fraction')
+                  or evaluation.HasField('examples_per_second')
+                  or evaluation.HasField('duplicate_rate')
+                  or evaluation.HasField('subtree_dedup_ratio')):
         eval_str += "\nEval Extra:"
-        eval_str += " inv {invalid:.3f}"
+        if evaluation.HasField('invalid'):
+            eval_str += " inv {invalid:.3f}"
+        if evaluation.HasField('active_fraction'):
+            eval_str += " act {active_fraction:.3f}"
+        if evaluation.HasField('examples_per_second'):
+            eval_str += " ex/s {examples_per_second:.1f} tok/s {tokens_per_second:.1f}"
+        if evaluation.HasField('duplicate_rate'):
+            eval_str += " dup {duplicate_rate:.3f} hit {cache_hit_rate:.3f}"
+        if evaluation.HasField('subtree_dedup_ratio'):
+            eval_str += " subtree_dedup {subtree_dedup_ratio:.2f}x"
 
     return eval_str
 
@@ -258,13 +374,24 @@ def log_formatter(log_entry, extra=False, rl=False):
         'time': log_entry.time_per_token_seconds,
         'learning_rate': log_entry.learning_rate,
         'invalid': log_entry.invalid,
+        'active_fraction': log_entry.active_fraction,
         'mean_adv_mean': log_entry.mean_adv_mean,
         'mean_adv_mean_magnitude': log_entry.mean_adv_mean_magnitude,
         'mean_adv_var': log_entry.mean_adv_var,
         'mean_adv_var_magnitude': log_entry.mean_adv_var_magnitude,
         'epsilon': log_entry.epsilon,
         'temperature': log_entry.temperature,
+        'examples_per_second': log_entry.examples_per_second,
+        'tokens_per_second': log_entry.tokens_per_second,
     }
+    for key in TIMING_STAGES + TIMING_OVERHEADS:
+        args['timing_' + key] = getattr(log_entry.timing, key)
+    for key in PROFILE_PHASES:
+        args['profile_' + key] = getattr(log_entry.profile, key)
+    for op in ['shift', 'reduce']:
+        calls = getattr(log_entry.profile, op + '_calls')
+        rows = getattr(log_entry.profile, op + '_rows')
+        args[op + '_rows_per_call'] = rows / calls if calls > 0 else 0.0
 
     log_str = train_format(log_entry, extra, rl).format(**args)
     if len(log_entry.evaluation) > 0:
@@ -276,6 +403,12 @@ def log_formatter(log_entry, extra=False, rl=False):
                 'filename': evaluation.filename,
                 'time': evaluation.time_per_token_seconds,
                 'invalid': evaluation.invalid,
+                'active_fraction': evaluation.active_fraction,
+                'examples_per_second': evaluation.examples_per_second,
+                'tokens_per_second': evaluation.tokens_per_second,
+                'duplicate_rate': evaluation.duplicate_rate,
+                'cache_hit_rate': evaluation.cache_hit_rate,
+                'subtree_dedup_ratio': evaluation.subtree_dedup_ratio,
             }
             log_str += '\n' + \
                 eval_format(evaluation, extra).format(**eval_args)
@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
     name='spinn/util/logging.proto',
     package='logging',
     syntax='proto2',
-    serialized_pb=_b('\n\x18spinn/util/logging.proto\x12\x07logging\"V\n\x08SpinnLog\x12$\n\x06header\x18\x01 \x03(\x0b\x32\x14.logging.SpinnHeader\x12$\n\x07\x65ntries\x18\x02 \x03(\x0b\x32\x13.logging.SpinnEntry\"\x8c\x02\n\x0bSpinnHeader\x12\x14\n\x0ctotal_params\x18\x01 \x01(\x05\x12\x1a\n\x12model_architecture\x18\x02 \x01(\t\x12\x16\n\x0e\x65val_filenames\x18\x03 \x03(\t\x12\x12\n\nstart_step\x18\x04 \x01(\x05\x12\x12\n\nstart_time\x18\x05 \x01(\x03\x12\x13\n\x0bmodel_label\x18\x06 \x03(\t\x12\x33\n\x05\x66lags\x18\x64 \x03(\x0b\x32$.logging.SpinnHeader.CommandLineFlag\x12\x12\n\nextra_logs\x18\x65 \x03(\t\x1a-\n\x0f\x43ommandLineFlag\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t\"\xa1\x01\n\x08\x45valData\x12\x1b\n\x13\x65val_class_accuracy\x18\x02 \x01(\x02\x12 \n\x18\x65val_transition_accuracy\x18\x03 \x01(\x02\x12\x10\n\x08\x66ilename\x18\x04 \x01(\t\x12\x1e\n\x16time_per_token_seconds\x18\x05 \x01(\x02\x12\x13\n\x0breport_path\x18\x06 \x01(\t\x12\x0f\n\x07invalid\x18\x07 \x01(\x02\"\x87\x01\n\x0fRLSamplingStats\x12\r\n\x05t_idx\x18\x01 \x01(\x05\x12\x10\n\x08\x63rossing\x18\x02 \x01(\x02\x12\x0f\n\x07gold_lb\x18\x03 \x01(\t\x12\x0f\n\x07pred_tr\x18\x04 \x01(\t\x12\x0f\n\x07pred_ev\x18\x05 \x01(\t\x12\x0f\n\x07strg_tr\x18\x06 \x01(\t\x12\x0f\n\x07strg_ev\x18\x07 \x01(\t\"\xc1\x04\n\nSpinnEntry\x12\x0c\n\x04step\x18\x01 \x01(\x05\x12\x16\n\x0e\x63lass_accuracy\x18\x02 \x01(\x02\x12\x1b\n\x13transition_accuracy\x18\x03 \x01(\x02\x12\x12\n\ntotal_cost\x18\x04 \x01(\x02\x12\x1a\n\x12\x63ross_entropy_cost\x18\x05 \x01(\x02\x12\x17\n\x0ftransition_cost\x18\x06 \x01(\x02\x12\x0f\n\x07l2_cost\x18\x07 \x01(\x02\x12\x1e\n\x16time_per_token_seconds\x18\x08 \x01(\x02\x12\x15\n\rlearning_rate\x18\t \x01(\x02\x12\x0f\n\x07invalid\x18\n \x01(\x02\x12\x13\n\x0bmodel_label\x18\x16 \x01(\t\x12\x12\n\nroot_label\x18\x17 \x01(\t\x12\x13\n\x0bpolicy_cost\x18\x0b \x01(\x02\x12\x12\n\nvalue_cost\x18\x0c \x01(\x02\x12\x15\n\rmean_adv_mean\x18\r \x01(\x02\x12\x1f\n\x17mean_adv_mean_magnitude\x18\x0e \x01(\x02\x12\x14\n\x0cmean_adv_var\x18\x0f \x01(\x02\x12\x1e\n\x16mean_adv_var_magnitude\x18\x10 \x01(\x02\x12\x0f\n\x07\x65psilon\x18\x11 \x01(\x02\x12\x13\n\x0btemperature\x18\x12 \x01(\x02\x12%\n\nevaluation\x18\x13 \x03(\x0b\x32\x11.logging.EvalData\x12-\n\x0brl_sampling\x18\x14 \x03(\x0b\x32\x18.logging.RLSamplingStats\x12\x12\n\ncheckpoint\x18\x15 \x01(\t\"\x8c\x01\n\x0c\x45valSentence\x12\x13\n\x0bsentence_id\x18\x01 \x01(\x05\x12\x12\n\nprediction\x18\x02 \x01(\x05\x12\r\n\x05truth\x18\x03 \x01(\x05\x12\x0e\n\x06output\x18\x04 \x03(\x02\x12\x19\n\x11sent1_transitions\x18\x05 \x03(\x05\x12\x19\n\x11sent2_transitions\x18\x06 \x03(\x05\"5\n\tEvalBatch\x12(\n\tsentences\x18\x01 \x03(\x0b\x32\x15.logging.EvalSentence\"7\n\x10\x45valuationReport\x12#\n\x07\x62\x61tches\x18\x01 \x03(\x0b\x32\x12.logging.EvalBatch')
+    serialized_pb=_b('\n\x18spinn/util/logging.proto\x12\x07logging\"V\n\x08SpinnLog\x12$\n\x06header\x18\x01 \x03(\x0b\x32\x14.logging.SpinnHeader\x12$\n\x07\x65ntries\x18\x02 \x03(\x0b\x32\x13.logging.SpinnEntry\"\x8c\x02\n\x0bSpinnHeader\x12\x14\n\x0ctotal_params\x18\x01 \x01(\x05\x12\x1a\n\x12model_architecture\x18\x02 \x01(\t\x12\x16\n\x0e\x65val_filenames\x18\x03 \x03(\t\x12\x12\n\nstart_step\x18\x04 \x01(\x05\x12\x12\n\nstart_time\x18\x05 \x01(\x03\x12\x13\n\x0bmodel_label\x18\x06 \x03(\t\x12\x33\n\x05\x66lags\x18\x64 \x03(\x0b\x32$.logging.SpinnHeader.CommandLineFlag\x12\x12\n\nextra_logs\x18\x65 \x03(\t\x1a-\n\x0f\x43ommandLineFlag\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t\"\xbf\x02\n\x08\x45valData\x12\x1b\n\x13\x65val_class_accuracy\x18\x02 \x01(\x02\x12 \n\x18\x65val_transition_accuracy\x18\x03 \x01(\x02\x12\x10\n\x08\x66ilename\x18\x04 \x01(\t\x12\x1e\n\x16time_per_token_seconds\x18\x05 \x01(\x02\x12\x13\n\x0breport_path\x18\x06 \x01(\t\x12\x0f\n\x07invalid\x18\x07 \x01(\x02\x12\x17\n\x0f\x61\x63tive_fraction\x18\x08 \x01(\x02\x12\x1b\n\x13\x65xamples_per_second\x18\t \x01(\x02\x12\x19\n\x11tokens_per_second\x18\n \x01(\x02\x12\x16\n\x0e\x64uplicate_rate\x18\x0b \x01(\x02\x12\x16\n\x0e\x63\x61\x63he_hit_rate\x18\x0c \x01(\x02\x12\x1b\n\x13subtree_dedup_ratio\x18\r \x01(\x02\"\x89\x02\n\x0cSpinnProfile\x12\x0f\n\x07tracker\x18\x01 \x01(\x02\x12\x16\n\x0etransition_net\x18\x02 \x01(\x02\x12\x17\n\x0fpredict_actions\x18\x03 \x01(\x02\x12\x10\n\x08validate\x18\x04 \x01(\x02\x12\x12\n\npre_action\x18\x05 \x01(\x02\x12\x13\n\x0bshift_phase\x18\x06 \x01(\x02\x12\x14\n\x0creduce_phase\x18\x07 \x01(\x02\x12\x12\n\nloss_phase\x18\x08 \x01(\x02\x12\x13\n\x0bshift_calls\x18\t \x01(\x02\x12\x12\n\nshift_rows\x18\n \x01(\x02\x12\x14\n\x0creduce_calls\x18\x0b \x01(\x02\x12\x13\n\x0breduce_rows\x18\x0c \x01(\x02\"q\n\nStepTiming\x12\x11\n\tdata_wait\x18\x01 \x01(\x02\x12\x0f\n\x07\x66orward\x18\x02 \x01(\x02\x12\x10\n\x08\x62\x61\x63kward\x18\x03 \x01(\x02\x12\x11\n\toptimizer\x18\x04 \x01(\x02\x12\x0c\n\x04\x65val\x18\x05 \x01(\x02\x12\x0c\n\x04save\x18\x06 \x01(\x02\"\x87\x01\n\x0fRLSamplingStats\x12\r\n\x05t_idx\x18\x01 \x01(\x05\x12\x10\n\x08\x63rossing\x18\x02 \x01(\x02\x12\x0f\n\x07gold_lb\x18\x03 \x01(\t\x12\x0f\n\x07pred_tr\x18\x04 \x01(\t\x12\x0f\n\x07pred_ev\x18\x05 \x01(\t\x12\x0f\n\x07strg_tr\x18\x06 \x01(\t\x12\x0f\n\x07strg_ev\x18\x07 \x01(\t\"\xdf\x05\n\nSpinnEntry\x12\x0c\n\x04step\x18\x01 \x01(\x05\x12\x16\n\x0e\x63lass_accuracy\x18\x02 \x01(\x02\x12\x1b\n\x13transition_accuracy\x18\x03 \x01(\x02\x12\x12\n\ntotal_cost\x18\x04 \x01(\x02\x12\x1a\n\x12\x63ross_entropy_cost\x18\x05 \x01(\x02\x12\x17\n\x0ftransition_cost\x18\x06 \x01(\x02\x12\x0f\n\x07l2_cost\x18\x07 \x01(\x02\x12\x1e\n\x16time_per_token_seconds\x18\x08 \x01(\x02\x12\x15\n\rlearning_rate\x18\t \x01(\x02\x12\x0f\n\x07invalid\x18\n \x01(\x02\x12\x13\n\x0bmodel_label\x18\x16 \x01(\t\x12\x12\n\nroot_label\x18\x17 \x01(\t\x12\x17\n\x0f\x61\x63tive_fraction\x18\x18 \x01(\x02\x12&\n\x07profile\x18\x19 \x01(\x0b\x32\x15.logging.SpinnProfile\x12#\n\x06timing\x18\x1a \x01(\x0b\x32\x13.logging.StepTiming\x12\x1b\n\x13\x65xamples_per_second\x18\x1b \x01(\x02\x12\x19\n\x11tokens_per_second\x18\x1c \x01(\x02\x12\x13\n\x0bpolicy_cost\x18\x0b \x01(\x02\x12\x12\n\nvalue_cost\x18\x0c \x01(\x02\x12\x15\n\rmean_adv_mean\x18\r \x01(\x02\x12\x1f\n\x17mean_adv_mean_magnitude\x18\x0e \x01(\x02\x12\x14\n\x0cmean_adv_var\x18\x0f \x01(\x02\x12\x1e\n\x16mean_adv_var_magnitude\x18\x10 \x01(\x02\x12\x0f\n\x07\x65psilon\x18\x11 \x01(\x02\x12\x13\n\x0btemperature\x18\x12 \x01(\x02\x12%\n\nevaluation\x18\x13 \x03(\x0b\x32\x11.logging.EvalData\x12-\n\x0brl_sampling\x18\x14 \x03(\x0b\x32\x18.logging.RLSamplingStats\x12\x12\n\ncheckpoint\x18\x15 \x01(\t\"\x8c\x01\n\x0c\x45valSentence\x12\x13\n\x0bsentence_id\x18\x01 \x01(\x05\x12\x12\n\nprediction\x18\x02 \x01(\x05\x12\r\n\x05truth\x18\x03 \x01(\x05\x12\x0e\n\x06output\x18\x04 \x03(\x02\x12\x19\n\x11sent1_transitions\x18\x05 \x03(\x05\x12\x19\n\x11sent2_transitions\x18\x06 \x03(\x05\"5\n\tEvalBatch\x12(\n\tsentences\x18\x01 \x03(\x0b\x32\x15.logging.EvalSentence\"7\n\x10\x45valuationReport\x12#\n\x07\x62\x61tches\x18\x01 \x03(\x0b\x32\x12.logging.EvalBatch')
 )
 
 
@@ -296,6 +296,102 @@ _EVALDATA = _descriptor.Descriptor(
             is_extension=False,
             extension_scope=None,
             options=None),
+        _descriptor.FieldDescriptor(
+            name='active_fraction',
+            full_name='logging.EvalData.active_fraction',
+            index=6,
+            number=8,
+            type=2,
+            cpp_type=6,
+            label=1,
+            has_default_value=False,
+            default_value=float(0),
+            message_type=None,
+            enum_type=None,
+            containing_type=None,
+            is_extension=False,
+            extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='examples_per_second',
+            full_name='logging.EvalData.examples_per_second',
+            index=7,
+            number=9,
+            type=2,
+            cpp_type=6,
+            label=1,
+            has_default_value=False,
+            default_value=float(0),
+            message_type=None,
+            enum_type=None,
+            containing_type=None,
+            is_extension=False,
+            extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='tokens_per_second',
+            full_name='logging.EvalData.tokens_per_second',
+            index=8,
+            number=10,
+            type=2,
+            cpp_type=6,
+            label=1,
+            has_default_value=False,
+            default_value=float(0),
+            message_type=None,
+            enum_type=None,
+            containing_type=None,
+            is_extension=False,
+            extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='duplicate_rate',
+            full_name='logging.EvalData.duplicate_rate',
+            index=9,
+            number=11,
+            type=2,
+            cpp_type=6,
+            label=1,
+            has_default_value=False,
+            default_value=float(0),
+            message_type=None,
+            enum_type=None,
+            containing_type=None,
+            is_extension=False,
+            extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='cache_hit_rate',
+            full_name='logging.EvalData.cache_hit_rate',
+            index=10,
+            number=12,
+            type=2,
+            cpp_type=6,
+            label=1,
+            has_default_value=False,
+            default_value=float(0),
+            message_type=None,
+            enum_type=None,
+            containing_type=None,
+            is_extension=False,
+            extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='subtree_dedup_ratio',
+            full_name='logging.EvalData.subtree_dedup_ratio',
+            index=11,
+            number=13,
+            type=2,
+            cpp_type=6,
+            label=1,
+            has_default_value=False,
+            default_value=float(0),
+            message_type=None,
+            enum_type=None,
+            containing_type=None,
+            is_extension=False,
+            extension_scope=None,
+            options=None),
     ],
     extensions=[],
     nested_types=[],
@@ -306,7 +402,181 @@ _EVALDATA = _descriptor.Descriptor(
     extension_ranges=[],
     oneofs=[],
     serialized_start=397,
-    serialized_end=558,
+    serialized_end=716,
+)
+
+
+_SPINNPROFILE = _descriptor.Descriptor(
+    name='SpinnProfile',
+    full_name='logging.SpinnProfile',
+    filename=None,
+    file=DESCRIPTOR,
+    containing_type=None,
+    fields=[
+        _descriptor.FieldDescriptor(
+            name='tracker', full_name='logging.SpinnProfile.tracker', index=0,
+            number=1, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='transition_net', full_name='logging.SpinnProfile.transition_net', index=1,
+            number=2, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='predict_actions', full_name='logging.SpinnProfile.predict_actions', index=2,
+            number=3, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='validate', full_name='logging.SpinnProfile.validate', index=3,
+            number=4, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='pre_action', full_name='logging.SpinnProfile.pre_action', index=4,
+            number=5, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='shift_phase', full_name='logging.SpinnProfile.shift_phase', index=5,
+            number=6, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='reduce_phase', full_name='logging.SpinnProfile.reduce_phase', index=6,
+            number=7, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='loss_phase', full_name='logging.SpinnProfile.loss_phase', index=7,
+            number=8, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='shift_calls', full_name='logging.SpinnProfile.shift_calls', index=8,
+            number=9, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='shift_rows', full_name='logging.SpinnProfile.shift_rows', index=9,
+            number=10, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='reduce_calls', full_name='logging.SpinnProfile.reduce_calls', index=10,
+            number=11, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='reduce_rows', full_name='logging.SpinnProfile.reduce_rows', index=11,
+            number=12, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+    ],
+    extensions=[
+    ],
+    nested_types=[],
+    enum_types=[
+    ],
+    options=None,
+    is_extendable=False,
+    syntax='proto2',
+    extension_ranges=[],
+    oneofs=[
+    ],
+    serialized_start=719,
+    serialized_end=984,
+)
+
+
+_STEPTIMING = _descriptor.Descriptor(
+    name='StepTiming',
+    full_name='logging.StepTiming',
+    filename=None,
+    file=DESCRIPTOR,
+    containing_type=None,
+    fields=[
+        _descriptor.FieldDescriptor(
+            name='data_wait', full_name='logging.StepTiming.data_wait', index=0,
+            number=1, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='forward', full_name='logging.StepTiming.forward', index=1,
+            number=2, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='backward', full_name='logging.StepTiming.backward', index=2,
+            number=3, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='optimizer', full_name='logging.StepTiming.optimizer', index=3,
+            number=4, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='eval', full_name='logging.StepTiming.eval', index=4,
+            number=5, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='save', full_name='logging.StepTiming.save', index=5,
+            number=6, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+    ],
+    extensions=[
+    ],
+    nested_types=[],
+    enum_types=[
+    ],
+    options=None,
+    is_extendable=False,
+    syntax='proto2',
+    extension_ranges=[],
+    oneofs=[
+    ],
+    serialized_start=986,
+    serialized_end=1099,
 )
 
 
@@ -378,8 +648,8 @@ _RLSAMPLINGSTATS = _descriptor.Descriptor(
     extension_ranges=[],
     oneofs=[
     ],
-    serialized_start=561,
-    serialized_end=696,
+    serialized_start=1102,
+    serialized_end=1237,
 )
 
 
@@ -475,77 +745,112 @@ _SPINNENTRY = _descriptor.Descriptor(
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='policy_cost', full_name='logging.SpinnEntry.policy_cost', index=12,
+            name='active_fraction', full_name='logging.SpinnEntry.active_fraction', index=12,
+            number=24, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='profile', full_name='logging.SpinnEntry.profile', index=13,
+            number=25, type=11, cpp_type=10, label=1,
+            has_default_value=False, default_value=None,
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='timing', full_name='logging.SpinnEntry.timing', index=14,
+            number=26, type=11, cpp_type=10, label=1,
+            has_default_value=False, default_value=None,
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='examples_per_second', full_name='logging.SpinnEntry.examples_per_second', index=15,
+            number=27, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='tokens_per_second', full_name='logging.SpinnEntry.tokens_per_second', index=16,
+            number=28, type=2, cpp_type=6, label=1,
+            has_default_value=False, default_value=float(0),
+            message_type=None, enum_type=None, containing_type=None,
+            is_extension=False, extension_scope=None,
+            options=None),
+        _descriptor.FieldDescriptor(
+            name='policy_cost', full_name='logging.SpinnEntry.policy_cost', index=17,
             number=11, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='value_cost', full_name='logging.SpinnEntry.value_cost', index=13,
+            name='value_cost', full_name='logging.SpinnEntry.value_cost', index=18,
             number=12, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='mean_adv_mean', full_name='logging.SpinnEntry.mean_adv_mean', index=14,
+            name='mean_adv_mean', full_name='logging.SpinnEntry.mean_adv_mean', index=19,
             number=13, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='mean_adv_mean_magnitude', full_name='logging.SpinnEntry.mean_adv_mean_magnitude', index=15,
+            name='mean_adv_mean_magnitude', full_name='logging.SpinnEntry.mean_adv_mean_magnitude', index=20,
             number=14, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='mean_adv_var', full_name='logging.SpinnEntry.mean_adv_var', index=16,
+            name='mean_adv_var', full_name='logging.SpinnEntry.mean_adv_var', index=21,
             number=15, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='mean_adv_var_magnitude', full_name='logging.SpinnEntry.mean_adv_var_magnitude', index=17,
+            name='mean_adv_var_magnitude', full_name='logging.SpinnEntry.mean_adv_var_magnitude', index=22,
             number=16, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='epsilon', full_name='logging.SpinnEntry.epsilon', index=18,
+            name='epsilon', full_name='logging.SpinnEntry.epsilon', index=23,
             number=17, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='temperature', full_name='logging.SpinnEntry.temperature', index=19,
+            name='temperature', full_name='logging.SpinnEntry.temperature', index=24,
             number=18, type=2, cpp_type=6, label=1,
             has_default_value=False, default_value=float(0),
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='evaluation', full_name='logging.SpinnEntry.evaluation', index=20,
+            name='evaluation', full_name='logging.SpinnEntry.evaluation', index=25,
             number=19, type=11, cpp_type=10, label=3,
             has_default_value=False, default_value=[],
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='rl_sampling', full_name='logging.SpinnEntry.rl_sampling', index=21,
+            name='rl_sampling', full_name='logging.SpinnEntry.rl_sampling', index=26,
             number=20, type=11, cpp_type=10, label=3,
             has_default_value=False, default_value=[],
             message_type=None, enum_type=None, containing_type=None,
             is_extension=False, extension_scope=None,
             options=None),
         _descriptor.FieldDescriptor(
-            name='checkpoint', full_name='logging.SpinnEntry.checkpoint', index=22,
+            name='checkpoint', full_name='logging.SpinnEntry.checkpoint', index=27,
             number=21, type=9, cpp_type=9, label=1,
             has_default_value=False, default_value=_b("").decode('utf-8'),
             message_type=None, enum_type=None, containing_type=None,
@@ -563,8 +868,8 @@ _SPINNENTRY = _descriptor.Descriptor(
     extension_ranges=[],
     oneofs=[
     ],
-    serialized_start=699,
-    serialized_end=1276,
+    serialized_start=1240,
+    serialized_end=1975,
 )
 
 
@@ -629,8 +934,8 @@ _EVALSENTENCE = _descriptor.Descriptor(
     extension_ranges=[],
     oneofs=[
     ],
-    serialized_start=1279,
-    serialized_end=1419,
+    serialized_start=1978,
+    serialized_end=2118,
 )
 
 
@@ -660,8 +965,8 @@ _EVALBATCH = _descriptor.Descriptor(
     extension_ranges=[],
     oneofs=[
     ],
-    serialized_start=1421,
-    serialized_end=1474,
+    serialized_start=2120,
+    serialized_end=2173,
 )
 
 
@@ -697,14 +1002,16 @@ _EVALUATIONREPORT = _descriptor.Descriptor(
     syntax='proto2',
     extension_ranges=[],
     oneofs=[],
-    serialized_start=1476,
-    serialized_end=1531,
+    serialized_start=2175,
+    serialized_end=2230,
 )
 
 _SPINNLOG.fields_by_name['header'].message_type = _SPINNHEADER
 _SPINNLOG.fields_by_name['entries'].message_type = _SPINNENTRY
 _SPINNHEADER_COMMANDLINEFLAG.containing_type = _SPINNHEADER
 _SPINNHEADER.fields_by_name['flags'].message_type = _SPINNHEADER_COMMANDLINEFLAG
+_SPINNENTRY.fields_by_name['profile'].message_type = _SPINNPROFILE
+_SPINNENTRY.fields_by_name['timing'].message_type = _STEPTIMING
 _SPINNENTRY.fields_by_name['evaluation'].message_type = _EVALDATA
 _SPINNENTRY.fields_by_name['rl_sampling'].message_type = _RLSAMPLINGSTATS
 _EVALBATCH.fields_by_name['sentences'].message_type = _EVALSENTENCE
@@ -712,6 +1019,8 @@ _EVALUATIONREPORT.fields_by_name['batches'].message_type = _EVALBATCH
 DESCRIPTOR.message_types_by_name['SpinnLog'] = _SPINNLOG
 DESCRIPTOR.message_types_by_name['SpinnHeader'] = _SPINNHEADER
 DESCRIPTOR.message_types_by_name['EvalData'] = _EVALDATA
+DESCRIPTOR.message_types_by_name['SpinnProfile'] = _SPINNPROFILE
+DESCRIPTOR.message_types_by_name['StepTiming'] = _STEPTIMING
 DESCRIPTOR.message_types_by_name['RLSamplingStats'] = _RLSAMPLINGSTATS
 DESCRIPTOR.message_types_by_name['SpinnEntry'] = _SPINNENTRY
 DESCRIPTOR.message_types_by_name['EvalSentence'] = _EVALSENTENCE
@@ -747,6 +1056,20 @@ EvalData = _reflection.GeneratedProtocolMessageType('EvalData', (_message.Messag
 ))
 _sym_db.RegisterMessage(EvalData)
 
+SpinnProfile = _reflection.GeneratedProtocolMessageType('SpinnProfile', (_message.Message,), dict(
+    DESCRIPTOR=_SPINNPROFILE,
+    __module__='spinn.util.logging_pb2'
+    # @@protoc_insertion_point(class_scope:logging.SpinnProfile)
+))
+_sym_db.RegisterMessage(SpinnProfile)
+
+StepTiming = _reflection.GeneratedProtocolMessageType('StepTiming', (_message.Message,), dict(
+    DESCRIPTOR=_STEPTIMING,
+    __module__='spinn.util.logging_pb2'
+    # @@protoc_insertion_point(class_scope:logging.StepTiming)
+))
+_sym_db.RegisterMessage(StepTiming)
+
 RLSamplingStats = _reflection.GeneratedProtocolMessageType('RLSamplingStats', (_message.Message,), dict(
     DESCRIPTOR=_RLSAMPLINGSTATS,
     __module__='spinn.util.logging_pb2'
@@ -1,7 +1,8 @@
 import numpy as np
-from collections import deque
+from collections import deque, OrderedDict
 import json
 import os
+import time
 import logging_pb2 as pb
 
 
@@ -32,6 +33,10 @@ def time_per_token(num_tokens, total_time):
     return sum(total_time) / float(sum(num_tokens))
 
 
+def per_second(counts, total_time):
+    return sum(counts) / float(sum(total_time))
+
+
 class Accumulator(object):
     """Accumulator. Makes it easy to keep a trailing list of statistics."""
 
@@ -55,6 +60,82 @@ class Accumulator(object):
         return np.array(self.get(key, clear)).mean()
 
 
+class Profiler(object):
+    """Totals the time spent in named phases and counts named events.
+
+    When disabled, start and stop return immediately, so the calls can be left
+    in hot loops.
+
+        t = profiler.start()
+        ...
+        profiler.stop('phase', t)
+
+    Args:
+        enabled: Whether to record anything.
+        synchronize: Called before reading the clock, e.g. to wait for
+            asynchronous GPU work so it is counted in the right phase.
+    """
+
+    def __init__(self, enabled=False, synchronize=None):
+        self.enabled = enabled
+        self.synchronize = synchronize
+        self.reset()
+
+    def reset(self):
+        self.times = dict()
+        self.counts = dict()
+
+    def start(self):
+        if not self.enabled:
+            return None
+        if self.synchronize is not None:
+            self.synchronize()
+        return time.time()
+
+    def stop(self, key, start):
+        if not self.enabled:
+            return
+        if self.synchronize is not None:
+            self.synchronize()
+        self.times[key] = self.times.get(key, 0.0) + time.time() - start
+
+    def count(self, key, n=1):
+        if self.enabled:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+
+class LRUCache(object):
+    """A mapping of bounded size that evicts the least recently used entry,
+    and counts lookups that hit and miss."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
 class EvalReporter(object):
     def __init__(self):
         super(EvalReporter, self).__init__()
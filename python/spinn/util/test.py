@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 
 from spinn.util.misc import Args
+from spinn.util.blocks import LSTMStateBatch
 
 
 def default_args(**kwargs):
@@ -41,21 +42,16 @@ def default_args(**kwargs):
         args['word_embedding_dim'],
         args['model_dim'])
     context_args.input_dim = args['model_dim']
+    context_args.token_wise = True
 
     args['context_args'] = context_args
 
     class Reduce(nn.Module):
         def forward(self, lefts, rights, tracking):
-            batch_size = len(lefts)
-            return torch.chunk(
-                torch.cat(
-                    lefts,
-                    0) -
-                torch.cat(
-                    rights,
-                    0),
-                batch_size,
-                0)
+            batched = isinstance(lefts, LSTMStateBatch)
+            ret = LSTMStateBatch(LSTMStateBatch.wrap(lefts).both -
+                                 LSTMStateBatch.wrap(rights).both)
+            return ret if batched else ret.unbundle()
 
     composition_args = Args()
     composition_args.lateral_tracking = True
@@ -69,6 +65,12 @@ def default_args(**kwargs):
     composition_args.tracking_ln = False
     composition_args.detach = False
     composition_args.evolution = False
+    composition_args.stack_type = "fat"
+    composition_args.level_wise = False
+    composition_args.hash_cons = False
+    composition_args.compact_active_rows = False
+    composition_args.fused_gates = False
+    composition_args.profile = False
 
     args['composition_args'] = composition_args
 
@@ -0,0 +1,26 @@
+"""Converts a GloVe-format text vector file into a binary store, which
+--embedding_data_path can load much faster.
+
+$ python scripts/convert_embeddings.py \
+    --text_path ~/data/glove.840B.300d.txt \
+    --store_path ~/data/glove.840B.300d.npy
+
+This writes the float32 matrix to glove.840B.300d.npy and the word of each row
+to glove.840B.300d.words.
+"""
+
+import gflags
+import sys
+
+from spinn.util.data import ConvertEmbeddingsToBinary
+
+FLAGS = gflags.FLAGS
+
+
+if __name__ == '__main__':
+    gflags.DEFINE_string("text_path", None, "GloVe-format text vector file.")
+    gflags.DEFINE_string("store_path", None, "Where to write the matrix. Must end in .npy.")
+    FLAGS(sys.argv)
+    num_words, embedding_dim = ConvertEmbeddingsToBinary(
+        FLAGS.text_path, FLAGS.store_path)
+    print("Wrote {} embeddings of dimension {}.".format(num_words, embedding_dim))